@@ -0,0 +1,5 @@
+# coding: utf-8
+
+"""
+Benchmarks of the alljets hot paths on synthetic events, see :py:mod:`alljets.benchmark.run`.
+"""
@@ -0,0 +1,238 @@
+# coding: utf-8
+
+"""
+Synthetic NanoAOD-like events for benchmarking the alljets selectors and producers.
+
+The generated events contain the ``Jet`` collection with b-tag scores and hadron flavours, the
+collections ``Bjet``, ``LightJet`` and ``VetoJet`` as created by the default selection, ``HLT``
+decisions with a turn-on in H_T, reconstructed top quark masses and ``gen_top`` truth records in
+the format of :py:func:`columnflow.production.cms.gen_particles.gen_top_lookup`. Everything is drawn
+with numpy from a single seed, so that the same arguments always produce the same events.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+
+from alljets.util import local_index_flat, pad_flat
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# pdg ids of the generated truth particles
+PDG_TOP = 6
+PDG_B = 5
+PDG_W = 24
+PDG_QUARKS = (1, 2, 3, 4)
+
+
+def jet_multiplicity(
+    n_events: int,
+    spec: str,
+    rng: np.random.Generator,
+    max_jets: int = 20,
+) -> np.ndarray:
+    """
+    Draws the number of jets for *n_events* events following the distribution *spec*, which is one
+    of ``"fixed:<n>"``, ``"poisson:<mean>"`` or ``"uniform:<min>-<max>"`` (both inclusive). Counts
+    are clipped to *max_jets*.
+    """
+    kind, _, value = spec.partition(":")
+    try:
+        if kind == "fixed":
+            counts = np.full(n_events, int(value))
+        elif kind == "poisson":
+            counts = rng.poisson(float(value), n_events)
+        elif kind == "uniform":
+            low, high = map(int, value.split("-"))
+            counts = rng.integers(low, high + 1, n_events)
+        else:
+            raise ValueError(f"unknown distribution '{kind}'")
+    except ValueError as e:
+        raise ValueError(f"invalid jet multiplicity '{spec}': {e}") from e
+
+    return np.clip(counts, 0, max_jets).astype(np.int64)
+
+
+def _p4(pt, eta, phi, mass):
+    px, py, pz = pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+    return px, py, pz, np.sqrt(px ** 2 + py ** 2 + pz ** 2 + mass ** 2)
+
+
+def _add(*particles: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    # sum of particles given as dicts of (pt, eta, phi, mass) arrays
+    px, py, pz, e = (sum(c) for c in zip(*(_p4(p["pt"], p["eta"], p["phi"], p["mass"]) for p in particles)))
+    pt = np.hypot(px, py)
+    return {
+        "pt": pt,
+        "eta": np.arcsinh(pz / np.maximum(pt, 1e-6)),
+        "phi": np.arctan2(py, px),
+        "mass": np.sqrt(np.maximum(e ** 2 - px ** 2 - py ** 2 - pz ** 2, 0.0)),
+    }
+
+
+def _gen_particles(
+    kin: dict[str, np.ndarray],
+    pdg_id: np.ndarray,
+    status: int,
+) -> ak.Array:
+    # regular (n_events, ...) blocks of gen particles as jagged records
+    shape = kin["pt"].shape
+    fields = {
+        **{key: value.astype(np.float32) for key, value in kin.items()},
+        "pdgId": np.broadcast_to(pdg_id, shape).astype(np.int32),
+        "status": np.full(shape, status, dtype=np.int32),
+        "statusFlags": np.full(shape, 1 << 13, dtype=np.int32),
+        "genPartIdxMother": np.full(shape, -1, dtype=np.int32),
+    }
+    return ak.with_name(ak.from_regular(ak.zip(fields), axis=None), "GenParticle")
+
+
+def _gen_top(
+    jets: dict[str, np.ndarray],
+    order: np.ndarray,
+    counts: np.ndarray,
+    match_fraction: float,
+    rng: np.random.Generator,
+) -> ak.Array:
+    # truth partons, (b1, b2, q11, q12, q21, q22), smeared around the jets at the first six positions
+    # of *order* for matched events and drawn independently otherwise
+    n_events = len(counts)
+    idx = order[:, :6]
+    matched = (rng.random(n_events) < match_fraction)[:, None] & (idx < counts[:, None])
+    rows = np.arange(n_events)[:, None]
+    random = {
+        "pt": 30.0 + rng.exponential(50.0, idx.shape),
+        "eta": rng.uniform(-2.5, 2.5, idx.shape),
+        "phi": rng.uniform(-np.pi, np.pi, idx.shape),
+        "mass": rng.uniform(0.0, 5.0, idx.shape),
+    }
+    smear = {
+        "pt": jets["pt"][rows, idx] * rng.normal(1.0, 0.1, idx.shape),
+        "eta": jets["eta"][rows, idx] + rng.normal(0.0, 0.05, idx.shape),
+        "phi": jets["phi"][rows, idx] + rng.normal(0.0, 0.05, idx.shape),
+        "mass": jets["mass"][rows, idx],
+    }
+    partons = {key: np.where(matched, smear[key], random[key]) for key in random}
+
+    b = {key: value[:, :2] for key, value in partons.items()}
+    q = {key: value[:, 2:].reshape(n_events, 2, 2) for key, value in partons.items()}
+    w = _add({key: value[..., 0] for key, value in q.items()}, {key: value[..., 1] for key, value in q.items()})
+    t = _add(b, w)
+
+    # particles of the first top quark, antiparticles of the second one
+    sign = np.array([1, -1])
+    quark_ids = rng.choice(PDG_QUARKS, (n_events, 2, 2)) * sign[:, None] * sign
+    return ak.zip(
+        {
+            "t": _gen_particles(t, PDG_TOP * sign, 62),
+            "b": _gen_particles(b, PDG_B * sign, 23),
+            "w": _gen_particles(w, PDG_W * sign, 22),
+            "w_children": _gen_particles(q, quark_ids, 23),
+        },
+        depth_limit=2,
+    )
+
+
+def generate_events(
+    n_events: int,
+    multiplicity: str = "poisson:8",
+    max_jets: int = 20,
+    n_bjets: int = 2,
+    btag_b: tuple[float, float] = (5.0, 1.2),
+    btag_light: tuple[float, float] = (0.6, 8.0),
+    btag_wp: float = 0.7264,
+    triggers: list[str] | tuple[str, ...] = (),
+    gen_top: bool = True,
+    match_fraction: float = 0.7,
+    category_ids: list[int] | tuple[int, ...] = (),
+    seed: int = 0,
+) -> ak.Array:
+    """
+    Returns *n_events* synthetic events with a jet multiplicity following *multiplicity*, see
+    :py:func:`jet_multiplicity`. Jets are sorted by pt. Per event, up to *n_bjets* randomly chosen
+    jets are b jets with ``hadronFlavour`` 5, whose ``btagDeepFlavB`` scores follow a beta
+    distribution with shape parameters *btag_b*, while scores of all other jets follow *btag_light*.
+    ``Bjet``, ``LightJet`` and ``VetoJet`` are split from the jets by the kinematic fit acceptance
+    and the b-tag working point *btag_wp*.
+
+    Each of the *triggers* fires with a probability that rises with H_T, with turn-on points spread
+    between 400 and 700 GeV. When *gen_top* is set, the ``gen_top`` column contains the truth record
+    of two top quarks, whose b quarks and W boson decay products are close to the b jets and four
+    light jets of the event for a fraction *match_fraction* of events. When *category_ids* are
+    given, the jagged ``category_ids`` column assigns each event to one to three of them, as the
+    leaf categories written by the category_ids producer.
+    """
+    rng = np.random.default_rng(seed)
+    counts = jet_multiplicity(n_events, multiplicity, rng, max_jets=max_jets)
+    offsets = np.zeros(n_events + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    n_jets = int(offsets[-1])
+    event_idx = np.repeat(np.arange(n_events), counts)
+
+    # jet kinematics, sorted by pt within each event
+    pt = 25.0 + rng.exponential(60.0, n_jets)
+    pt = pt[np.lexsort((-pt, event_idx))]
+    jets = {
+        "pt": pt,
+        "eta": rng.uniform(-2.8, 2.8, n_jets),
+        "phi": rng.uniform(-np.pi, np.pi, n_jets),
+        "mass": pt * rng.uniform(0.05, 0.2, n_jets),
+    }
+
+    # random order of jets per event, the first n_bjets are b jets and the next four are light
+    # quark candidates for the truth record
+    key = rng.random(n_jets)
+    rank = np.empty(n_jets, dtype=np.int64)
+    rank[np.lexsort((key, event_idx))] = local_index_flat(offsets)
+    is_b = rank < n_bjets
+    jets["hadronFlavour"] = np.where(is_b, 5, 0).astype(np.int32)
+    jets["btagDeepFlavB"] = np.where(is_b, rng.beta(*btag_b, n_jets), rng.beta(*btag_light, n_jets))
+    jets = {key: value.astype(np.int32 if key == "hadronFlavour" else np.float32) for key, value in jets.items()}
+
+    def jagged(flat):
+        return ak.unflatten(flat, counts)
+
+    jet_coll = ak.zip({key: jagged(value) for key, value in jets.items()})
+    accepted = (np.abs(jets["eta"]) < 2.4) & (jets["pt"] >= 40.0)
+    tagged = accepted & (jets["btagDeepFlavB"] >= btag_wp)
+
+    columns = {
+        "run": np.ones(n_events, dtype=np.uint32),
+        "luminosityBlock": (np.arange(n_events) // 1000 + 1).astype(np.uint32),
+        "event": (np.arange(n_events) + 1 + seed * n_events).astype(np.uint64),
+        "Jet": jet_coll,
+        "Bjet": jet_coll[jagged(tagged)],
+        "LightJet": jet_coll[jagged(accepted & ~tagged)],
+        "VetoJet": jet_coll[jagged(~accepted)],
+        "Mt1": rng.normal(172.5, 20.0, n_events).astype(np.float32),
+        "Mt2": rng.normal(172.5, 20.0, n_events).astype(np.float32),
+    }
+
+    # trigger decisions with a turn-on in H_T
+    if triggers:
+        ht = np.bincount(event_idx, weights=pt, minlength=n_events)
+        thresholds = np.linspace(400.0, 700.0, len(triggers))
+        columns["HLT"] = ak.zip(
+            {
+                name: rng.random(n_events) < 1.0 / (1.0 + np.exp(-(ht - threshold) / 40.0))
+                for name, threshold in zip(triggers, thresholds)
+            },
+            depth_limit=1,
+        )
+
+    if gen_top:
+        order = pad_flat(rank, offsets, n_max=max(6, max_jets), fill_value=max_jets)
+        order = np.argsort(order, axis=1, kind="stable")
+        padded = {key: pad_flat(jets[key], offsets, n_max=order.shape[1]) for key in ("pt", "eta", "phi", "mass")}
+        columns["gen_top"] = _gen_top(padded, order, counts, match_fraction, rng)
+
+    if category_ids:
+        ids = np.asarray(category_ids, dtype=np.int64)
+        n_cats = rng.integers(1, min(3, len(ids)) + 1, n_events)
+        chosen = np.argsort(rng.random((n_events, len(ids))), axis=1)
+        keep = np.arange(len(ids))[None, :] < n_cats[:, None]
+        columns["category_ids"] = ak.unflatten(ids[chosen[keep]], n_cats)
+
+    return ak.zip(columns, depth_limit=1)
@@ -0,0 +1,332 @@
+# coding: utf-8
+
+"""
+Benchmarks of the alljets selectors, producers and histogram filling on synthetic events.
+
+Each target is run on events from :py:func:`alljets.benchmark.generator.generate_events` for all
+combinations of chunk sizes and jet multiplicity distributions. Wall time, CPU time, the peak of
+memory allocations and the throughput are written to a json file together with the commit, so that
+results of different commits can be compared, e.g.
+
+.. code-block:: bash
+
+    python -m alljets.benchmark.run --targets features,kinFitMatch \\
+        --chunk-sizes 10000,50000 --multiplicities poisson:8,uniform:6-14 --output bench_new.json \\
+        --compare bench_old.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import gc
+import importlib
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections.abc import Callable
+
+import law
+
+from columnflow.columnar_util import Route, TaskArrayFunction, has_ak_column, set_ak_column
+from columnflow.util import maybe_import, InsertableDict
+
+from alljets.benchmark.generator import generate_events
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+logger = law.logger.get_logger(__name__)
+
+
+# names of benchmark targets mapped to the module and attribute of the array function
+BENCHMARK_TARGETS = {
+    "jet_selection": ("alljets.selection.jet", "jet_selection"),
+    "features": ("alljets.production.example", "features"),
+    "kinFitMatch": ("alljets.production.example", "kinFitMatch_numpy"),
+    "trigger_prod": ("alljets.production.example", "trigger_prod"),
+    "aj_trighist": ("alljets.histogramming.aj_hist", "aj_trighist"),
+}
+
+# targets that cannot run on the current tree, reported as skipped without numbers
+SKIPPED_TARGETS = {
+    "jet_selection": "jet_selection references the undefined bjet_sel_alt in its BTag_alt step",
+}
+
+# variables of the histogram filled by the aj_trighist target
+TRIGHIST_VARIABLES = ("ht", "trig_bits")
+
+
+def build_inst(target: str, inst_dict: dict) -> TaskArrayFunction:
+    """
+    Imports the array function of the benchmark *target*, creates an instance for the analysis,
+    config and dataset in *inst_dict* and runs its setup without any task, requirements or inputs.
+    """
+    if target not in BENCHMARK_TARGETS:
+        raise ValueError(f"unknown benchmark target '{target}', choose from {', '.join(BENCHMARK_TARGETS)}")
+    module, attr = BENCHMARK_TARGETS[target]
+    inst = getattr(importlib.import_module(module), attr)(inst_dict=dict(inst_dict))
+    inst.run_setup(None, {}, {}, InsertableDict())
+    return inst
+
+
+def complete_columns(events: ak.Array, columns: set[Route | str]) -> ak.Array:
+    """
+    Adds all *columns* that are missing in *events* and not covered by the generator, filled with
+    zeros. Fields of existing collections obtain the structure of their collection, missing
+    collections are added empty. Columns with wildcards are skipped.
+    """
+    for route in sorted(map(Route, columns), key=str):
+        if any("*" in field for field in route.fields) or has_ak_column(events, route):
+            continue
+        head = route.fields[0]
+        if len(route.fields) == 1:
+            value = np.zeros(len(events), dtype=np.float32)
+        elif head in events.fields:
+            coll = events[head]
+            value = ak.zeros_like(coll[coll.fields[0]], dtype=np.float32)
+        else:
+            value = ak.unflatten(np.zeros(0, dtype=np.float32), np.zeros(len(events), dtype=np.int64))
+        events = set_ak_column(events, route, value)
+    return events
+
+
+def measure(func: Callable, n_events: int, repeats: int = 3) -> dict:
+    """
+    Calls *func* once to warm up caches, *repeats* times to measure wall and CPU time, and once more
+    with :py:mod:`tracemalloc` enabled to obtain the peak of memory allocations, which includes
+    numpy and awkward buffers. The maximum resident set size is that of the whole process so far.
+    """
+    func()
+
+    wall, cpu = [], []
+    for _ in range(repeats):
+        gc.collect()
+        t0, c0 = time.perf_counter(), time.process_time()
+        func()
+        wall.append(time.perf_counter() - t0)
+        cpu.append(time.process_time() - c0)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    wall_median = statistics.median(wall)
+    return {
+        "wall_min": min(wall),
+        "wall_median": wall_median,
+        "cpu_median": statistics.median(cpu),
+        "events_per_second": n_events / wall_median,
+        "peak_alloc_mb": peak / 1024 ** 2,
+        # ru_maxrss is given in kB on linux
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def prepare(target: str, inst: TaskArrayFunction, events: ak.Array, inst_dict: dict) -> Callable:
+    """
+    Returns a function without arguments that runs *inst* of the benchmark *target* on *events*.
+    """
+    if target != "aj_trighist":
+        events = complete_columns(events, inst.used_columns)
+        return lambda: inst(events)
+
+    # the histogram is filled from the bit-packed trigger decisions produced by trigger_prod
+    config_inst = inst_dict["config_inst"]
+    trigger_prod = build_inst("trigger_prod", inst_dict)
+    events = trigger_prod(complete_columns(events, trigger_prod.used_columns))
+    variable_insts = [config_inst.get_variable(name) for name in TRIGHIST_VARIABLES]
+    h = inst.run_create_hist(variable_insts, task=None)
+    weight = np.asarray(events.Mt1 > 0, dtype=np.float32)
+    # same structure as the fill data in CreateHistograms, with jagged category ids
+    data = {
+        "ht": np.asarray(ak.sum(events.Jet.pt, axis=1)),
+        "trig_bits": np.asarray(events.trig_mask),
+        "category": events.category_ids,
+        "process": np.full(len(events), inst_dict["dataset_inst"].processes.get_first().id, dtype=np.int32),
+        "shift": np.zeros(len(events), dtype=np.int32),
+        "weight": (weight, np.ones_like(weight)),
+    }
+    # the fill function modifies the data dictionary
+    return lambda: inst.run_fill_hist(h, dict(data), task=None)
+
+
+def git_info() -> dict:
+    base = os.getenv("AJ_BASE", os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+    def git(*args):
+        try:
+            return subprocess.check_output(["git", "-C", base, *args], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def run_benchmarks(
+    targets: list[str],
+    chunk_sizes: list[int],
+    multiplicities: list[str],
+    config: str = "2017_v9",
+    dataset: str = "tt_fh_powheg",
+    repeats: int = 3,
+    seed: int = 0,
+) -> dict:
+    """
+    Runs all benchmark *targets* for all *chunk_sizes* and *multiplicities* and returns the results
+    together with metadata as a json serializable dictionary. Failing targets are reported with
+    their error instead of aborting the remaining benchmarks.
+    """
+    from alljets.config.analysis_aj import analysis_aj
+
+    config_inst = analysis_aj.get_config(config)
+    inst_dict = {
+        "analysis_inst": analysis_aj,
+        "config_inst": config_inst,
+        "dataset_inst": config_inst.get_dataset(dataset),
+    }
+
+    # all configured triggers
+    triggers = set()
+    for key in ("trigger", "ref_trigger", "bkg_trigger"):
+        for names in config_inst.get_aux(key, {}).values():
+            triggers |= set(law.util.make_list(names))
+
+    category_ids = [category_inst.id for category_inst in config_inst.get_leaf_categories()]
+
+    results = []
+    for target in targets:
+        if target in SKIPPED_TARGETS:
+            logger.warning(f"skipping benchmark target {target}: {SKIPPED_TARGETS[target]}")
+            results.append({"target": target, "status": "skipped", "reason": SKIPPED_TARGETS[target]})
+            continue
+        try:
+            inst = build_inst(target, inst_dict)
+        except Exception as e:
+            logger.error(f"setup of benchmark target {target} failed: {e}")
+            results.append({"target": target, "status": "failed", "error": repr(e)})
+            continue
+
+        hlt = {
+            route.fields[1] for route in map(Route, inst.used_columns)
+            if route.fields[0] == "HLT" and len(route.fields) == 2 and "*" not in route.fields[1]
+        }
+        for multiplicity in multiplicities:
+            for chunk_size in chunk_sizes:
+                result = {
+                    "target": target,
+                    "multiplicity": multiplicity,
+                    "chunk_size": chunk_size,
+                    "repeats": repeats,
+                }
+                events = generate_events(
+                    chunk_size,
+                    multiplicity=multiplicity,
+                    btag_wp=config_inst.x.btag_working_points.deepjet.tight,
+                    triggers=sorted(triggers | hlt),
+                    category_ids=category_ids,
+                    seed=seed,
+                )
+                result["n_jets"] = int(ak.sum(ak.num(events.Jet, axis=1)))
+                try:
+                    result.update(measure(prepare(target, inst, events, inst_dict), chunk_size, repeats))
+                    result["status"] = "ok"
+                except Exception as e:
+                    logger.error(f"benchmark {target} ({multiplicity}, {chunk_size} events) failed: {e}")
+                    result.update({"status": "failed", "error": repr(e)})
+                results.append(result)
+                logger.info(
+                    f"{target:<16} {multiplicity:<14} {chunk_size:>8} events: " + (
+                        f"{result['wall_median']:.3f}s, {result['events_per_second']:.0f} ev/s, "
+                        f"{result['peak_alloc_mb']:.1f} MB peak"
+                        if result["status"] == "ok" else "failed"
+                    ),
+                )
+                del events
+
+    return {
+        "meta": {
+            **git_info(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "awkward": ak.__version__,
+            "config": config,
+            "dataset": dataset,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def compare(results: dict, reference: dict) -> None:
+    """
+    Prints the throughput of *results* relative to the *reference* results for all benchmarks that
+    succeeded in both.
+    """
+    def key(r):
+        return r["target"], r.get("multiplicity"), r.get("chunk_size")
+
+    ref = {key(r): r for r in reference["results"] if r.get("status") == "ok"}
+    print(f"throughput relative to {reference['meta'].get('commit')}:")
+    for r in results["results"]:
+        if r.get("status") != "ok" or key(r) not in ref:
+            continue
+        ratio = r["events_per_second"] / ref[key(r)]["events_per_second"]
+        print(f"  {r['target']:<16} {r['multiplicity']:<14} {r['chunk_size']:>8} events: {ratio:.2f}x")
+
+
+def main(args: list[str] | None = None) -> int:
+    def csv(value):
+        return [v for v in value.split(",") if v]
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--targets", type=csv, default=list(BENCHMARK_TARGETS), help="comma-separated targets")
+    parser.add_argument("--chunk-sizes", type=csv, default=["10000", "50000"], help="comma-separated chunk sizes")
+    parser.add_argument(
+        "--multiplicities",
+        type=csv,
+        default=["poisson:8", "uniform:6-14"],
+        help="comma-separated jet multiplicities, e.g. fixed:6, poisson:8 or uniform:6-14",
+    )
+    parser.add_argument("--config", default="2017_v9", help="name of the analysis config")
+    parser.add_argument("--dataset", default="tt_fh_powheg", help="name of the dataset, defines data/mc and tags")
+    parser.add_argument("--repeats", type=int, default=3, help="timed calls per benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the event generator")
+    parser.add_argument("--output", default="benchmark.json", help="json output file")
+    parser.add_argument("--compare", default=None, help="json output of an earlier run to compare against")
+    args = parser.parse_args(args)
+
+    results = run_benchmarks(
+        targets=args.targets,
+        chunk_sizes=[int(c) for c in args.chunk_sizes],
+        multiplicities=args.multiplicities,
+        config=args.config,
+        dataset=args.dataset,
+        repeats=args.repeats,
+        seed=args.seed,
+    )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"written benchmark results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    return int(any(r["status"] == "failed" for r in results["results"]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
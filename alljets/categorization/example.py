@@ -5,10 +5,21 @@ Exemplary selection methods.
 """
 
 from columnflow.categorization import Categorizer, categorizer
+from columnflow.columnar_util import has_ak_column
 from columnflow.util import maybe_import
 
+from alljets.production.jet_masks import get_jet_mask
+
+np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
+
+def _fit_skipped(events: ak.Array) -> ak.Array:
+    # events not fitted due to the fit preselection, none for outputs written before FitSkipped existed
+    if has_ak_column(events, "FitSkipped"):
+        return events.FitSkipped
+    return np.zeros(len(events), dtype=bool)
+
 #
 # categorizer functions used by categories definitions
 #
@@ -35,48 +46,36 @@ def cat_7j(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.
 @categorizer(uses={"Jet.pt", "Jet.btagDeepFlavB", "Jet.eta"})
 def cat_2btj(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # two or more b-jets
-    wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
-    return events, (ak.sum(
-        (events.Jet.pt >= 40.0) &
-        (abs(events.Jet.eta) < 2.4) &
-        (events.Jet.btagDeepFlavB >= wp_tight), axis=1) >= 2
-    )
+    bjet_mask = get_jet_mask(events, self.config_inst, "kinfit_jet", "tight_b")
+    return events, ak.sum(bjet_mask, axis=1) >= 2
 
 
 @categorizer(uses={"Jet.pt", "Jet.btagDeepFlavB", "Jet.eta"})
 def cat_1btj(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # one b-jet
-    wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
-    return events, (ak.sum(
-        (events.Jet.pt >= 40.0) &
-        abs(events.Jet.eta < 2.4) &
-        (events.Jet.btagDeepFlavB >= wp_tight), axis=1) == 1
-    )
+    bjet_mask = get_jet_mask(events, self.config_inst, "kinfit_jet", "tight_b")
+    return events, ak.sum(bjet_mask, axis=1) == 1
 
 
 @categorizer(uses={"Jet.pt", "Jet.btagDeepFlavB", "Jet.eta"})
 def cat_0btj(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # zero b-jets, rejection with very loose working point
-    wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
-    return events, (ak.sum((
-        events.Jet.pt >= 40.0) &
-        abs(events.Jet.eta < 2.4) &
-        (events.Jet.btagDeepFlavB >= wp_tight), axis=1) == 0
-    )
+    bjet_mask = get_jet_mask(events, self.config_inst, "kinfit_jet", "tight_b")
+    return events, ak.sum(bjet_mask, axis=1) == 0
 
 
-@categorizer(uses={"FitPgof","FitChi2"})
+@categorizer(uses={"FitPgof","FitChi2", "FitSkipped"})
 def cat_fit_conv_leq(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # kinematic fit has converged and is below pgof cut (bad events)
     pgofcut = self.config_inst.x.fitpgofcut
-    return events, (events.FitChi2 < 10000) & (events.FitPgof <= pgofcut)
+    return events, ~_fit_skipped(events) & (events.FitChi2 < 10000) & (events.FitPgof <= pgofcut)
 
 
-@categorizer(uses={"FitPgof","FitChi2"})
+@categorizer(uses={"FitPgof","FitChi2", "FitSkipped"})
 def cat_fit_conv_big(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # kinematic fit has converged and is above pgof cut (good events)
     pgofcut = self.config_inst.x.fitpgofcut
-    return events, (events.FitChi2 < 10000) & (events.FitPgof > pgofcut)
+    return events, ~_fit_skipped(events) & (events.FitChi2 < 10000) & (events.FitPgof > pgofcut)
 
 
 # @categorizer(uses={"FitChi2", "FitRbb"})
@@ -98,43 +97,34 @@ def cat_fit_nconv(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Arr
     return events, (events.FitChi2 >= 10000)
 
 
-@categorizer(uses={"FitChi2"})
+@categorizer(uses={"FitChi2", "FitSkipped"})
 def cat_fit_conv(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # kinematic fit has converged
-    return events, (events.FitChi2 < 10000)
+    return events, ~_fit_skipped(events) & (events.FitChi2 < 10000)
 
 
-@categorizer(uses={"Jet.pt", "Jet.btagDeepFlavB", "Jet.eta", "HLT.*", "FitChi2"})
+@categorizer(uses={"Jet.pt", "Jet.btagDeepFlavB", "Jet.eta", "HLT.*", "FitChi2", "FitSkipped"})
 def cat_2btj_sig(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # two or more b-jets
     chi2cut = self.config_inst.x.fitchi2cut
-    wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
     signal_trigger = self.config_inst.x.trigger["tt_fh"][0]
+    bjet_mask = get_jet_mask(events, self.config_inst, "kinfit_jet", "tight_b")
     return events, (events.HLT[signal_trigger] &
                     # (events.FitRbb > 2.0) &
-                    (events.FitChi2 <= chi2cut) &
-                    (ak.sum(
-                        (events.Jet.pt >= 40.0) &
-                        (abs(events.Jet.eta) < 2.4) &
-                        (events.Jet.btagDeepFlavB >= wp_tight), axis=1,
-                    ) >= 2))
+                    ~_fit_skipped(events) & (events.FitChi2 <= chi2cut) &
+                    (ak.sum(bjet_mask, axis=1) >= 2))
 
 
-@categorizer(uses={"Jet.pt", "Jet.btagDeepFlavB", "Jet.eta", "HLT.*", "FitChi2"})
+@categorizer(uses={"Jet.pt", "Jet.btagDeepFlavB", "Jet.eta", "HLT.*", "FitChi2", "FitSkipped"})
 def cat_0btj_bkg(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # zero b-jets, rejection with very loose working point
     chi2cut = self.config_inst.x.fitchi2cut
-    wp_loose = self.config_inst.x.btag_working_points.deepjet.loose
-    # wp_loose = 0.01
     bkg_trigger = self.config_inst.x.bkg_trigger["tt_fh"][0]
+    loose_bjet_mask = get_jet_mask(events, self.config_inst, "kinfit_jet", "loose_b")
     return events, (events.HLT[bkg_trigger] &
                     # (events.FitRbb > 2.0) &
-                    (events.FitChi2 <= chi2cut) &
-                    (ak.sum(
-                        (events.Jet.pt >= 40.0) &
-                        (abs(events.Jet.eta) < 2.4) &
-                        (events.Jet.btagDeepFlavB >= wp_loose), axis=1,
-                    ) == 0))
+                    ~_fit_skipped(events) & (events.FitChi2 <= chi2cut) &
+                    (ak.sum(loose_bjet_mask, axis=1) == 0))
 
 @categorizer(uses={"fitCombinationType"})
 def cat_fit_matched(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
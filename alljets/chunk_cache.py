@@ -0,0 +1,91 @@
+# coding: utf-8
+
+"""
+Chunk-scoped cache of values derived from events, shared by variable expressions.
+
+During histogramming, all variable expressions of a chunk are evaluated on the same events array.
+Values registered with :py:func:`cached` or :py:func:`cached_route` are computed once for the
+current chunk and reused by all other variables referring to them. The cache only holds values of
+a single events array and is cleared as soon as a different array is passed or the array is
+garbage collected.
+"""
+
+from __future__ import annotations
+
+import weakref
+from collections.abc import Callable, Hashable
+from typing import Any
+
+from columnflow.columnar_util import Route, has_ak_column
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class ChunkCache:
+    """
+    Cache of values derived from a single events array, keyed by arbitrary hashable keys.
+    """
+
+    def __init__(self):
+        self._ref = None
+        self._values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self) -> None:
+        self._ref = None
+        self._values.clear()
+
+    def _expire(self, ref: weakref.ref) -> None:
+        # called when a cached events array is garbage collected
+        if ref is self._ref:
+            self.clear()
+
+    def get(self, events: ak.Array, key: Hashable, func: Callable[[ak.Array], Any]) -> Any:
+        """
+        Returns the value *key* derived from *events*, computed with ``func(events)`` only once per
+        events array.
+        """
+        if self._ref is None or self._ref() is not events:
+            self.clear()
+            self._ref = weakref.ref(events, self._expire)
+        if key in self._values:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._values[key] = func(events)
+        return self._values[key]
+
+
+# process-wide cache used by all variable expressions
+chunk_cache = ChunkCache()
+
+
+def cached(key: Hashable, func: Callable[[ak.Array], Any], events: ak.Array) -> Any:
+    """
+    Returns ``func(events)``, cached under *key* for the current chunk.
+    """
+    return chunk_cache.get(events, key, func)
+
+
+def cached_route(expression: str, null_value: Any) -> Callable[[ak.Array], Any]:
+    """
+    Returns a variable expression function evaluating the string *expression* as a route, as done
+    for string expressions in ``cf.CreateHistograms``, but cached per chunk so that variables with
+    the same expression share the result. The function has an *inputs* attribute to be used as
+    ``inputs`` auxiliary entry of the variable.
+    """
+    route = Route(expression)
+
+    def apply(events):
+        if len(events) == 0 and not has_ak_column(events, route):
+            return np.array([], dtype=np.float32)
+        return route.apply(events, null_value=null_value)
+
+    def expr(events, *args, **kwargs):
+        return chunk_cache.get(events, ("route", expression, null_value), apply)
+
+    expr.inputs = [expression]
+    return expr
@@ -41,7 +41,44 @@ def patch_selector_steps_names():
     SelectorClassMixin.selector_steps_order_sensitive = True
 
 
+@memoize
+def patch_step_timing_summary():
+    from alljets.instrumentation import step_timer
+
+    # nothing to do when the step instrumentation is disabled
+    if not step_timer.enabled:
+        return
+
+    from columnflow.tasks.selection import SelectEvents
+    from columnflow.tasks.production import ProduceColumns
+    from columnflow.tasks.histograms import CreateHistograms
+
+    def patch_run(task_cls):
+        run = task_cls.run
+
+        def wrapped_run(self, *args, **kwargs):
+            step_timer.reset()
+            result = run(self, *args, **kwargs)
+
+            # write the summary of this branch next to the task outputs
+            if step_timer.chunks:
+                output = law.util.flatten(self.output())[0]
+                target = output.parent.child(f"step_timing_{self.branch}.json", type="f")
+                target.dump(step_timer.summary(), indent=4, formatter="json")
+                logger.info(f"written step timing summary to {target.uri()}")
+
+            return result
+
+        task_cls.run = wrapped_run
+
+    for task_cls in (SelectEvents, ProduceColumns, CreateHistograms):
+        patch_run(task_cls)
+
+    logger.debug("patched run of cf.SelectEvents, cf.ProduceColumns and cf.CreateHistograms")
+
+
 @memoize
 def patch_all():
     patch_bundle_repo_exclude_files()
     patch_selector_steps_names()
+    patch_step_timing_summary()
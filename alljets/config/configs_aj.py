@@ -597,6 +597,10 @@ def add_config(
     ################################################################################################
     cfg.x.fitchi2cut = 10
     cfg.x.fitpgofcut = 0.1
+    # events failing this expression are not fitted, get EMPTY_FLOAT fit outputs and FitSkipped set, see
+    # alljets.expressions for the syntax and kinFitMatch for the derived jet counts and categorizers, e.g.
+    # "(chi2 < 50) & (n_tight_b >= 2) & HLT.PFHT380_SixPFJet32_DoublePFBTagDeepCSV_2p2" or "cat_7j & cat_2btj"
+    cfg.x.kinfit_preselection = None
     cfg.x.trigger_sf_variable = "jet6_pt_5"
     ################################################################################################
     # shifts
@@ -823,6 +827,8 @@ def add_config(
                 "FitJet.*",
                 "FitChi2",
                 "FitPgof",
+                "FitSkipped",
+                "FitBackend",
                 "fitCombinationType",
                 "reco_combination_type",
                 "DeltaR",
@@ -866,7 +872,7 @@ def add_config(
                 "ht",
                 "Mt*",
                 "MW*",
-                "trig_bits",
+                "trig_mask",
             },
         },
     )
@@ -6,8 +6,10 @@ Definition of variables.
 from functools import partial
 
 import order as od
-from columnflow.columnar_util import (EMPTY_FLOAT, attach_coffea_behavior,
-                                      default_coffea_collections)
+from columnflow.columnar_util import EMPTY_FLOAT
+
+from alljets.chunk_cache import cached, cached_route
+from alljets.fourvector import FourVectors
 
 
 def add_variables(cfg: od.Config) -> None:
@@ -1209,12 +1211,22 @@ def add_variables(cfg: od.Config) -> None:
         binning=(4, -1.5, 2.5),
         x_title=r"Combination types: -1: NA 0: unmatched, 1: wrong, 2: correct",
     )
+    # bit-packed trigger decisions, see trigger_prod, expanded into one entry per set bit
     add_variable(
         cfg,
         name="trig_bits",
-        expression="trig_bits",
+        expression="trig_mask",
         binning=(4, -0.5, 3.5),
         x_title=r"trig bits",
+        aux={"bitmask_shift": 0},
+    )
+    add_variable(
+        cfg,
+        name="trig_bits_orth",
+        expression="trig_mask",
+        binning=(4, -0.5, 3.5),
+        x_title=r"trig bits (reference trigger)",
+        aux={"bitmask_shift": 32},
     )
     add_variable(
         cfg,
@@ -1235,25 +1247,7 @@ def add_variables(cfg: od.Config) -> None:
     )
 
     def build_w1jet(events, which=None):
-        events = attach_coffea_behavior(
-            events, {"FitW1": default_coffea_collections["Jet"]},
-        )
-        W1jets = events.FitW1
-        if which is None:
-            return W1jets * 1
-        if which == "mass":
-            return W1jets.mass
-        if which == "pt":
-            return W1jets.pt
-        if which == "eta":
-            return W1jets.eta
-        if which == "abs_eta":
-            return abs(W1jets.eta)
-        if which == "phi":
-            return W1jets.phi
-        if which == "energy":
-            return W1jets.energy
-        raise ValueError(f"Unknown which: {which}")
+        return p4_quantity(cached_p4(events, "FitW1"), which)
 
     build_w1jet.inputs = ["FitW1.{x,y,z,t}"]
 
@@ -1268,25 +1262,7 @@ def add_variables(cfg: od.Config) -> None:
     )
 
     def build_w1recojet(events, which=None):
-        events = attach_coffea_behavior(
-            events, {"RecoW1": default_coffea_collections["Jet"]},
-        )
-        W1recojets = events.RecoW1
-        if which is None:
-            return W1recojets * 1
-        if which == "mass":
-            return W1recojets.mass
-        if which == "pt":
-            return W1recojets.pt
-        if which == "eta":
-            return W1recojets.eta
-        if which == "abs_eta":
-            return abs(W1recojets.eta)
-        if which == "phi":
-            return W1recojets.phi
-        if which == "energy":
-            return W1recojets.energy
-        raise ValueError(f"Unknown which: {which}")
+        return p4_quantity(cached_p4(events, "RecoW1"), which)
 
     build_w1recojet.inputs = ["RecoW1.{x,y,z,t}"]
 
@@ -1301,25 +1277,7 @@ def add_variables(cfg: od.Config) -> None:
     )
 
     def build_w2recojet(events, which=None):
-        events = attach_coffea_behavior(
-            events, {"RecoW2": default_coffea_collections["Jet"]},
-        )
-        W2recojets = events.RecoW2
-        if which is None:
-            return W2recojets * 1
-        if which == "mass":
-            return W2recojets.mass
-        if which == "pt":
-            return W2recojets.pt
-        if which == "eta":
-            return W2recojets.eta
-        if which == "abs_eta":
-            return abs(W2recojets.eta)
-        if which == "phi":
-            return W2recojets.phi
-        if which == "energy":
-            return W2recojets.energy
-        raise ValueError(f"Unknown which: {which}")
+        return p4_quantity(cached_p4(events, "RecoW2"), which)
 
     build_w2recojet.inputs = ["RecoW2.{x,y,z,t}"]
 
@@ -1334,25 +1292,7 @@ def add_variables(cfg: od.Config) -> None:
     )
 
     def build_top1recojet(events, which=None):
-        events = attach_coffea_behavior(
-            events, {"RecoTop1": default_coffea_collections["Jet"]},
-        )
-        Top1recojets = events.RecoTop1
-        if which is None:
-            return Top1recojets * 1
-        if which == "mass":
-            return Top1recojets.mass
-        if which == "pt":
-            return Top1recojets.pt
-        if which == "eta":
-            return Top1recojets.eta
-        if which == "abs_eta":
-            return abs(Top1recojets.eta)
-        if which == "phi":
-            return Top1recojets.phi
-        if which == "energy":
-            return Top1recojets.energy
-        raise ValueError(f"Unknown which: {which}")
+        return p4_quantity(cached_p4(events, "RecoTop1"), which)
 
     build_top1recojet.inputs = ["RecoTop1.{x,y,z,t}"]
 
@@ -1367,25 +1307,7 @@ def add_variables(cfg: od.Config) -> None:
     )
 
     def build_top1jet(events, which=None):
-        events = attach_coffea_behavior(
-            events, {"FitTop1": default_coffea_collections["Jet"]},
-        )
-        Top1jets = events.FitTop1
-        if which is None:
-            return Top1jets * 1
-        if which == "mass":
-            return Top1jets.mass
-        if which == "pt":
-            return Top1jets.pt
-        if which == "eta":
-            return Top1jets.eta
-        if which == "abs_eta":
-            return abs(Top1jets.eta)
-        if which == "phi":
-            return Top1jets.phi
-        if which == "energy":
-            return Top1jets.energy
-        raise ValueError(f"Unknown which: {which}")
+        return p4_quantity(cached_p4(events, "FitTop1"), which)
 
     build_top1jet.inputs = ["FitTop1.{x,y,z,t}"]
 
@@ -1418,25 +1340,7 @@ def add_variables(cfg: od.Config) -> None:
     )
 
     def build_top2jet(events, which=None):
-        events = attach_coffea_behavior(
-            events, {"FitTop2": default_coffea_collections["Jet"]},
-        )
-        Top2jets = events.FitTop2
-        if which is None:
-            return Top2jets * 1
-        if which == "mass":
-            return Top2jets.mass
-        if which == "pt":
-            return Top2jets.pt
-        if which == "eta":
-            return Top2jets.eta
-        if which == "abs_eta":
-            return abs(Top2jets.eta)
-        if which == "phi":
-            return Top2jets.phi
-        if which == "energy":
-            return Top2jets.energy
-        raise ValueError(f"Unknown which: {which}")
+        return p4_quantity(cached_p4(events, "FitTop2"), which)
 
     build_top2jet.inputs = ["FitTop2.{x,y,z,t}"]
     add_variable(
@@ -1466,25 +1370,7 @@ def add_variables(cfg: od.Config) -> None:
     )
 
     def build_b1jet(events, which=None):
-        events = attach_coffea_behavior(
-            events, {"FitB1": default_coffea_collections["Jet"]},
-        )
-        B1jets = events.FitB1
-        if which is None:
-            return B1jets * 1
-        if which == "mass":
-            return B1jets.mass
-        if which == "pt":
-            return B1jets.pt
-        if which == "eta":
-            return B1jets.eta
-        if which == "abs_eta":
-            return abs(B1jets.eta)
-        if which == "phi":
-            return B1jets.phi
-        if which == "energy":
-            return B1jets.energy
-        raise ValueError(f"Unknown which: {which}")
+        return p4_quantity(cached_p4(events, "FitB1"), which)
 
     build_b1jet.inputs = ["FitB1.{pt,eta,phi,mass}"]
     add_variable(
@@ -1498,34 +1384,41 @@ def add_variables(cfg: od.Config) -> None:
     )
 
     def build_b2jet(events, which=None):
-        events = attach_coffea_behavior(
-            events, {"FitB2": default_coffea_collections["Jet"]},
-        )
-        B2jets = events.FitB2
-        if which is None:
-            return B2jets * 1
-        if which == "mass":
-            return B2jets.mass
-        if which == "pt":
-            return B2jets.pt
-        if which == "eta":
-            return B2jets.eta
-        if which == "abs_eta":
-            return abs(B2jets.eta)
-        if which == "phi":
-            return B2jets.phi
-        if which == "energy":
-            return B2jets.energy
-        raise ValueError(f"Unknown which: {which}")
+        return p4_quantity(cached_p4(events, "FitB2"), which)
 
-    build_b2jet.inputs = ["FitB2.{x,y,z,t}"]
+    build_b2jet.inputs = ["FitB2.{pt,eta,phi,mass}"]
 
 
+def cached_p4(events, column: str) -> FourVectors:
+    """
+    Returns the four-vectors in *column*, built once per chunk and shared by all variables.
+    """
+    return cached(("p4", column), lambda events: FourVectors.from_record(events[column]), events)
+
+
+def p4_quantity(p4: FourVectors, which: str | None = None):
+    """
+    Returns the quantity *which* of the four-vectors *p4*, or the vectors themselves when *None*.
+    """
+    if which is None:
+        return p4
+    if which == "abs_eta":
+        return abs(p4.eta)
+    if which in ("mass", "pt", "eta", "phi", "energy"):
+        return getattr(p4, which)
+    raise ValueError(f"Unknown which: {which}")
+
 
 # helper to add a variable to the config with some defaults
 def add_variable(config: od.Config, *args, **kwargs) -> od.Variable:
     kwargs.setdefault("null_value", EMPTY_FLOAT)
 
+    # evaluate string expressions with indexing once per chunk, shared by all variables using them
+    expression = kwargs.get("expression")
+    if isinstance(expression, str) and "[" in expression:
+        kwargs["expression"] = cached_route(expression, kwargs["null_value"])
+        kwargs["aux"] = {"inputs": kwargs["expression"].inputs, **kwargs.get("aux", {})}
+
     # create the variable
     variable = config.add_variable(*args, **kwargs)
 
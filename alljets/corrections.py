@@ -0,0 +1,162 @@
+# coding: utf-8
+
+"""
+Cached loading and fast evaluation of correctionlib corrections.
+
+Correction sets are parsed once per process and cached by the path, modification time and size of
+their file, so that tasks running several branches in the same process (or re-running the setup of
+a producer) neither read nor parse the same json again. Files are only read on a cache miss, and
+files with identical content share one parsed correction set. Corrections whose content is a single TFormula, such
+as the fitted trigger scale factors, are translated into vectorized numpy expressions, validated
+against correctionlib and evaluated without calling into correctionlib per event.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+from collections.abc import Callable
+
+import law
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+correctionlib = maybe_import("correctionlib")
+
+logger = law.logger.get_logger(__name__)
+
+
+# parsed correction sets keyed by content hash, and content hashes keyed by path, mtime and size
+_correction_sets: dict[str, tuple[correctionlib.CorrectionSet, dict]] = {}
+_correction_set_hashes: dict[tuple[str, float, int], str] = {}
+
+# tokens of TFormula expressions that can be translated to numpy
+_formula_token = re.compile(
+    r"\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|(?P<param>\[\d+\])|(?P<name>[A-Za-z_][\w:]*)"
+    r"|(?P<op>[-+*/(),^]))",
+)
+_formula_functions = {
+    "exp": "np.exp",
+    "TMath::Exp": "np.exp",
+    "log": "np.log",
+    "TMath::Log": "np.log",
+    "sqrt": "np.sqrt",
+    "TMath::Sqrt": "np.sqrt",
+    "abs": "np.abs",
+    "TMath::Abs": "np.abs",
+    "pow": "np.power",
+    "TMath::Power": "np.power",
+}
+# names of the TFormula variables in order
+_formula_variables = ("x", "y", "z", "t")
+
+# points at which translated formulas are compared to correctionlib
+VALIDATION_POINTS = np.linspace(0.0, 3000.0, 301)
+
+
+def load_correction_set(target: law.FileSystemFileTarget) -> tuple[correctionlib.CorrectionSet, dict]:
+    """
+    Loads the gzipped correction set json in *target* and returns the parsed correction set and its
+    json content, using a process-wide cache keyed by the path, modification time and size of the
+    file. The file is only read and hashed on a cache miss.
+    """
+    stat = target.stat()
+    key = (target.path, stat.st_mtime, stat.st_size)
+    if key not in _correction_set_hashes:
+        content = target.load(formatter="gzip")
+        digest = hashlib.sha256(content).hexdigest()
+        if digest not in _correction_sets:
+            text = content.decode("utf-8")
+            _correction_sets[digest] = (correctionlib.CorrectionSet.from_string(text), json.loads(text))
+        _correction_set_hashes[key] = digest
+    return _correction_sets[_correction_set_hashes[key]]
+
+
+def compile_formula(expression: str, parameters: list[float] | None = None) -> Callable:
+    """
+    Translates the TFormula *expression* with optional *parameters* into a numpy function of up to
+    four arrays (x, y, z, t). Raises a *ValueError* for expressions containing unsupported tokens.
+    """
+    parts = []
+    pos = 0
+    # unary signs bind tighter than ^ in TFormula, so they are put into parentheses together with
+    # their operand, closed once the parenthesis depth at which they started is reached again
+    depth = 0
+    unary_depths = []
+    expression = expression.strip()
+    while pos < len(expression):
+        m = _formula_token.match(expression, pos)
+        if not m:
+            raise ValueError(f"unsupported token in formula '{expression}' at position {pos}")
+        pos = m.end()
+        op = m.group("op")
+        operand_end = False
+        if m.group("number"):
+            parts.append(m.group("number"))
+            operand_end = True
+        elif m.group("param"):
+            parts.append(repr(float((parameters or [])[int(m.group("param")[1:-1])])))
+            operand_end = True
+        elif m.group("name") in _formula_variables:
+            parts.append(m.group("name"))
+            operand_end = True
+        elif m.group("name") in _formula_functions:
+            parts.append(_formula_functions[m.group("name")])
+        elif op in ("+", "-") and (not parts or parts[-1] in ("+", "-", "*", "/", "(", ",", "**", "(+", "(-")):
+            parts.append(f"({op}")
+            unary_depths.append(depth)
+        elif op:
+            parts.append("**" if op == "^" else op)
+            depth += (op == "(") - (op == ")")
+            operand_end = op == ")"
+        else:
+            raise ValueError(f"unsupported name '{m.group('name')}' in formula '{expression}'")
+        while operand_end and unary_depths and unary_depths[-1] == depth:
+            parts.append(")")
+            unary_depths.pop()
+
+    # all tokens are checked above, so the translated expression only contains numbers, variables,
+    # operators and numpy functions
+    code = f"lambda x=None, y=None, z=None, t=None: {' '.join(parts)}"
+    return eval(compile(code, "<formula>", "eval"), {"np": np, "__builtins__": {}})
+
+
+class CorrectionEvaluator:
+    """
+    Evaluates the correction *name* of a correction set loaded with :py:func:`load_correction_set`.
+    If its content is a TFormula that can be translated with :py:func:`compile_formula` and agrees
+    with correctionlib at the :py:data:`VALIDATION_POINTS`, it is evaluated with numpy, otherwise
+    with correctionlib.
+    """
+
+    def __init__(self, correction_set: correctionlib.CorrectionSet, content: dict, name: str):
+        self.name = name
+        self.correction = correction_set[name]
+        self.formula = None
+
+        data = next(c for c in content["corrections"] if c["name"] == name)["data"]
+        if isinstance(data, dict) and data.get("nodetype") == "formula" and data.get("parser") == "TFormula":
+            try:
+                self.formula = compile_formula(data["expression"], data.get("parameters"))
+            except (ValueError, IndexError, SyntaxError) as e:
+                logger.warning(f"falling back to correctionlib for correction {name}: {e}")
+            else:
+                if not self.validate(*(VALIDATION_POINTS for _ in data["variables"])):
+                    logger.warning(f"numpy evaluation of correction {name} disagrees with correctionlib")
+                    self.formula = None
+
+    def validate(self, *values: np.ndarray) -> bool:
+        """
+        Returns whether the numpy and correctionlib evaluation of the correction agree for *values*.
+        """
+        with np.errstate(all="ignore"):
+            return np.allclose(self.formula(*values), self.correction.evaluate(*values), rtol=1e-6, equal_nan=True)
+
+    def __call__(self, *values: np.ndarray) -> np.ndarray:
+        values = tuple(np.asarray(v, dtype=np.float64) for v in values)
+        if self.formula is None:
+            return self.correction.evaluate(*values)
+        with np.errstate(over="ignore"):
+            return self.formula(*values)
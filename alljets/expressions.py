@@ -0,0 +1,132 @@
+# coding: utf-8
+
+"""
+Event masks from string expressions of columns.
+
+Expressions use python syntax with column routes as names, e.g.
+
+.. code-block:: python
+
+    "(chi2 < 50) & (n_tight_b >= 2) & HLT.PFHT380_SixPFJet32_DoublePFBTagDeepCSV_2p2"
+
+Allowed are numbers, booleans, names and attribute chains referring to columns or to derived
+quantities provided at evaluation, comparisons, the arithmetic operators ``+ - * /`` and the
+element-wise logical operators ``& | ~``. Anything else, such as function calls or subscripts, is
+rejected when the expression is compiled.
+"""
+
+from __future__ import annotations
+
+import ast
+import functools
+import operator
+from collections.abc import Callable, Iterable
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+_binary_ops = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+}
+_unary_ops = {
+    ast.Invert: operator.invert,
+    ast.USub: operator.neg,
+}
+_compare_ops = {
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+}
+
+
+def _route(node: ast.AST) -> str | None:
+    # dotted route of a name or attribute chain, or None for other nodes
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        parent = _route(node.value)
+        return None if parent is None else f"{parent}.{node.attr}"
+    return None
+
+
+class MaskExpression:
+    """
+    Compiled mask *expression*. Names in *derived* refer to quantities that are passed as callables
+    at evaluation, all other names and attribute chains are column routes, which are listed in
+    :py:attr:`routes`, e.g. to be added to the ``uses`` of a producer.
+    """
+
+    def __init__(self, expression: str, derived: Iterable[str] = ()):
+        self.expression = expression
+        self.derived = set(derived)
+        self.routes = set()
+        try:
+            self._tree = ast.parse(expression.strip(), mode="eval").body
+        except SyntaxError as e:
+            raise ValueError(f"invalid mask expression '{expression}': {e}") from e
+        self._check(self._tree)
+
+    def _check(self, node: ast.AST) -> None:
+        route = _route(node)
+        if route is not None:
+            if route not in self.derived:
+                self.routes.add(route)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (bool, int, float)):
+            pass
+        elif isinstance(node, ast.BinOp) and type(node.op) in _binary_ops:
+            self._check(node.left)
+            self._check(node.right)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in _unary_ops:
+            self._check(node.operand)
+        elif isinstance(node, ast.Compare) and all(type(op) in _compare_ops for op in node.ops):
+            for child in [node.left] + node.comparators:
+                self._check(child)
+        else:
+            raise ValueError(f"unsupported element '{ast.dump(node)}' in mask expression '{self.expression}'")
+
+    def _evaluate(self, node: ast.AST, events: ak.Array, derived: dict[str, Callable]):
+        route = _route(node)
+        if route is not None:
+            if route in self.derived:
+                return derived[route]()
+            return functools.reduce(lambda array, field: array[field], route.split("."), events)
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.BinOp):
+            return _binary_ops[type(node.op)](
+                self._evaluate(node.left, events, derived),
+                self._evaluate(node.right, events, derived),
+            )
+        if isinstance(node, ast.UnaryOp):
+            return _unary_ops[type(node.op)](self._evaluate(node.operand, events, derived))
+
+        # chained comparisons as in python, i.e., a < b < c is (a < b) & (b < c)
+        left = self._evaluate(node.left, events, derived)
+        result = True
+        for op, comparator in zip(node.ops, node.comparators):
+            right = self._evaluate(comparator, events, derived)
+            result = result & _compare_ops[type(op)](left, right)
+            left = right
+        return result
+
+    def __call__(self, events: ak.Array, derived: dict[str, Callable] | None = None) -> np.ndarray:
+        """
+        Evaluates the expression for *events* and returns a boolean numpy mask. *derived* maps the
+        names of derived quantities to functions computing them, which are only called when used.
+        """
+        missing = self.derived - set(derived or {})
+        if missing:
+            raise ValueError(f"no values given for derived quantities {', '.join(sorted(missing))}")
+        mask = self._evaluate(self._tree, events, derived or {})
+        return np.broadcast_to(np.asarray(mask, dtype=bool), (len(events),)).copy()
@@ -0,0 +1,154 @@
+# coding: utf-8
+
+"""
+Struct-of-arrays four-vectors for fit and reconstruction objects.
+
+:py:class:`FourVectors` holds float32 px, py, pz and e components as plain numpy arrays of equal
+shape, e.g. ``(n_events,)`` for one object per event or ``(n_events, 6)`` for the fitted jets.
+Arithmetic works directly on these buffers without attaching coffea behaviors or zipping records,
+and derived quantities such as the mass and pt are computed once per object and cached. Columns
+are read with :py:meth:`FourVectors.from_record` and written back with
+:py:meth:`FourVectors.to_record`, e.g.
+
+.. code-block:: python
+
+    jets = FourVectors.from_record(events.FitJet, n=6)
+    w1 = jets[:, 2] + jets[:, 3]
+    events = set_ak_column(events, "FitW1", w1.to_record())
+"""
+
+from __future__ import annotations
+
+import functools
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class FourVectors:
+    """
+    Four-vectors with float32 components *px*, *py*, *pz* and *e* of equal shape. Masses follow the
+    convention of the coffea vector behaviors, i.e., they are negative for space-like vectors.
+    """
+
+    def __init__(self, px: np.ndarray, py: np.ndarray, pz: np.ndarray, e: np.ndarray):
+        self.px = np.asarray(px, dtype=np.float32)
+        self.py = np.asarray(py, dtype=np.float32)
+        self.pz = np.asarray(pz, dtype=np.float32)
+        self.e = np.asarray(e, dtype=np.float32)
+
+    @classmethod
+    def from_ptetaphim(
+        cls,
+        pt: np.ndarray,
+        eta: np.ndarray,
+        phi: np.ndarray,
+        mass: np.ndarray,
+    ) -> FourVectors:
+        pt, eta, phi, mass = (np.asarray(v, dtype=np.float32) for v in (pt, eta, phi, mass))
+        px, py, pz = pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+        p4 = cls(px, py, pz, np.sqrt(px ** 2 + py ** 2 + pz ** 2 + mass ** 2))
+        # the inputs are exact, prefill the cache
+        p4.__dict__.update(pt=pt, eta=eta, phi=phi)
+        return p4
+
+    @classmethod
+    def from_record(cls, array: ak.Array, n: int | None = None) -> FourVectors:
+        """
+        Reads the flat buffers of the fields ``x``, ``y``, ``z`` and ``t`` or, if not present,
+        ``pt``, ``eta``, ``phi`` and ``mass`` of *array*. Arrays with one object per event result in
+        vectors of shape ``(n_events,)``, jagged arrays with *n* objects per event in vectors of
+        shape ``(n_events, n)``, and flat vectors of all objects when *n* is *None*.
+        """
+        def values(field):
+            flat = np.asarray(ak.flatten(array[field], axis=None) if array.ndim > 1 else array[field])
+            if array.ndim > 1 and n is not None:
+                if len(flat) != len(array) * n:
+                    raise ValueError(f"expected {n} objects per event, got {len(flat)} for {len(array)} events")
+                flat = flat.reshape(-1, n)
+            return flat
+
+        if "x" in array.fields:
+            return cls(*(values(field) for field in "xyzt"))
+        return cls.from_ptetaphim(*(values(field) for field in ("pt", "eta", "phi", "mass")))
+
+    def to_record(self) -> ak.Array:
+        """
+        Returns the vectors as records with fields ``x``, ``y``, ``z`` and ``t``, as written by the
+        coffea vector behaviors.
+        """
+        return ak.zip({"x": self.px, "y": self.py, "z": self.pz, "t": self.e})
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.px.shape
+
+    def __len__(self) -> int:
+        return len(self.px)
+
+    def __getitem__(self, index) -> FourVectors:
+        return FourVectors(self.px[index], self.py[index], self.pz[index], self.e[index])
+
+    def __add__(self, other: FourVectors) -> FourVectors:
+        return FourVectors(self.px + other.px, self.py + other.py, self.pz + other.pz, self.e + other.e)
+
+    def sum(self, axis: int = -1) -> FourVectors:
+        return FourVectors(*(v.sum(axis=axis) for v in (self.px, self.py, self.pz, self.e)))
+
+    @property
+    def energy(self) -> np.ndarray:
+        return self.e
+
+    @functools.cached_property
+    def pt(self) -> np.ndarray:
+        return np.hypot(self.px, self.py)
+
+    @functools.cached_property
+    def p(self) -> np.ndarray:
+        return np.sqrt(self.pt ** 2 + self.pz ** 2)
+
+    @functools.cached_property
+    def mass2(self) -> np.ndarray:
+        return (self.e - self.p) * (self.e + self.p)
+
+    @functools.cached_property
+    def mass(self) -> np.ndarray:
+        return np.copysign(np.sqrt(np.abs(self.mass2)), self.mass2)
+
+    @functools.cached_property
+    def eta(self) -> np.ndarray:
+        return np.arcsinh(np.divide(self.pz, self.pt, out=np.zeros_like(self.pz), where=self.pt != 0))
+
+    @functools.cached_property
+    def phi(self) -> np.ndarray:
+        return np.arctan2(self.py, self.px)
+
+    def delta_r(self, other: FourVectors) -> np.ndarray:
+        dphi = (self.phi - other.phi + np.pi) % (2 * np.pi) - np.pi
+        return np.sqrt((self.eta - other.eta) ** 2 + dphi ** 2)
+
+    @property
+    def boost_vector(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Velocity (px, py, pz) / e of the vectors, e.g. to boost other vectors into their rest frame
+        with ``other.boost(*(-b for b in self.boost_vector))``.
+        """
+        return self.px / self.e, self.py / self.e, self.pz / self.e
+
+    def boost(self, bx: np.ndarray, by: np.ndarray, bz: np.ndarray) -> FourVectors:
+        """
+        Returns the vectors boosted by the velocity (*bx*, *by*, *bz*).
+        """
+        b2 = bx ** 2 + by ** 2 + bz ** 2
+        gamma = 1 / np.sqrt(1 - b2)
+        bp = bx * self.px + by * self.py + bz * self.pz
+        gamma2 = np.divide(gamma - 1, b2, out=np.zeros_like(b2), where=b2 > 0)
+        f = gamma2 * bp + gamma * self.e
+        return FourVectors(
+            self.px + f * bx,
+            self.py + f * by,
+            self.pz + f * bz,
+            gamma * (self.e + bp),
+        )
@@ -17,12 +17,17 @@ from columnflow.types import Any
 from columnflow.columnar_util import flat_np_view
 from columnflow.histogramming.default import cf_default
 
+from alljets.util import broadcast_flat, expand_bitmask
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 hist = maybe_import("hist")
 
 
-@hist_producer()
+@hist_producer(
+    # maximum number of entries per weight category filled at once, read from the law config when None
+    fill_batch_size=None,
+)
 def aj_trighist(self: HistProducer, events: ak.Array, **kwargs) -> ak.Array:
     return events, ak.Array(np.ones(len(events), dtype=np.float32))
 
@@ -82,34 +87,74 @@ def aj_trighist_fill_hist(self: HistProducer, h: hist.Histogram, data: dict[str,
             data[ax.name] = ak.copy(data[ax.name])
             flat_np_view(data[ax.name])[right_egde_mask] -= ax.widths[-1] * 1e-5
 
-    # check if conversion to records is needed
+    # expand bit-packed columns (see trigger_prod) into one entry per set bit, repeating all other
+    # per-event values, which avoids building jagged arrays and their cartesian product
     arr_types = (ak.Array, np.ndarray)
-    vals = list(data.values())
-    convert = (
-        # values is a mixture of singular and array types
-        (any(isinstance(v, arr_types) for v in vals) and not all(isinstance(v, arr_types) for v in vals)) or
-        # values contain at least one array with more than one dimension
-        any(isinstance(v, arr_types) and v.ndim != 1 for v in vals)
-    )
+    bitmask_axes = [
+        name for name in axis_names
+        if self.config_inst.has_variable(name) and self.config_inst.get_variable(name).has_aux("bitmask_shift")
+    ]
+    if len(bitmask_axes) > 1:
+        raise ValueError(f"cannot fill more than one bit-packed axis at once, got {bitmask_axes}")
+    if bitmask_axes:
+        name = bitmask_axes[0]
+        rows, bits = expand_bitmask(data[name], shift=self.config_inst.get_variable(name).x.bitmask_shift)
+
+        def take(value):
+            # jagged values such as the category ids stay jagged and are flattened below
+            if isinstance(value, ak.Array) and value.ndim > 1:
+                return value[rows]
+            return np.asarray(value)[rows]
+
+        data = {
+            key: (
+                bits if key == name else
+                [take(w) for w in value] if key == "weight" else
+                take(value) if isinstance(value, arr_types) else
+                value
+            )
+            for key, value in data.items()
+        }
 
-    # actual conversion
-    if convert:
-        data2 = data.copy()
-        data["weightcategory"] = 0
-        data2["weightcategory"] = 1
-        weights = data["weight"]
-        data["weight"] = weights[0]
-        data2["weight"] = weights[1]
+    # the weight producer returns the weighted and unweighted weights, which are broadcast together
+    # with all other values and filled into the weight categories 0 and 1 within the same fill call
+    weights = data.pop("weight")
+    data.pop("weightcategory", None)
+    data = {**data, "weight": weights[0], "weight_unweighted": weights[1]}
+
+    # flatten jagged values, repeating per-event values via offsets instead of building cartesian
+    # records, only jagged values with different structures still require the cartesian product
+    try:
+        data = broadcast_flat(data)
+    except ValueError:
         arrays = ak.flatten(ak.cartesian(data))
-        arrays2 = ak.flatten(ak.cartesian(data2))
-        data = {field: arrays[field] for field in arrays.fields}
-        data2 = {field: arrays2[field] for field in arrays2.fields}
+        data = {field: np.asarray(arrays[field]) for field in arrays.fields}
         del arrays
-        del arrays2
 
-    names = [ax.name for ax in h.axes if ax.__class__.__name__ not in ("StrCategory", "IntCategory")]
-    h.fill(**data, sample=data[names[0]])
-    h.fill(**data2, sample=data2[names[0]])
+    # the sample of the mean storage is the first non-categorical axis
+    sample_name = [ax.name for ax in h.axes if ax.__class__.__name__ not in ("StrCategory", "IntCategory")][0]
+
+    # fill in sub-batches to bound the memory of the values duplicated for both weight categories
+    if self.fill_batch_size is None:
+        self.fill_batch_size = law.config.get_expanded_int("analysis", "hist_fill_batch_size", 1000000)
+    n = max((len(value) for value in data.values() if isinstance(value, np.ndarray)), default=1)
+    for start in range(0, n, self.fill_batch_size):
+        stop = min(start + self.fill_batch_size, n)
+
+        def batch(value):
+            if isinstance(value, np.ndarray):
+                return value[start:stop]
+            return np.full(stop - start, value)
+
+        fill_kwargs = {
+            key: np.concatenate([batch(value)] * 2) if isinstance(value, np.ndarray) else value
+            for key, value in data.items()
+            if key not in ("weight", "weight_unweighted")
+        }
+        fill_kwargs["weightcategory"] = np.repeat(np.array([0, 1]), stop - start)
+        fill_kwargs["weight"] = np.concatenate([batch(data["weight"]), batch(data["weight_unweighted"])])
+        sample = fill_kwargs[sample_name]
+        h.fill(**fill_kwargs, sample=sample if isinstance(sample, np.ndarray) else np.full(2 * (stop - start), sample))
 
 
 @aj_trighist.post_process_hist
@@ -0,0 +1,247 @@
+# coding: utf-8
+
+"""
+Memory-mappable on-disk format for histograms.
+
+A histogram is stored as a directory containing the raw bin contents of its view including flow
+bins in ``bins.npy`` and the axis and storage metadata in ``meta.json``. :py:func:`load_hist`
+memory-maps the bins and returns a :py:class:`LazyHist`, from which selections of categorical axes
+(e.g. category, process, shift and weightcategory) are read as regular ``hist.Hist`` objects. Only
+the bytes of the selected bins are read from disk.
+
+Existing pickled histograms can be converted with
+
+.. code-block:: bash
+
+    python -m alljets.histogramming.hist_store hists.pickle hists.hstore
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import sys
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+hist = maybe_import("hist")
+
+
+# version of the on-disk format
+STORE_VERSION = 1
+
+# storage types that can be stored
+STORAGES = ("Double", "Int64", "Weight", "Mean", "WeightedMean")
+
+
+def _axis_meta(ax) -> dict:
+    traits = ax.traits
+    meta = {
+        "name": ax.name,
+        # label defaults to the name when unset, store the raw metadata to rebuild identical axes
+        "label": ax.__dict__.get("label", ""),
+        "underflow": traits.underflow,
+        "overflow": traits.overflow,
+        "growth": traits.growth,
+    }
+    if isinstance(ax, hist.axis.Regular):
+        if getattr(ax, "transform", None) is not None:
+            raise TypeError(f"transformed regular axis '{ax.name}' not supported")
+        meta.update(type="Regular", bins=ax.size, start=float(ax.edges[0]), stop=float(ax.edges[-1]))
+        meta["circular"] = traits.circular
+    elif isinstance(ax, hist.axis.Integer):
+        meta.update(type="Integer", start=int(ax.edges[0]), stop=int(ax.edges[-1]))
+    elif isinstance(ax, hist.axis.Variable):
+        meta.update(type="Variable", edges=[float(e) for e in ax.edges])
+    elif isinstance(ax, hist.axis.IntCategory):
+        meta.update(type="IntCategory", categories=[int(c) for c in ax])
+    elif isinstance(ax, hist.axis.StrCategory):
+        meta.update(type="StrCategory", categories=[str(c) for c in ax])
+    else:
+        raise TypeError(f"unsupported axis type {type(ax).__name__} of axis '{ax.name}'")
+    return meta
+
+
+def _build_axis(meta: dict, categories: list | None = None):
+    kwargs = {"name": meta["name"], "label": meta["label"]}
+    if meta["type"] == "Regular":
+        return hist.axis.Regular(
+            meta["bins"], meta["start"], meta["stop"], underflow=meta["underflow"], overflow=meta["overflow"],
+            growth=meta["growth"], circular=meta["circular"], **kwargs,
+        )
+    if meta["type"] == "Integer":
+        return hist.axis.Integer(
+            meta["start"], meta["stop"], underflow=meta["underflow"], overflow=meta["overflow"],
+            growth=meta["growth"], **kwargs,
+        )
+    if meta["type"] == "Variable":
+        return hist.axis.Variable(
+            meta["edges"], underflow=meta["underflow"], overflow=meta["overflow"], growth=meta["growth"],
+            **kwargs,
+        )
+    cls = hist.axis.IntCategory if meta["type"] == "IntCategory" else hist.axis.StrCategory
+    # category axes have an overflow bin unless they are growing, set it explicitly otherwise
+    if meta["overflow"] == meta["growth"]:
+        kwargs["overflow"] = meta["overflow"]
+    return cls(meta["categories"] if categories is None else categories, growth=meta["growth"], **kwargs)
+
+
+def save_hist(h: hist.Hist, path: str) -> None:
+    """
+    Stores the histogram *h* in the directory *path*, see :py:mod:`alljets.histogramming.hist_store`.
+    """
+    storage = h.storage_type.__name__
+    if storage not in STORAGES:
+        raise TypeError(f"unsupported storage type {storage}")
+
+    # write into a temporary directory first so that concurrent readers never see partial stores
+    tmp_path = f"{path.rstrip(os.sep)}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, "bins.npy"), np.asarray(h.view(flow=True)), allow_pickle=False)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": STORE_VERSION,
+                "storage": storage,
+                "axes": [_axis_meta(ax) for ax in h.axes],
+            },
+            f,
+            indent=1,
+        )
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def _category_index(categories: list, value, axis_name: str) -> int:
+    # position of a selected category, given as in hist.Hist by hist.loc or string value or by index
+    if isinstance(value, str) or hasattr(value, "value"):
+        loc = getattr(value, "value", value)
+        if loc not in categories:
+            raise KeyError(f"category {loc!r} not found on axis '{axis_name}'")
+        index = categories.index(loc) + getattr(value, "offset", 0)
+    elif isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+        index = int(value) + (len(categories) if value < 0 else 0)
+    else:
+        raise TypeError(f"cannot select {value!r} on category axis '{axis_name}'")
+    if not 0 <= index < len(categories):
+        raise IndexError(f"index {value!r} out of range for axis '{axis_name}' with {len(categories)} bins")
+    return index
+
+
+class LazyHist:
+    """
+    Histogram stored with :py:func:`save_hist`, whose bins are memory-mapped and only read when
+    selected. Selections follow the dictionary syntax of ``hist.Hist``:
+
+    .. code-block:: python
+
+        h = load_hist("hists.hstore")
+        # all shifts of a single process and category, reading only their bins
+        h_sel = h[{"process": "tt_fh", "category": ["incl", "6j"], "shift": hist.loc("nominal")}]
+        # same, summed over the selected categories
+        h_sel = h[{"process": "tt_fh", "category": ["incl", "6j"]}][{"category": sum}]
+
+    Keys are names of categorical axes, values are single categories, which remove the axis, or
+    lists of categories, which keep it. As in ``hist.Hist``, categories are given by value as strings
+    or wrapped into ``hist.loc``, while bare integers are bin indices, so that integer categories
+    must be selected with ``hist.loc``. The result is a regular ``hist.Hist`` with all non-selected
+    axes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != STORE_VERSION:
+            raise ValueError(f"unsupported histogram store version {meta['version']} in {path}")
+        self.storage = meta["storage"]
+        self.axes_meta = meta["axes"]
+        self.bins = np.load(os.path.join(path, "bins.npy"), mmap_mode="r")
+
+    @property
+    def axis_names(self) -> list[str]:
+        return [meta["name"] for meta in self.axes_meta]
+
+    def categories(self, name: str) -> list:
+        """
+        Returns the categories of the categorical axis *name*.
+        """
+        meta = self.axes_meta[self.axis_names.index(name)]
+        if "categories" not in meta:
+            raise ValueError(f"axis '{name}' is not categorical")
+        return list(meta["categories"])
+
+    def __getitem__(self, selection: dict) -> hist.Hist:
+        unknown = set(selection) - set(self.axis_names)
+        if unknown:
+            raise KeyError(f"unknown axes {', '.join(sorted(unknown))}")
+
+        # positions of the selected categories per axis, reading the bins axis by axis so that the
+        # first selection of the memory map only touches the selected blocks
+        arr = self.bins
+        axes = []
+        axis = 0
+        for meta in self.axes_meta:
+            if meta["name"] not in selection:
+                axes.append(_build_axis(meta))
+                axis += 1
+                continue
+
+            categories = self.categories(meta["name"])
+            value = selection[meta["name"]]
+            single = not isinstance(value, (list, tuple))
+            index = [
+                _category_index(categories, v, meta["name"])
+                for v in ([value] if single else value)
+            ]
+            values = [categories[i] for i in index]
+
+            if single:
+                arr = np.take(arr, index[0], axis=axis)
+            else:
+                arr = np.take(arr, index, axis=axis)
+                axes.append(_build_axis(meta, categories=values))
+                # keep the (empty) overflow bin of non-growing category axes
+                if meta["overflow"] and not meta["growth"]:
+                    pad = [(0, 0)] * arr.ndim
+                    pad[axis] = (0, 1)
+                    arr = np.pad(arr, pad)
+                axis += 1
+
+        h = hist.Hist(*axes, storage=getattr(hist.storage, self.storage)())
+        h.view(flow=True)[...] = arr
+        return h
+
+    def to_hist(self) -> hist.Hist:
+        """
+        Reads the full histogram.
+        """
+        return self[{}]
+
+
+def load_hist(path: str) -> LazyHist:
+    """
+    Memory-maps the histogram stored in the directory *path* and returns a :py:class:`LazyHist`.
+    """
+    return LazyHist(path)
+
+
+def is_hist_store(path: str) -> bool:
+    """
+    Returns whether *path* is a directory written by :py:func:`save_hist`.
+    """
+    return os.path.isfile(os.path.join(path, "meta.json")) and os.path.isfile(os.path.join(path, "bins.npy"))
+
+
+if __name__ == "__main__":
+    import pickle
+
+    if len(sys.argv) != 3:
+        print("usage: python -m alljets.histogramming.hist_store INPUT.pickle OUTPUT_DIR", file=sys.stderr)
+        sys.exit(1)
+
+    with open(sys.argv[1], "rb") as f:
+        save_hist(pickle.load(f), sys.argv[2])
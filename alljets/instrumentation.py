@@ -0,0 +1,129 @@
+# coding: utf-8
+
+"""
+Lightweight instrumentation of named steps inside selectors and producers.
+
+Steps are timed with the :py:func:`step` context manager, or the :py:func:`timed` decorator for
+whole array functions, e.g.
+
+.. code-block:: python
+
+    @selector(...)
+    @timed("jet_selection")
+    def jet_selection(self, events, **kwargs):
+        ...
+        with step("jet_selection.chi2"):
+            mt_result = reco(bjets, ljets)
+
+For each step, the number of calls, wall time, CPU time and the growth of the peak resident set
+size of the process are recorded. The outermost step of a call defines a chunk, so that all nested
+steps are also reported per chunk. Recording is disabled unless the ``step_timing`` option in the
+``[analysis]`` section of the law config is set, in which case :py:func:`step` costs a single
+attribute lookup. Summaries are written per branch next to the task outputs, see
+:py:func:`alljets.columnflow_patches.patch_step_timing_summary`.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import functools
+import resource
+import time
+from collections.abc import Callable
+
+import law
+
+
+logger = law.logger.get_logger(__name__)
+
+# shared no-op context of disabled steps
+_null_context = contextlib.nullcontext()
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss is given in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StepTimer:
+    """
+    Accumulates timing and memory information of named steps, in total and per chunk. *enabled*
+    defaults to the ``step_timing`` option in the law config, which is read on first use.
+    """
+
+    def __init__(self, enabled: bool | None = None):
+        self._enabled = enabled
+        self.reset()
+
+    @property
+    def enabled(self) -> bool:
+        if self._enabled is None:
+            self._enabled = law.config.get_expanded_bool("analysis", "step_timing", False)
+        return self._enabled
+
+    def reset(self) -> None:
+        self.totals = {}
+        self.chunks = []
+        self._chunk = None
+        self._depth = 0
+
+    def step(self, name: str) -> contextlib.AbstractContextManager:
+        """
+        Returns a context manager recording the step *name*, or a no-op context when disabled.
+        """
+        return self._record(name) if self.enabled else _null_context
+
+    @contextlib.contextmanager
+    def _record(self, name: str):
+        if self._depth == 0:
+            self._chunk = {"name": name, "steps": {}}
+        self._depth += 1
+
+        rss = _max_rss_mb()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            max_rss = _max_rss_mb()
+            self._depth -= 1
+            for stats in (self.totals, self._chunk["steps"]):
+                entry = stats.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "rss_growth_mb": 0.0})
+                entry["calls"] += 1
+                entry["wall"] += wall
+                entry["cpu"] += cpu
+                entry["rss_growth_mb"] += max_rss - rss
+                entry["max_rss_mb"] = max_rss
+            if self._depth == 0:
+                self.chunks.append(self._chunk)
+                self._chunk = None
+
+    def summary(self) -> dict:
+        """
+        Returns the recorded steps in total and per chunk as a json serializable dictionary.
+        """
+        return {"steps": self.totals, "chunks": self.chunks}
+
+
+# process-wide timer used by all alljets modules
+step_timer = StepTimer()
+
+
+def step(name: str) -> contextlib.AbstractContextManager:
+    """
+    Context manager recording the step *name* with the process-wide :py:attr:`step_timer`.
+    """
+    return step_timer.step(name)
+
+
+def timed(name: str) -> Callable:
+    """
+    Decorator recording all calls of the decorated function as the step *name*.
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with step_timer.step(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
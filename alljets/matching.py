@@ -0,0 +1,129 @@
+# coding: utf-8
+
+"""
+Matching of reconstructed jets to the partons of the fully hadronic ttbar decay.
+
+Reco jets and partons are given as blocks of shape ``(n_events, 6)`` in the order
+(b1, b2, q11, q12, q21, q22), where q1x are the light jets assigned to the first and q2x those
+assigned to the second W boson. Partons follow the same order with the b quarks and W boson decay
+products of the two top quarks in ``gen_top``. All matching classes are derived from a single
+``(n_events, 6, 6)`` matrix of ΔR values computed from the raw eta and phi buffers.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# parton index assigned to each reco jet in all assignments that count as correct, i.e., b jets
+# matched to the b quarks and light jets to the decay products of the W boson of the same top quark,
+# with both W decay products in either order
+CORRECT_ASSIGNMENTS = np.array([
+    [0, 1, 2, 3, 4, 5],
+    [0, 1, 3, 2, 4, 5],
+    [0, 1, 2, 3, 5, 4],
+    [0, 1, 3, 2, 5, 4],
+    [1, 0, 4, 5, 2, 3],
+    [1, 0, 4, 5, 3, 2],
+    [1, 0, 5, 4, 2, 3],
+    [1, 0, 5, 4, 3, 2],
+])
+
+# partons that reco jets can be matched to, b jets to b quarks and light jets to light quarks
+ALLOWED_PARTONS = np.zeros((6, 6), dtype=bool)
+ALLOWED_PARTONS[:2, :2] = True
+ALLOWED_PARTONS[2:, 2:] = True
+
+# combination types
+UNMATCHED, WRONG, CORRECT = 0, 1, 2
+
+
+def jet_block(jets: ak.Array | list[ak.Array], field: str) -> np.ndarray:
+    """
+    Returns the *field* of six reco jets per event as a ``(n_events, 6)`` array. *jets* is either a
+    jagged array with six jets per event or a list of six arrays with one jet per event, given as
+    records or lists of length one.
+    """
+    if isinstance(jets, (list, tuple)):
+        return np.stack([np.asarray(ak.flatten(jet[field], axis=None)) for jet in jets], axis=1)
+    return np.asarray(ak.flatten(jets[field], axis=None)).reshape(-1, 6)
+
+
+def parton_block(gen_top: ak.Array, field: str) -> np.ndarray:
+    """
+    Returns the *field* of the b quarks and W boson decay products in *gen_top* (see
+    :py:func:`columnflow.production.cms.gen_particles.gen_top_lookup`) as a ``(n_events, 6)`` array.
+    All events must contain two top quarks with two W boson decay products each.
+    """
+    b = np.asarray(ak.flatten(gen_top.b[field], axis=None)).reshape(-1, 2)
+    q = np.asarray(ak.flatten(gen_top.w_children[field], axis=None)).reshape(-1, 4)
+    return np.concatenate([b, q], axis=1)
+
+
+def delta_r_matrix(
+    eta1: np.ndarray,
+    phi1: np.ndarray,
+    eta2: np.ndarray,
+    phi2: np.ndarray,
+) -> np.ndarray:
+    """
+    Returns the ΔR between all objects of the ``(n_events, n1)`` blocks *eta1*, *phi1* and the
+    ``(n_events, n2)`` blocks *eta2*, *phi2* with shape ``(n_events, n1, n2)``. Values are computed
+    in the precision of the inputs, as done by the coffea ``delta_r`` behavior.
+    """
+    deta = eta1[:, :, None] - eta2[:, None, :]
+    dphi = (phi1[:, :, None] - phi2[:, None, :] + np.pi) % (2 * np.pi) - np.pi
+    return np.sqrt(deta ** 2 + dphi ** 2)
+
+
+def match_jets(
+    dr: np.ndarray,
+    dr_max: float = 0.4,
+    return_best: bool = False,
+) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+    """
+    Classifies the assignment of reco jets to partons given by the ``(n_events, 6, 6)`` ΔR matrix
+    *dr*. Events are :py:attr:`CORRECT` if one of the :py:attr:`CORRECT_ASSIGNMENTS` has all jets
+    within *dr_max* of their parton, :py:attr:`WRONG` if all jets are matched to a parton of the
+    same type but not in a correct assignment, and :py:attr:`UNMATCHED` otherwise.
+
+    When *return_best* is set, the index of the correct assignment with the smallest sum of ΔR
+    values is returned as well, which is -1 for events that are not correctly assigned.
+    """
+    close = dr < dr_max
+    matched = np.all(np.any(close & ALLOWED_PARTONS, axis=2), axis=1)
+    jets = np.arange(6)
+    correct_per_assignment = np.all(close[:, jets, CORRECT_ASSIGNMENTS], axis=2)
+    correct = np.any(correct_per_assignment, axis=1)
+
+    # correct assignments imply matched jets
+    comb_type = matched.astype(np.int8) + correct.astype(np.int8)
+    if not return_best:
+        return comb_type
+
+    dr_sum = np.where(correct_per_assignment, dr[:, jets, CORRECT_ASSIGNMENTS].sum(axis=2), np.inf)
+    best = np.where(correct, np.argmin(dr_sum, axis=1), -1)
+    return comb_type, best
+
+
+def combination_type(
+    jets: ak.Array | list[ak.Array],
+    gen_top: ak.Array,
+    dr_max: float = 0.4,
+    return_best: bool = False,
+) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the combination type (see :py:func:`match_jets`) of six reco *jets* per event in the
+    order (b1, b2, q11, q12, q21, q22), given in any format accepted by :py:func:`jet_block`, with
+    respect to the partons in *gen_top*.
+    """
+    dr = delta_r_matrix(
+        jet_block(jets, "eta"),
+        jet_block(jets, "phi"),
+        parton_block(gen_top, "eta"),
+        parton_block(gen_top, "phi"),
+    )
+    return match_jets(dr, dr_max=dr_max, return_best=return_best)
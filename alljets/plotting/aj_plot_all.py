@@ -33,6 +33,79 @@ plt = maybe_import("matplotlib.pyplot")
 mplhep = maybe_import("mplhep")
 
 
+def convert_weightedmean_to_weight(h_mean: hist.Hist, include_flow: bool = True) -> hist.Hist:
+    """
+    Converts a histogram with WeightedMean storage into one with Weight storage, keeping the
+    sums of weights and of squared weights per bin. Axes are rebuilt with their full category sets
+    and the bin contents are copied as whole structured views.
+    """
+    if not isinstance(h_mean._storage_type(), hist.storage.WeightedMean):
+        logger.warning(
+            "Storage type is not WeightedMean.",
+        )
+        return h_mean
+
+    # Reconstruct axes with full category sets and metadata
+    axes = []
+    for ax in h_mean.axes:
+        name = ax.name
+        label = ax.label
+
+        if isinstance(ax, hist.axis.Regular):
+            axes.append(hist.axis.Regular(ax.size, ax.start, ax.stop, name=name, label=label, flow=ax.options.flow))
+        elif isinstance(ax, hist.axis.Integer):
+            axes.append(hist.axis.Integer(ax.start, ax.stop, name=name, label=label, flow=ax.options.flow))
+        elif isinstance(ax, hist.axis.IntCategory):
+            axes.append(hist.axis.IntCategory(list(ax), name=name, label=label))
+        elif isinstance(ax, hist.axis.StrCategory):
+            axes.append(hist.axis.StrCategory(list(ax), name=name, label=label))
+        elif isinstance(ax, hist.axis.Variable):
+            axes.append(hist.axis.Variable(ax.edges, name=name, label=label))
+        else:
+            raise TypeError(f"Unsupported axis type: {type(ax)}")
+
+    # Create the new histogram with Weight storage
+    h_weight = hist.Hist(*axes, storage=hist.storage.Weight())
+
+    # Copy bin contents of the views with/without flow
+    mean_view = h_mean.view(flow=include_flow)
+    weight_view = h_weight.view(flow=include_flow)
+    weight_view[...] = np.stack([mean_view.sum_of_weights, mean_view.sum_of_weights_squared], axis=-1)
+
+    return h_weight
+
+
+class WeightSliceCache:
+    """
+    Cache of slices of WeightedMean histograms converted with
+    :py:func:`convert_weightedmean_to_weight`, keyed by the histogram and the slice index, e.g.
+    ``(weight category, shift, slice(None), trigger bin)``. Repeated requests for the same slice
+    return the converted histogram of the first request, so it must not be modified in place.
+
+    .. code-block:: python
+
+        weight_slice = WeightSliceCache()
+        h = weight_slice(hist_list_mean[0], (1, 0, slice(None), eff_bin))
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def __call__(self, h_mean: hist.Hist, index: tuple) -> hist.Hist:
+        # the histogram is kept alongside the result so that its id cannot be reused,
+        # slices are only hashable as of python 3.12
+        key = (id(h_mean),) + tuple(
+            (i.start, i.stop, i.step) if isinstance(i, slice) else i
+            for i in index
+        )
+        if key not in self._cache:
+            self._cache[key] = (h_mean, convert_weightedmean_to_weight(h_mean[index]))
+        return self._cache[key][1]
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
 def draw_error_bands(
     ax: plt.Axes,
     h: hist.Hist,
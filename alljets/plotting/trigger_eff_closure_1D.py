@@ -13,7 +13,7 @@ from inspect import signature
 import law
 
 from columnflow.util import maybe_import
-from alljets.plotting.aj_plot_all import aj_plot_all
+from alljets.plotting.aj_plot_all import aj_plot_all, convert_weightedmean_to_weight, WeightSliceCache
 from columnflow.plotting.plot_util import (
     prepare_style_config,
     remove_residual_axis,
@@ -39,50 +39,6 @@ law run cf.PlotVariables1D --version v1
 """
 
 
-def convert_weightedmean_to_weight(h_mean: hist.Hist, include_flow: bool = True) -> hist.Hist:
-    if not isinstance(h_mean._storage_type(), hist.storage.WeightedMean):
-        logger.warning(
-            "Storage type is not WeightedMean.",
-        )
-        return h_mean
-
-    # Reconstruct axes with full category sets and metadata
-    axes = []
-    for ax in h_mean.axes:
-        name = ax.name
-        label = ax.label
-
-        if isinstance(ax, hist.axis.Regular):
-            axes.append(hist.axis.Regular(ax.size, ax.start, ax.stop, name=name, label=label, flow=ax.options.flow))
-        elif isinstance(ax, hist.axis.Integer):
-            axes.append(hist.axis.Integer(ax.start, ax.stop, name=name, label=label, flow=ax.options.flow))
-        elif isinstance(ax, hist.axis.IntCategory):
-            axes.append(hist.axis.IntCategory(list(ax), name=name, label=label))
-        elif isinstance(ax, hist.axis.StrCategory):
-            axes.append(hist.axis.StrCategory(list(ax), name=name, label=label))
-        elif isinstance(ax, hist.axis.Variable):
-            axes.append(hist.axis.Variable(ax.edges, name=name, label=label))
-        else:
-            raise TypeError(f"Unsupported axis type: {type(ax)}")
-
-    # Create the new histogram with Weight storage
-    h_weight = hist.Hist(*axes, storage=hist.storage.Weight())
-
-    # View with/without flow
-    mean_view = h_mean.view(flow=include_flow)
-    weight_view = h_weight.view(flow=include_flow)
-
-    # Copy bin contents
-    for idx in np.ndindex(mean_view.shape):
-        bin_content = mean_view[idx]
-        weight_view[idx] = (
-            bin_content.sum_of_weights,
-            bin_content.sum_of_weights_squared,
-        )
-
-    return h_weight
-
-
 def sigmoid(x, L, x0, k, b):
     y = L / (1 + np.exp(-k * (x - x0))) + b
     return y
@@ -154,6 +110,7 @@ def plot_efficiencies(
         for i in range(len(hist_list)):
             hist_list[i] = convert_weightedmean_to_weight(hist_list[i])
     remove_residual_axis(hists, "shift")
+    weight_slice = WeightSliceCache()
 
     variable_inst = variable_insts[0]
     hists = apply_variable_settings(hists, variable_insts, variable_settings)
@@ -200,14 +157,14 @@ def plot_efficiencies(
 
     # for updating labels of individual selector steps
     # myhist_0 = convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin])
-    myhist_1 = convert_weightedmean_to_weight(hist_list_mean[1][weighted, 0, :, eff_bin])
+    myhist_1 = weight_slice(hist_list_mean[1], (weighted, 0, slice(None), eff_bin))
 
-    norm_hist_0 = np.array(convert_weightedmean_to_weight(hist_list_mean[0][1, 0, :, 0]).values())
-    norm_hist_1 = np.array(convert_weightedmean_to_weight(hist_list_mean[1][1, 0, :, 0]).values())
+    norm_hist_0 = np.array(weight_slice(hist_list_mean[0], (1, 0, slice(None), 0)).values())
+    norm_hist_1 = np.array(weight_slice(hist_list_mean[1], (1, 0, slice(None), 0)).values())
 
     # Fitting sigmoid or other function to efficiencies
 
-    values = convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin]).values()
+    values = weight_slice(hist_list_mean[0], (weighted, 0, slice(None), eff_bin)).values()
     norm = norm_hist_0
     efficiency = np.nan_to_num(values / norm, nan=0)
     band_low, band_high = binom_int(values, norm)
@@ -220,7 +177,7 @@ def plot_efficiencies(
     yerrors = yerrors.T
     plot_config["fit_0"] = {
         "method": "draw_efficiency_x",
-        "hist": convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin]),
+        "hist": weight_slice(hist_list_mean[0], (weighted, 0, slice(None), eff_bin)),
         "kwargs": {
             "x": hist_list_mean[0][weighted, 0, :, eff_bin].values(),
             "color": "b",
@@ -242,7 +199,7 @@ def plot_efficiencies(
     }
     plot_config["fit_1"] = {
         "method": "draw_efficiency_x",
-        "hist": convert_weightedmean_to_weight(hist_list_mean[1][weighted, 0, :, eff_bin]),
+        "hist": weight_slice(hist_list_mean[1], (weighted, 0, slice(None), eff_bin)),
         "kwargs": {
             "x": hist_list_mean[1][weighted, 0, :, eff_bin].values(),
             "color": "r",
@@ -287,6 +244,7 @@ def plot_efficiencies_with_uncert(
     """
     keys = list(hists.keys())
     variable_inst = variable_insts[0]
+    weight_slice = WeightSliceCache()
     hists = apply_variable_settings(hists, variable_insts, variable_settings)
     hists = apply_density(hists, density)
 
@@ -328,11 +286,11 @@ def plot_efficiencies_with_uncert(
     myhist_data = myhist_data_all_shifts[{"shift": "nominal"}]
     myhist_all_shifts = (hists[0][proc_key])
     myhist = myhist_all_shifts[{"shift": "nominal"}]
-    norm_hist_data = np.array(convert_weightedmean_to_weight((myhist_data)[1, :, 0]).values())
-    norm_hist = np.array(convert_weightedmean_to_weight((myhist)[1, :, 0]).values())
+    norm_hist_data = np.array(weight_slice(myhist_data, (1, slice(None), 0)).values())
+    norm_hist = np.array(weight_slice(myhist, (1, slice(None), 0)).values())
 
     # errors for ratio
-    values = convert_weightedmean_to_weight(myhist_data[0, :, eff_bin]).values()
+    values = weight_slice(myhist_data, (0, slice(None), eff_bin)).values()
     norm = norm_hist_data
     efficiency = np.nan_to_num(values / norm, nan=0)
     band_low, band_high = binom_int(values, norm)
@@ -348,7 +306,7 @@ def plot_efficiencies_with_uncert(
         if not keys[i].name == "data":
             plot_config["fit_1"] = {
                 "method": "draw_efficiency_x",
-                "hist": convert_weightedmean_to_weight((myhist_data)[0, :, eff_bin]),
+                "hist": weight_slice(myhist_data, (0, slice(None), eff_bin)),
                 "kwargs": {
                     "linestyle": "none",
                     "x": (myhist_data)[0, :, eff_bin].values(),
@@ -365,14 +323,14 @@ def plot_efficiencies_with_uncert(
                     "capsize": 3,
                     "linestyle": "none",
                     "norm": (
-                        convert_weightedmean_to_weight(myhist[0, :, eff_bin]).values() *
+                        weight_slice(myhist, (0, slice(None), eff_bin)).values() *
                         norm_hist_data) / norm_hist,
                 },
             }
         else:
             plot_config["hist1"] = {
                 "method": "draw_efficiency_x",
-                "hist": convert_weightedmean_to_weight(myhist[0, :, eff_bin]),
+                "hist": weight_slice(myhist, (0, slice(None), eff_bin)),
                 "kwargs": {
                     "x": myhist[0, :, eff_bin].values(),
                     "color": "r",
@@ -384,14 +342,14 @@ def plot_efficiencies_with_uncert(
     low = convert_weightedmean_to_weight(myhist_all_shifts[{"shift": "trig_down"}])[0, :, eff_bin].values()
     high = convert_weightedmean_to_weight(myhist_all_shifts[{"shift": "trig_up"}])[0, :, eff_bin].values()
 
-    errors_low = abs((low / norm_hist) - (convert_weightedmean_to_weight(myhist[0, :, eff_bin]).values() / norm_hist))
-    errors_high = abs((high / norm_hist) - (convert_weightedmean_to_weight(myhist[0, :, eff_bin]).values() / norm_hist))
-    eff = convert_weightedmean_to_weight(myhist[0, :, eff_bin]).values() / norm_hist
+    errors_low = abs((low / norm_hist) - (weight_slice(myhist, (0, slice(None), eff_bin)).values() / norm_hist))
+    errors_high = abs((high / norm_hist) - (weight_slice(myhist, (0, slice(None), eff_bin)).values() / norm_hist))
+    eff = weight_slice(myhist, (0, slice(None), eff_bin)).values() / norm_hist
 
     plot_config["syst"] = {
         "method": "draw_error_bands",
         "ratio_method": "draw_error_bands",
-        "hist": convert_weightedmean_to_weight(myhist[0, :, eff_bin]),
+        "hist": weight_slice(myhist, (0, slice(None), eff_bin)),
         "kwargs": {
             "bottom": (eff - errors_low),
             "height": errors_low + errors_high,
@@ -400,7 +358,7 @@ def plot_efficiencies_with_uncert(
         "ratio_kwargs": {
             "height": ((errors_low + errors_high) / eff),
             "bottom": (eff - errors_low) / eff,
-            "norm": convert_weightedmean_to_weight(myhist[0, :, eff_bin]).values(),
+            "norm": weight_slice(myhist, (0, slice(None), eff_bin)).values(),
         },
     }
 
@@ -442,6 +400,7 @@ def plot_efficiencies_with_fit(
         for i in range(len(hist_list)):
             hist_list[i] = convert_weightedmean_to_weight(hist_list[i])
     remove_residual_axis(hists, "shift")
+    weight_slice = WeightSliceCache()
 
     variable_inst = variable_insts[0]
     hists = apply_variable_settings(hists, variable_insts, variable_settings)
@@ -487,10 +446,10 @@ def plot_efficiencies_with_fit(
         trigger_names[eff_bin] = trig_alias
 
     #  myhist_0 = convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin])
-    myhist_1 = convert_weightedmean_to_weight(hist_list_mean[1][weighted, 0, :, eff_bin])
+    myhist_1 = weight_slice(hist_list_mean[1], (weighted, 0, slice(None), eff_bin))
 
-    norm_hist_0 = np.array(convert_weightedmean_to_weight(hist_list_mean[0][1, 0, :, 0]).values())
-    norm_hist_1 = np.array(convert_weightedmean_to_weight(hist_list_mean[1][1, 0, :, 0]).values())
+    norm_hist_0 = np.array(weight_slice(hist_list_mean[0], (1, 0, slice(None), 0)).values())
+    norm_hist_1 = np.array(weight_slice(hist_list_mean[1], (1, 0, slice(None), 0)).values())
 
     # Fitting sigmoid or other function to efficiencies
     fit_result = np.zeros((len(hist_list_mean), 4))
@@ -498,8 +457,8 @@ def plot_efficiencies_with_fit(
     variances = np.zeros((len(hist_list_mean), 4, 4))
     for j in range(len(hist_list_mean)):
         fit = eff_fit(
-            convert_weightedmean_to_weight(hist_list_mean[j][weighted, 0, :, eff_bin]).values(),
-            convert_weightedmean_to_weight(hist_list_mean[j][1, 0, :, 0]).values(),
+            weight_slice(hist_list_mean[j], (weighted, 0, slice(None), eff_bin)).values(),
+            weight_slice(hist_list_mean[j], (1, 0, slice(None), 0)).values(),
             hist_list_mean[j][weighted, 0, :, eff_bin].values(),
             fit_function=func_dict[fit_func],
         )
@@ -507,7 +466,7 @@ def plot_efficiencies_with_fit(
         variances[j] = fit[0][1]
         chi2[j] = fit[1]
 
-    values = convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin]).values()
+    values = weight_slice(hist_list_mean[0], (weighted, 0, slice(None), eff_bin)).values()
     norm = norm_hist_0
     efficiency = np.nan_to_num(values / norm, nan=0)
     band_low, band_high = binom_int(values, norm)
@@ -520,7 +479,7 @@ def plot_efficiencies_with_fit(
     yerrors = yerrors.T
     plot_config["fit_0"] = {
         "method": "draw_efficiency_with_fit",
-        "hist": convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin]),
+        "hist": weight_slice(hist_list_mean[0], (weighted, 0, slice(None), eff_bin)),
         "fit_result": fit_result[0],
         "kwargs": {
             "x": hist_list_mean[0][weighted, 0, :, eff_bin].values(),
@@ -542,7 +501,7 @@ def plot_efficiencies_with_fit(
     }
     plot_config["fit_1"] = {
         "method": "draw_efficiency_with_fit",
-        "hist": convert_weightedmean_to_weight(hist_list_mean[1][weighted, 0, :, eff_bin]),
+        "hist": weight_slice(hist_list_mean[1], (weighted, 0, slice(None), eff_bin)),
         "fit_result": fit_result[1],
         "kwargs": {
             "x": hist_list_mean[1][weighted, 0, :, eff_bin].values(),
@@ -593,6 +552,7 @@ def produce_trig_weight(
     else:
         TypeError("Unsupported hist storage type (not WeightedMean)")
     remove_residual_axis(hists, "shift")
+    weight_slice = WeightSliceCache()
 
     variable_inst = variable_insts[0]
     hists = apply_variable_settings(hists, variable_insts, variable_settings)
@@ -638,10 +598,10 @@ def produce_trig_weight(
         trigger_names[eff_bin] = trig_alias
 
     # myhist_0 = convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin])
-    myhist_1 = convert_weightedmean_to_weight(hist_list_mean[1][weighted, 0, :, eff_bin])
+    myhist_1 = weight_slice(hist_list_mean[1], (weighted, 0, slice(None), eff_bin))
 
-    norm_hist_0 = np.array(convert_weightedmean_to_weight(hist_list_mean[0][1, 0, :, 0]).values())
-    norm_hist_1 = np.array(convert_weightedmean_to_weight(hist_list_mean[1][1, 0, :, 0]).values())
+    norm_hist_0 = np.array(weight_slice(hist_list_mean[0], (1, 0, slice(None), 0)).values())
+    norm_hist_1 = np.array(weight_slice(hist_list_mean[1], (1, 0, slice(None), 0)).values())
 
     # Fitting sigmoid or other function to efficiencies
     fit_result = np.zeros((len(hist_list_mean), 4))
@@ -649,15 +609,15 @@ def produce_trig_weight(
     variances = np.zeros((len(hist_list_mean), 4, 4))
     for j in range(len(hist_list_mean)):
         fit = eff_fit(
-            convert_weightedmean_to_weight(hist_list_mean[j][weighted, 0, :, eff_bin]).values(),
-            convert_weightedmean_to_weight(hist_list_mean[j][weighted, 0, :, 0]).values(),
+            weight_slice(hist_list_mean[j], (weighted, 0, slice(None), eff_bin)).values(),
+            weight_slice(hist_list_mean[j], (weighted, 0, slice(None), 0)).values(),
             hist_list_mean[j][weighted, 0, :, eff_bin].values(),
             fit_function=func_dict[fit_func],
         )
         fit_result[j] = fit[0][0]
         variances[j] = fit[0][1]
         chi2[j] = fit[1]
-    values = convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin]).values()
+    values = weight_slice(hist_list_mean[0], (weighted, 0, slice(None), eff_bin)).values()
     norm = norm_hist_0
     efficiency = np.nan_to_num(values / norm, nan=0)
     band_low, band_high = binom_int(values, norm)
@@ -670,7 +630,7 @@ def produce_trig_weight(
     yerrors = yerrors.T
     plot_config["fit_0"] = {
         "method": "draw_efficiency_with_fit",
-        "hist": convert_weightedmean_to_weight(hist_list_mean[0][weighted, 0, :, eff_bin]),
+        "hist": weight_slice(hist_list_mean[0], (weighted, 0, slice(None), eff_bin)),
         "fit_result": fit_result[0],
         "kwargs": {
             "x": hist_list_mean[0][weighted, 0, :, eff_bin].values(),
@@ -692,7 +652,7 @@ def produce_trig_weight(
     }
     plot_config["fit_1"] = {
         "method": "draw_efficiency_with_fit",
-        "hist": convert_weightedmean_to_weight(hist_list_mean[1][weighted, 0, :, eff_bin]),
+        "hist": weight_slice(hist_list_mean[1], (weighted, 0, slice(None), eff_bin)),
         "fit_result": fit_result[1],
         "kwargs": {
             "x": hist_list_mean[1][weighted, 0, :, eff_bin].values(),
@@ -1,30 +1,386 @@
 # coding: utf-8
 
+"""
+Kinematic fit of the fully hadronic ttbar hypothesis.
+"""
+
+from __future__ import annotations
+
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import law
+
 from columnflow.columnar_util import EMPTY_FLOAT, flat_np_view, set_ak_column
 from columnflow.production import Producer, producer
 # from columnflow.selection.util import create_collections_from_masks
 from columnflow.util import maybe_import
+from law.util import InsertableDict
+
+from alljets.instrumentation import step, timed
+from alljets.util import event_keys, jagged_offsets, leading_order, match_rows, pad_flat, scatter_leading
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 coffea = maybe_import("coffea")
 maybe_import("coffea.nanoevents.methods.nanoaod")
 
+logger = law.logger.get_logger(__name__)
+
+# number of jets entering a fit hypothesis, ordered as (B1, B2, W1Prod1, W1Prod2, W2Prod1, W2Prod2)
+N_FIT_JETS = 6
+
+# chi2 at and above which fits count as not converged, see also the fit categories
+NCONV_CHI2 = 10000.0
+
+# ids of the fit implementations stored in the FitBackend column, since the numpy fit agrees with
+# pyKinFit only approximately
+FIT_BACKEND_IDS = {"pykinfit": 0, "numpy": 1}
+
+# sources of shifts that change the jets entering the kinematic fit
+REFIT_SHIFT_SOURCES = ("jec", "jer")
+
+# worker pool shared by all fits in this process, created on first use as (key, pool)
+_worker_pool = None
+
+
+def kinfit_batch(
+    jets: np.ndarray,
+    offsets: np.ndarray | None = None,
+    counts: np.ndarray | None = None,
+    backend: str = "pykinfit",
+    n_workers: int = 1,
+    batch_size: int = 2000,
+    top_k: int | None = None,
+    max_jets: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Batch entry point of the kinematic fit. *jets* is either the flat content buffer of a jagged jet
+    array with shape ``(n_jets, 4)`` and fields ``(pt, eta, phi, mass)``, in which case *offsets*
+    must be given, or a padded ``(n_events, n_max, 4)`` block whose valid jets per event are given
+    by *counts* (defaulting to *n_max*). Jets are expected to be sorted as required by the fit.
+
+    *backend* selects the fit implementation, either ``"pykinfit"`` (requires the CMSSW sandbox),
+    ``"numpy"`` (see :py:mod:`alljets.production.kinfit_numpy`) or ``"server"``, which hands the
+    batch to a running fit server (see :py:mod:`alljets.production.kinfit_server`). All backends
+    fit all jet permutations of all jets of an event, unless *max_jets* limits the fit to the leading
+    ones.
+
+    When *top_k* is set, only the *top_k* jet permutations with the smallest mass chi2 of the jet
+    selection are fitted per event (see :py:func:`alljets.production.kinfit_numpy.fit_numpy`).
+    pyKinFit cannot be given single permutations, so it fits all assignments of each distinct set of
+    six jets among these permutations instead, which includes them.
+
+    When *n_workers* is larger than one, events are split into sub-batches of *batch_size* that are
+    fitted by a pool of worker processes and gathered in the original order. With a single worker
+    or less than two sub-batches, the fit runs serially in this process, yielding identical results.
+    The same holds when the pool cannot be started or fails, e.g., since a worker crashed or could
+    not import the fitter, in which case the pool is discarded and the batch is refitted serially.
+
+    Returns a 4-tuple of contiguous numpy arrays:
+
+        - the fitted ``(pt, eta, phi, mass)`` of the six jets, shape ``(n_events, 6, 4)``,
+        - the indices of the fitted jets in the input order, shape ``(n_events, 6)``,
+        - the chi2 and the goodness-of-fit probability of the best combination, shape ``(n_events,)``.
+    """
+    if offsets is not None:
+        counts = np.diff(offsets)
+        jets = pad_flat(jets, offsets, dtype=np.float32)
+    else:
+        jets = np.asarray(jets, dtype=np.float32)
+        if counts is None:
+            counts = np.full(len(jets), jets.shape[1], dtype=np.int64)
+    if max_jets is not None:
+        if max_jets < N_FIT_JETS:
+            raise ValueError(f"max_jets must be at least {N_FIT_JETS}, got {max_jets}")
+        jets = jets[:, :max_jets]
+        counts = np.minimum(counts, max_jets)
+
+    if backend not in kinfit_backends:
+        raise ValueError(f"unknown kinematic fit backend '{backend}', choose from {list(kinfit_backends)}")
+    n_events = len(jets)
+    if not n_events:
+        return (
+            np.zeros((0, N_FIT_JETS, 4), dtype=np.float32),
+            np.zeros((0, N_FIT_JETS), dtype=np.int32),
+            np.zeros(0, dtype=np.float64),
+            np.zeros(0, dtype=np.float64),
+        )
+
+    counts = np.asarray(counts)
+    if n_workers > 1 and n_events > batch_size:
+        splits = np.arange(batch_size, n_events, batch_size)
+        try:
+            pool = _get_worker_pool(n_workers, backend)
+            results = list(pool.map(
+                _fit_worker,
+                [
+                    (backend, _jets, _counts, top_k)
+                    for _jets, _counts in zip(np.split(jets, splits), np.split(counts, splits))
+                ],
+            ))
+        except Exception as e:
+            # errors of the fit itself are raised again by the serial fit below
+            logger.warning(f"kinematic fit with {n_workers} workers failed, running serially: {e!r}")
+            _close_worker_pool()
+        else:
+            return tuple(np.concatenate(arrays, axis=0) for arrays in zip(*results))
+
+    return kinfit_backends[backend](jets, counts, top_k=top_k)
+
+
+def _init_fit_worker(backend: str) -> None:
+    # import the fitter once per worker, import errors are raised by the fit call itself
+    if backend == "pykinfit":
+        try:
+            import pyKinFit  # noqa: F401
+        except ImportError:
+            pass
+
+
+def _fit_worker(
+    args: tuple[str, np.ndarray, np.ndarray, int | None],
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    backend, jets, counts, top_k = args
+    return kinfit_backends[backend](jets, counts, top_k=top_k)
+
+
+def _get_worker_pool(n_workers: int, backend: str) -> ProcessPoolExecutor:
+    global _worker_pool
+
+    key = (n_workers, backend)
+    if _worker_pool is None or _worker_pool[0] != key:
+        _close_worker_pool()
+        # spawn rather than fork, since the parent process might hold threads and ROOT state
+        pool = ProcessPoolExecutor(
+            n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_fit_worker,
+            initargs=(backend,),
+        )
+        _worker_pool = (key, pool)
+        logger.debug(f"started {n_workers} kinematic fit workers with backend '{backend}'")
+
+    return _worker_pool[1]
+
+
+@atexit.register
+def _close_worker_pool() -> None:
+    global _worker_pool
+
+    if _worker_pool is not None:
+        _worker_pool[1].shutdown(cancel_futures=True)
+        _worker_pool = None
+
+
+def _fit_pykinfit(
+    jets: np.ndarray,
+    counts: np.ndarray,
+    top_k: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    if top_k is not None:
+        return _fit_pykinfit_top_k(jets, counts, top_k)
+
+    import pyKinFit
+
+    # pyKinFit only accepts nested sequences, so the conversion is confined to this call and done
+    # row-wise from numpy rather than per jet from awkward
+    ragged = [
+        [row[:n].tolist() for row, n in zip(jets[..., i], counts)]
+        for i in range(4)
+    ]
+    fitPt, fitEta, fitPhi, fitMass, indexlist, fitChi2, fitPgof = pyKinFit.setBestCombi(*ragged)
+
+    fit_jets = np.empty((len(jets), N_FIT_JETS, 4), dtype=np.float32)
+    for i, values in enumerate((fitPt, fitEta, fitPhi, fitMass)):
+        fit_jets[..., i] = [v[:N_FIT_JETS] for v in values]
+    indices = np.array([v[:N_FIT_JETS] for v in indexlist], dtype=np.int32)
+
+    return (
+        fit_jets,
+        indices,
+        np.asarray(fitChi2, dtype=np.float64),
+        np.asarray(fitPgof, dtype=np.float64),
+    )
+
+
+def _fit_pykinfit_top_k(
+    jets: np.ndarray,
+    counts: np.ndarray,
+    top_k: int,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    from alljets.production.kinfit_numpy import top_k_jet_sets
+
+    # pyKinFit fits all assignments of the jets it is given, so each set of six jets of the top_k
+    # permutations is fitted as a separate event, keeping their b-tag order, and the best one is kept
+    set_rows, jet_sets = top_k_jet_sets(jets, counts, top_k)
+    n_events = len(jets)
+    results = (
+        np.zeros((n_events, N_FIT_JETS, 4), dtype=np.float32),
+        np.zeros((n_events, N_FIT_JETS), dtype=np.int32),
+        np.zeros(n_events, dtype=np.float64),
+        np.zeros(n_events, dtype=np.float64),
+    )
+
+    if len(set_rows):
+        fit_jets, indices, chi2, pgof = _fit_pykinfit(
+            jets[set_rows[:, None], jet_sets],
+            np.full(len(set_rows), N_FIT_JETS),
+        )
+        indices = np.take_along_axis(jet_sets, indices.astype(np.int64), axis=1)
+        order = np.lexsort((chi2, set_rows))
+        best = order[np.r_[True, set_rows[order][1:] != set_rows[order][:-1]]]
+        for result, values in zip(results, (fit_jets, indices, chi2, pgof)):
+            result[set_rows[best]] = values[best]
+
+    # events with at most top_k permutations are fitted with all of them
+    full = np.setdiff1d(np.arange(n_events), set_rows)
+    if len(full):
+        for result, values in zip(results, _fit_pykinfit(jets[full], counts[full])):
+            result[full] = values
+
+    return results
+
+
+def _fit_numpy(
+    jets: np.ndarray,
+    counts: np.ndarray,
+    top_k: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    from alljets.production.kinfit_numpy import fit_numpy
+
+    return fit_numpy(jets, counts, max_jets=jets.shape[1], top_k=top_k)
+
+
+def _fit_server(
+    jets: np.ndarray,
+    counts: np.ndarray,
+    top_k: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    from alljets.production.kinfit_server import fit_remote
+
+    return fit_remote(jets, counts, top_k=top_k)
+
+
+kinfit_backends = {
+    "pykinfit": _fit_pykinfit,
+    "numpy": _fit_numpy,
+    "server": _fit_server,
+}
+
+
+def nominal_seeds(
+    nominal: dict[str, np.ndarray],
+    keys: np.ndarray,
+    phi: np.ndarray,
+    offsets: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the positions of the six jets fitted in the nominal shift among the jets given by their
+    flat *phi* values and *offsets*, with shape ``(n_events, 6)``, as well as the nominal chi2. Jets
+    are identified by their phi, which is not changed by jet energy scale and resolution shifts.
+    Positions are -1 for events without converged nominal fit or whose jets are not all found.
+    Events are identified by their *keys* as returned by :py:func:`alljets.util.event_keys`.
+
+    *nominal* contains the event ``keys``, their sort ``order``, the reco ``phi`` of the fitted
+    jets with shape ``(n_nominal, 6)`` and the ``chi2`` of the nominal fit.
+    """
+    if not len(nominal["keys"]):
+        return np.full((len(keys), N_FIT_JETS), -1), np.full(len(keys), NCONV_CHI2)
+
+    rows, found = match_rows(nominal["keys"], keys, order=nominal["order"])
+    chi2 = nominal["chi2"][rows]
+    same = nominal["phi"][rows][:, :, None] == pad_flat(phi, offsets, fill_value=np.nan)[:, None, :]
+    seeded = found & np.all(np.any(same, axis=2), axis=1) & (chi2 >= 0) & (chi2 < NCONV_CHI2)
+    positions = np.argmax(same, axis=2) if same.shape[2] else np.zeros(same.shape[:2], dtype=np.int64)
+    return np.where(seeded[:, None], positions, -1), chi2
+
+
+def warm_started_fit(
+    jets: np.ndarray,
+    offsets: np.ndarray,
+    positions: np.ndarray,
+    nominal_chi2: np.ndarray,
+    max_dchi2: float,
+    top_k: int | None = None,
+    **kwargs,
+) -> tuple[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray], int]:
+    """
+    Kinematic fit seeded by the jets of a previous fit, e.g. of the nominal shift, given by their
+    *positions* among the jets as returned by :py:func:`nominal_seeds`. *jets* and *offsets* are
+    defined as in :py:func:`kinfit_batch`. For seeded events, only the assignments of the six seed
+    jets are fitted. Events without seed and those whose chi2 exceeds *nominal_chi2* by more than
+    *max_dchi2* are fitted with all jets. *top_k* and *kwargs* are forwarded to
+    :py:func:`kinfit_batch`.
+
+    Returns the fit results as :py:func:`kinfit_batch` and the number of events whose seeded fit was
+    kept.
+    """
+    counts = np.diff(offsets)
+    jets = pad_flat(jets, offsets, dtype=np.float32)
+    n_events = len(counts)
+    results = (
+        np.zeros((n_events, N_FIT_JETS, 4), dtype=np.float32),
+        np.zeros((n_events, N_FIT_JETS), dtype=np.int32),
+        np.zeros(n_events, dtype=np.float64),
+        np.zeros(n_events, dtype=np.float64),
+    )
+
+    # fit the seed jets in the order of all jets, so that their b-tag order is kept
+    seeded = np.flatnonzero(positions[:, 0] >= 0)
+    seed_positions = np.sort(positions[seeded], axis=1)
+    fit_jets, indices, chi2, pgof = kinfit_batch(jets[seeded[:, None], seed_positions], **kwargs)
+    indices = np.take_along_axis(seed_positions, indices.astype(np.int64), axis=1)
+    keep = chi2 <= nominal_chi2[seeded] + max_dchi2
+    for result, values in zip(results, (fit_jets, indices, chi2, pgof)):
+        result[seeded[keep]] = values[keep]
+
+    # full permutation search for all other events
+    full = np.setdiff1d(np.arange(n_events), seeded[keep])
+    for result, values in zip(results, kinfit_batch(jets[full], counts=counts[full], top_k=top_k, **kwargs)):
+        result[full] = values
+
+    return results, int(np.sum(keep))
+
 
 @producer(
-    uses={"Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "Jet.btagDeepFlavB"},
+    uses={"run", "luminosityBlock", "event", "Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "Jet.btagDeepFlavB"},
     produces={
         "FitJet.pt",
         "FitJet.eta",
         "FitJet.phi",
         "FitJet.mass",
+        "FitRecoPhi",
         "FitChi2",
         "FitPgof",
+        "FitBackend",
     },
     jet_pt=None,
     jet_trigger=None,
+    # fit implementation, see kinfit_backends
+    backend="pykinfit",
+    # number of leading jets entering the fit, defaults to the "kinfit_max_jets" option in the law
+    # config, 0 or None for all jets
+    max_jets=None,
+    # number of fit worker processes and of events per sub-batch handed to a worker, defaulting to
+    # the "kinfit_workers" and "kinfit_batch_size" options in the law config
+    n_workers=None,
+    batch_size=None,
+    # number of permutations with the smallest mass chi2 that are fitted per event, defaults to the
+    # "kinfit_top_k" option in the law config, 0 or None for all permutations
+    top_k=None,
+    # number of fitted mc events per chunk that are also fitted with all permutations to count how
+    # often the top_k ranking misses the optimum, defaults to the "kinfit_top_k_check" option
+    top_k_check=None,
+    # whether to seed fits in jec and jer shifts with the jets of the nominal fit, and the increase
+    # of the chi2 with respect to the nominal one above which all permutations are fitted, defaulting
+    # to the "kinfit_warm_start" and "kinfit_warm_start_max_dchi2" options in the law config
+    warm_start=None,
+    warm_start_max_dchi2=None,
     sandbox="bash::$CF_REPO_BASE/sandboxes/cmsswtest.sh",
 )
+@timed("kinFit")
 def kinFit(
     self: Producer,
     events: ak.Array,
@@ -32,88 +388,214 @@ def kinFit(
     eventmask: ak.Array,
     **kwargs,
 ) -> ak.Array:
-    import pyKinFit
-    sel_events = events[eventmask]
-    sel_Jets = sel_events.Jet[sel_jet_mask[eventmask]]
-    wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
-
-    # sorted_indices = ak.argsort(sel_Jets.btagDeepFlavB, ascending=False)
-    # wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
-    sorted_indices = ak.where(
-        ak.num(sel_Jets.btagDeepFlavB, axis=1) >= 2,
-        ak.argsort(sel_Jets.btagDeepFlavB, ascending=False),
-        ak.argsort(sel_Jets.pt, ascending=False),
-    )
-    sorted_jets = sel_Jets[sorted_indices]
-    fitPt, fitEta, fitPhi, fitMass, indexlist, fitChi2, fitPgof = pyKinFit.setBestCombi(
-        ak.to_list(sorted_jets.pt),
-        ak.to_list(sorted_jets.eta),
-        ak.to_list(sorted_jets.phi),
-        ak.to_list(sorted_jets.mass),
+    with step("kinFit.prepare"):
+        sel_events = events[eventmask]
+        sel_Jets = sel_events.Jet[sel_jet_mask[eventmask]]
+
+        # sorted_indices = ak.argsort(sel_Jets.btagDeepFlavB, ascending=False)
+        # wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
+        sorted_indices = ak.where(
+            ak.num(sel_Jets.btagDeepFlavB, axis=1) >= 2,
+            ak.argsort(sel_Jets.btagDeepFlavB, ascending=False),
+            ak.argsort(sel_Jets.pt, ascending=False),
+        )
+        sorted_jets = sel_Jets[sorted_indices]
+    with step("kinFit.fit"):
+        if self.fit_backend is None:
+            # the fit server reports the backend it fits with
+            from alljets.production.kinfit_server import request
+            self.fit_backend = request("ping")["backend"]
+        flat_jets = np.stack([
+            flat_np_view(sorted_jets[field])
+            for field in ("pt", "eta", "phi", "mass")
+        ], axis=-1)
+        fit_offsets = jagged_offsets(sorted_jets)
+        if self.nominal_seeds is None:
+            fit_jets, fit_indices, fitChi2, fitPgof = kinfit_batch(
+                flat_jets,
+                offsets=fit_offsets,
+                backend=self.backend,
+                n_workers=self.n_workers,
+                batch_size=self.batch_size,
+                top_k=self.top_k,
+                max_jets=self.max_jets,
+            )
+        else:
+            positions, nominal_chi2 = nominal_seeds(
+                self.nominal_seeds,
+                event_keys(
+                    ak.to_numpy(sel_events.run),
+                    ak.to_numpy(sel_events.luminosityBlock),
+                    ak.to_numpy(sel_events.event),
+                ),
+                flat_jets[:, 2],
+                fit_offsets,
+            )
+            (fit_jets, fit_indices, fitChi2, fitPgof), n_kept = warm_started_fit(
+                flat_jets,
+                fit_offsets,
+                positions,
+                nominal_chi2,
+                self.warm_start_max_dchi2,
+                backend=self.backend,
+                n_workers=self.n_workers,
+                batch_size=self.batch_size,
+                top_k=self.top_k,
+                max_jets=self.max_jets,
+            )
+            logger.debug(f"kept {n_kept} of {len(fitChi2)} fits seeded with the nominal jets")
+
+    if self.top_k and self.top_k_check and self.dataset_inst.is_mc:
+        with step("kinFit.top_k_check"):
+            from alljets.production.kinfit_numpy import top_k_misses
+
+            n_check = min(self.top_k_check, len(fit_offsets) - 1)
+            missed, converged = top_k_misses(
+                pad_flat(flat_jets, fit_offsets[:n_check + 1], dtype=np.float32),
+                np.diff(fit_offsets[:n_check + 1]),
+                self.top_k,
+                max_jets=self.max_jets,
+            )
+            self.top_k_missed += missed
+            self.top_k_checked += converged
+            logger.info(
+                f"top {self.top_k} permutations missed the best fit in {missed} of {converged} events, "
+                f"{self.top_k_missed / max(self.top_k_checked, 1):.2%} of {self.top_k_checked} in total",
+            )
+
+    # order the selected jets of all events by b-tag score (or pt), and for fitted events move the
+    # six fitted jets to the front, followed by the remaining ones
+    with step("kinFit.reassembly"):
+        all_jets = events.Jet[sel_jet_mask]
+        sorted_reco_indices = ak.where(
+            ak.num(all_jets.btagDeepFlavB, axis=1) >= 2,
+            ak.argsort(all_jets.btagDeepFlavB, ascending=False),
+            ak.argsort(all_jets.pt, ascending=False),
+        )
+        sorted_reco = all_jets[sorted_reco_indices]
+        offsets = jagged_offsets(sorted_reco)
+        fit_rows = np.flatnonzero(ak.to_numpy(eventmask))
+        fit_order = leading_order(offsets, fit_rows, fit_indices)
+        sorted_jets_top6 = sorted_reco[ak.unflatten(fit_order, np.diff(offsets))][:, :N_FIT_JETS]
+
+        # scatter the fitted kinematics into the flat buffers of the leading jets, keeping the reco
+        # values for events that were not fitted
+        offsets_top6 = jagged_offsets(sorted_jets_top6)
+        counts_top6 = np.diff(offsets_top6)
+        fit_fields = {}
+        for i, field in enumerate(("pt", "eta", "phi", "mass")):
+            values = np.asarray(flat_np_view(sorted_jets_top6[field]), dtype=np.float32)
+            values = scatter_leading(values, offsets_top6, fit_rows, fit_jets[..., i])
+            fit_fields[field] = ak.unflatten(values, counts_top6)
+
+    with step("kinFit.set_columns"):
+        # Create FitJet collection with fit values, aligned with the original events
+        fitJet_record = ak.zip({"reco": sorted_jets_top6, **fit_fields}, depth_limit=2)
+        events = set_ak_column(events, "FitJet", fitJet_record)
+        # reco phi of the fitted jets, identifying them in jec and jer shifts
+        events = set_ak_column(events, "FitRecoPhi", sorted_jets_top6.phi)
+        # FitJets are in Order (B1,B2,W1Prod1,W1Prod2,W2Prod1,W2Prod2)
+        total_chi2 = np.full(len(events), EMPTY_FLOAT)
+        total_chi2[eventmask] = fitChi2
+        total_pgof = np.full(len(events), EMPTY_FLOAT)
+        total_pgof[eventmask] = fitPgof
+        events = set_ak_column(events, "FitChi2", total_chi2)
+        events = set_ak_column(events, "FitPgof", total_pgof)
+        # fit implementation, see FIT_BACKEND_IDS
+        events = set_ak_column(
+            events,
+            "FitBackend",
+            np.full(len(events), FIT_BACKEND_IDS[self.fit_backend], dtype=np.int8),
+        )
+    return events
+
+
+@kinFit.init
+def kinFit_init(self: Producer) -> None:
+    if self.n_workers is None:
+        self.n_workers = law.config.get_expanded_int("analysis", "kinfit_workers", 1)
+    if self.batch_size is None:
+        self.batch_size = law.config.get_expanded_int("analysis", "kinfit_batch_size", 2000)
+    if self.max_jets is None:
+        self.max_jets = law.config.get_expanded_int("analysis", "kinfit_max_jets", 0) or None
+    if self.top_k is None:
+        self.top_k = law.config.get_expanded_int("analysis", "kinfit_top_k", 0) or None
+    if self.top_k_check is None:
+        self.top_k_check = law.config.get_expanded_int("analysis", "kinfit_top_k_check", 0)
+    # misses of the top_k ranking and number of checked events, accumulated over chunks
+    self.top_k_missed = 0
+    self.top_k_checked = 0
+    if self.warm_start is None:
+        self.warm_start = law.config.get_expanded_bool("analysis", "kinfit_warm_start", False)
+    if self.warm_start_max_dchi2 is None:
+        self.warm_start_max_dchi2 = law.config.get_expanded_float("analysis", "kinfit_warm_start_max_dchi2", 1.0)
+    # fit implementation, resolved on the first call for the server backend
+    self.fit_backend = None if self.backend == "server" else self.backend
+    # seeds from the nominal fit, loaded in the setup if used
+    self.nominal_seeds = None
+
+
+def _warm_starts_fit(self: Producer, task: law.Task) -> bool:
+    # only columns produced for mc in a shift that changes the jets of the nominal shift
+    from columnflow.tasks.production import ProduceColumns
+
+    shift_inst = getattr(task, "global_shift_inst", None)
+    return (
+        self.warm_start and
+        isinstance(task, ProduceColumns) and
+        self.dataset_inst.is_mc and
+        shift_inst is not None and
+        not shift_inst.is_nominal and
+        shift_inst.source.startswith(REFIT_SHIFT_SOURCES)
     )
 
-    # function to append indices not found in a list yet to a target length
-    def appendindices(initial_array, target_lengths):
-        for i in range(len(initial_array)):
-            inner_list = initial_array[i]
-            target_length = target_lengths[i]
-            available_numbers = list(range(target_length))
-            for num in available_numbers:
-                if num not in inner_list:
-                    inner_list.append(num)
-                if len(inner_list) >= target_length:
-                    break
-        return initial_array
-
-    # function to insert values of one awkward array into another at a list of given indices
-    def insert_at_index(to_insert, where, indices_to_replace):
-        full_true = ak.full_like(where, True, dtype=bool)
-        mask = full_true & indices_to_replace
-        flat = flat_np_view(to_insert)
-        cut_orig = ak.num(where[mask])
-        cut_replaced = ak.unflatten(flat, cut_orig)
-        original = where[~mask]
-        combined = ak.concatenate((original, cut_replaced), axis=1)
-        return combined
-    lok_ind = ak.local_index(events.Jet[sel_jet_mask])
-    indexmask = appendindices(indexlist, ak.num(lok_ind[eventmask], axis=1))
-    combined_indices = insert_at_index(indexmask, lok_ind, eventmask)
-    sorted_reco_indices = ak.where(
-        ak.num(events.Jet[sel_jet_mask].btagDeepFlavB, axis=1) >= 2,
-        ak.argsort(events.Jet[sel_jet_mask].btagDeepFlavB, ascending=False),
-        ak.argsort(events.Jet[sel_jet_mask].pt, ascending=False),
+
+@kinFit.requires
+def kinFit_requires(self: Producer, task: law.Task, reqs: dict) -> None:
+    if "kinfit_nominal" in reqs or not _warm_starts_fit(self, task):
+        return
+    reqs["kinfit_nominal"] = task.req(task, shift="nominal")
+
+
+@kinFit.setup
+def kinFit_setup(
+    self: Producer,
+    task: law.Task,
+    reqs: dict,
+    inputs: dict,
+    reader_targets: InsertableDict,
+) -> None:
+    self.nominal_seeds = None
+    if not _warm_starts_fit(self, task):
+        return
+
+    # fitted jets and chi2 of the nominal shift, looked up by run, luminosity block and event number
+    columns = ak.from_parquet(
+        inputs["kinfit_nominal"]["columns"].abspath,
+        columns=["run", "luminosityBlock", "event", "FitRecoPhi", "FitChi2"],
     )
-    # sorted_reco_indices = ak.argsort(events.Jet[sel_jet_mask].btagDeepFlavB, ascending=False)
-    sorted_reco = (events.Jet[sel_jet_mask])[sorted_reco_indices]
-    sorted_jet = sorted_reco[combined_indices]
-
-    # Take only the first 6 jets per event
-    sorted_jets_top6 = sorted_jet[:, :6]
-    # Convert your Python lists to awkward arrays
-    fitPt_ak = ak.Array(fitPt)
-    fitPt_full = insert_at_index(
-        fitPt_ak[:, :6], sorted_jets_top6.pt, eventmask)
-    fitEta_ak = ak.Array(fitEta)
-    fitEta_full = insert_at_index(
-        fitEta_ak[:, :6], sorted_jets_top6.eta, eventmask)
-    fitPhi_ak = ak.Array(fitPhi)
-    fitPhi_full = insert_at_index(
-        fitPhi_ak[:, :6], sorted_jets_top6.phi, eventmask)
-    fitMass_ak = ak.Array(fitMass)
-    fitMass_full = insert_at_index(
-        fitMass_ak[:, :6], sorted_jets_top6.mass, eventmask)
-    # Create FitJet collection for the selected events with fit values
-    fitJet_record = ak.Array({"reco": sorted_jets_top6})
-    fitJet_record = ak.with_field(fitJet_record, fitPt_full[:, :6], "pt")
-    fitJet_record = ak.with_field(fitJet_record, fitEta_full[:, :6], "eta")
-    fitJet_record = ak.with_field(fitJet_record, fitPhi_full[:, :6], "phi")
-    fitJet_record = ak.with_field(fitJet_record, fitMass_full[:, :6], "mass")
-    events = set_ak_column(events, "FitJet", fitJet_record)
-    # FitJets are in Order (B1,B2,W1Prod1,W1Prod2,W2Prod1,W2Prod2)
-    total_chi2 = np.full(len(events), EMPTY_FLOAT)
-    total_chi2[eventmask] = ak.Array(fitChi2)
-    total_pgof = np.full(len(events), EMPTY_FLOAT)
-    total_pgof[eventmask] = ak.Array(fitPgof)
-    events = set_ak_column(events, "FitChi2", total_chi2)
-    events = set_ak_column(events, "FitPgof", total_pgof)
-    return events
+    keys = event_keys(np.asarray(columns.run), np.asarray(columns.luminosityBlock), np.asarray(columns.event))
+    self.nominal_seeds = {
+        "keys": keys,
+        "order": np.argsort(keys, kind="stable"),
+        "phi": pad_flat(
+            np.asarray(ak.flatten(columns.FitRecoPhi, axis=1)),
+            jagged_offsets(columns.FitRecoPhi),
+            n_max=N_FIT_JETS,
+            fill_value=np.nan,
+        ),
+        "chi2": np.asarray(columns.FitChi2),
+    }
+
+
+# numpy backend, runnable in the default columnar sandbox
+kinFit_numpy = kinFit.derive(
+    "kinFit_numpy",
+    cls_dict={"backend": "numpy", "sandbox": None},
+)
+
+# fit on a local fit server running in the CMSSW sandbox, runnable in the default columnar sandbox
+kinFit_server = kinFit.derive(
+    "kinFit_server",
+    cls_dict={"backend": "server", "sandbox": None},
+)
@@ -4,7 +4,11 @@
 Column production methods related to higher-level features.
 """
 
+from __future__ import annotations
 
+import law
+
+from columnflow.categorization import Categorizer
 from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column
 from columnflow.production import Producer, producer
 from columnflow.production.categories import category_ids
@@ -14,17 +18,35 @@ from columnflow.production.cms.muon import muon_weights
 from columnflow.production.cms.seeds import deterministic_seeds
 from columnflow.production.normalization import normalization_weights
 from columnflow.production.util import attach_coffea_behavior
-from columnflow.columnar_util import attach_coffea_behavior as attach_coffea_behavior_fn
 # from columnflow.selection.util import create_collections_from_masks
 from columnflow.util import maybe_import
+from law.util import InsertableDict
 
-from alljets.production.KinFit import kinFit
+from alljets.expressions import MaskExpression
+from alljets.fourvector import FourVectors
+from alljets.matching import combination_type
+from alljets.production.KinFit import REFIT_SHIFT_SOURCES, kinFit, kinFit_numpy, kinFit_server
+from alljets.production.jet_masks import get_jet_mask, jet_masks
+from alljets.util import content_hash, event_keys, kth_largest, match_rows, pack_bitmask
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 coffea = maybe_import("coffea")
 maybe_import("coffea.nanoevents.methods.nanoaod")
 
+logger = law.logger.get_logger(__name__)
+
+# jet fields entering the kinematic fit, including those of its jet mask
+KINFIT_INPUT_FIELDS = ["pt", "eta", "phi", "mass", "btagDeepFlavB"]
+
+# jet counts that can be used in the fit preselection, given by the jet masks applied on top of the
+# kinfit_jet mask
+KINFIT_PRESELECTION_COUNTS = {
+    "n_kinfit_jet": (),
+    "n_tight_b": ("tight_b",),
+    "n_loose_b": ("loose_b",),
+}
+
 
 @producer(
     uses={
@@ -95,10 +117,12 @@ def features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     }
     events = self[attach_coffea_behavior](events, jetcollections, **kwargs)
     # events = set_ak_column(events, "ht", (ak.sum(events.Jet.pt, axis=1) + ak.sum(events.VetoJet.pt, axis=1)))
+    central_jet_mask = get_jet_mask(events, self.config_inst, "central")
+    tight_bjet_mask = get_jet_mask(events, self.config_inst, "tight_b")
     events = set_ak_column(
         events,
         "ht_old",
-        (ak.sum(events.Jet[(abs(events.Jet.eta) < 2.4)].pt, axis=1)),
+        (ak.sum(events.Jet[central_jet_mask].pt, axis=1)),
     )
     events = set_ak_column(
         events,
@@ -114,45 +138,32 @@ def features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     events = set_ak_column(
         events,
         "n_event_jet",
-        ak.num(events.Jet[(abs(events.Jet.eta) < 2.4)].pt, axis=1),
+        ak.num(events.Jet[central_jet_mask].pt, axis=1),
         value_type=np.int32,
     )
-    wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
     events = set_ak_column(
         events,
         "n_bjet",
-        ak.sum((events.Jet.btagDeepFlavB >= wp_tight), axis=1),
+        ak.sum(tight_bjet_mask, axis=1),
         value_type=np.int32,
     )
     events = set_ak_column(
         events,
         "n_event_bjet",
-        ak.sum((events.Jet[(abs(events.Jet.eta) < 2.4)
-                           ].btagDeepFlavB >= wp_tight), axis=1),
+        ak.sum(tight_bjet_mask[central_jet_mask], axis=1),
         value_type=np.int32,
     )
     events = set_ak_column(
         events,
         "maxbtag",
-        (ak.max(events.Jet[(abs(events.Jet.eta) < 2.4)
-                           ].btagDeepFlavB, axis=1)),
+        (ak.max(events.Jet[central_jet_mask].btagDeepFlavB, axis=1)),
     )
-    # Insert dummy value for one jet events
-    sel_jet_mask = (abs(events.Jet.eta) < 2.4) & (events.Jet.pt > 40)
-    secmax = ak.sort(
-        (events.Jet[sel_jet_mask])[ak.argsort(
-            events.Jet[sel_jet_mask].pt, axis=1, ascending=False)].btagDeepFlavB,
-        axis=1,
-        ascending=False,
-    )
-    empty = ak.singletons(np.full(len(events), EMPTY_FLOAT))
+    # second highest b-tag score of the selected jets, with a dummy value for events with less jets
+    sel_jet_mask = get_jet_mask(events, self.config_inst, "central", "pt_gt40")
+    secmax = kth_largest(events.Jet.btagDeepFlavB[sel_jet_mask], 2, EMPTY_FLOAT)
     events = set_ak_column(events, "deltaMt", (events.Mt1 - events.Mt2))
 
-    events = set_ak_column(
-        events,
-        "secmaxbtag",
-        (ak.concatenate([secmax, empty, empty], axis=1)[:, 1]),
-    )
+    events = set_ak_column(events, "secmaxbtag", secmax)
     secmax_alt = ak.sort(
         events.Jet.btagDeepFlavB[sel_jet_mask], axis=1, ascending=False)
     empty = ak.singletons(np.full(len(events), EMPTY_FLOAT))
@@ -168,16 +179,17 @@ def features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
         "Jet.phi",
         "Jet.eta",
         "Jet.mass",
+        "run",
+        "luminosityBlock",
         "event",
-        attach_coffea_behavior,
         "Jet.btagDeepFlavB",
-        kinFit,
         "gen_top",
     },
     produces={
         # new columns
-        kinFit,
         "fitCombinationType",
+        "FitInputHash",
+        "FitSkipped",
         "FitW1.*",
         "FitW2.*",
         "FitTop1.*",
@@ -185,87 +197,225 @@ def features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
         # "FitRbb",
         # "Mt1", "Mt2", "MW1", "MW2", "chi2", "deltaRb",
     },
+    # producer performing the fit, added to uses and produces in the init
+    kinfit_cls=kinFit,
+    # whether to reuse the fit results of the nominal shift for shifts that do not change jets,
+    # defaults to the "kinfit_reuse_nominal" option in the law config
+    reuse_nominal=None,
+    # expression of events to fit in addition to the jet requirement, see alljets.expressions, which
+    # can refer to the derived jet counts and to categorizers not using fit outputs, e.g. cat_2btj,
+    # defaults to the kinfit_preselection auxiliary entry of the config
+    preselection=None,
 )
 def kinFitMatch(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
-    from alljets.scripts.default import combinationtype
-
     EF = -99999.0
-    kinFit_jetmask = (events.Jet.pt >= 40.0) & (abs(events.Jet.eta) < 2.4)
-    kinFit_eventmask = ak.sum(kinFit_jetmask, axis=1) >= 6
-    events = self[kinFit](events, kinFit_jetmask, kinFit_eventmask, **kwargs)
-
-    if events.gen_top.ndim > 1:
-        jetcollections = {
-            "FitJet": {
-                "type_name": "Jet",
-                "check_attr": "metric_table",
-                "skip_fields": "",
-            },
-            "FitJet.reco": {
-                "type_name": "Jet",
-                "check_attr": "metric_table",
-                "skip_fields": "",
-            },
+    kinFit_jetmask = get_jet_mask(events, self.config_inst, "kinfit_jet")
+    kinFit_eventmask = ak.to_numpy(ak.sum(kinFit_jetmask, axis=1) >= 6)
+    # events with enough jets that are not fitted due to the preselection
+    skipped = np.zeros(len(events), dtype=bool)
+    if self.preselection_expr is not None:
+        # events failing the preselection keep EMPTY_FLOAT fit outputs without being fitted
+        derived = {
+            name: (lambda masks=masks: ak.sum(get_jet_mask(events, self.config_inst, "kinfit_jet", *masks), axis=1))
+            for name, masks in KINFIT_PRESELECTION_COUNTS.items()
         }
-        events = self[attach_coffea_behavior](events, jetcollections, **kwargs)
-        gen_top = attach_coffea_behavior_fn(events.gen_top, collections={
-            "b": {
-                "type_name": "GenParticle", "check_attr": "metric_table", "skip_fields": "*Idx*G",
-            },
-            "t": {
-                "type_name": "GenParticle", "check_attr": "metric_table", "skip_fields": "*Idx*G",
-            },
-            "w": {
-                "type_name": "GenParticle", "check_attr": "metric_table", "skip_fields": "*Idx*G",
-            },
-            "w_children": {
-                "type_name": "GenParticle", "check_attr": "metric_table", "skip_fields": "*Idx*G",
-            },
+        # categorizers return the events and their mask
+        derived.update({
+            name: (lambda cls=cls: self[cls](events, **kwargs)[1])
+            for name, cls in self.preselection_categorizers.items()
         })
-        fitcomb = combinationtype(
-            events.FitJet.reco[kinFit_eventmask][:, 0],
-            events.FitJet.reco[kinFit_eventmask][:, 1],
-            events.FitJet.reco[kinFit_eventmask][:, 2],
-            events.FitJet.reco[kinFit_eventmask][:, 3],
-            events.FitJet.reco[kinFit_eventmask][:, 4],
-            events.FitJet.reco[kinFit_eventmask][:, 5],
-            gen_top[kinFit_eventmask],
+        presel_mask = self.preselection_expr(events, derived)
+        skipped = kinFit_eventmask & ~presel_mask
+        n_skipped = int(np.sum(skipped))
+        self.presel_skipped += n_skipped
+        self.presel_candidates += int(np.sum(kinFit_eventmask))
+        logger.info(
+            f"fit preselection skipped {n_skipped} of {np.sum(kinFit_eventmask)} events, "
+            f"{self.presel_skipped} of {self.presel_candidates} in total",
         )
-        full_fitcomb = np.full(len(events), EF)
-        full_fitcomb[kinFit_eventmask] = fitcomb
-        events = set_ak_column(events, "fitCombinationType", full_fitcomb)
+        kinFit_eventmask &= presel_mask
+    events = set_ak_column(events, "FitSkipped", skipped)
+    input_hash = content_hash(events.Jet[kinFit_jetmask], KINFIT_INPUT_FIELDS)
+    events = set_ak_column(events, "FitInputHash", input_hash)
+
+    # events with the same jets as in the nominal shift, whose fit and matching results are reused
+    reuse = np.zeros(len(events), dtype=bool)
+    if self.nominal_fit is not None:
+        keys = event_keys(ak.to_numpy(events.run), ak.to_numpy(events.luminosityBlock), ak.to_numpy(events.event))
+        reuse, nominal = _nominal_fit_columns(self.nominal_fit, keys, input_hash)
+        if not np.all(reuse):
+            logger.warning(
+                f"jets of {np.sum(~reuse)} of {len(reuse)} events differ from the nominal shift, refitting them",
+            )
+
+    if np.any(reuse) and np.all(reuse):
+        for column, values in nominal.items():
+            events = set_ak_column(events, column, values)
     else:
-        events = set_ak_column(events, "fitCombinationType", 0)
-        jetcollections = {
-            "FitJet": {
-                "type_name": "Jet",
-                "check_attr": "metric_table",
-                "skip_fields": "",
-            },
-            "FitJet.reco": {
-                "type_name": "Jet",
-                "check_attr": "metric_table",
-                "skip_fields": "",
-            },
-        }
-        events = self[attach_coffea_behavior](events, jetcollections, **kwargs)
-
-    B1 = events.FitJet[:, 0]
-    B2 = events.FitJet[:, 1]
-    W1 = events.FitJet[:, 2].add(events.FitJet[:, 3])
-    W2 = events.FitJet[:, 4].add(events.FitJet[:, 5])
-    Top1 = events.FitJet[:, 0].add(W1)
-    Top2 = events.FitJet[:, 1].add(W2)
-    events = set_ak_column(events, "FitB1", B1)
-    events = set_ak_column(events, "FitB2", B2)
-    events = set_ak_column(events, "FitW1", W1)
-    events = set_ak_column(events, "FitW2", W2)
-    events = set_ak_column(events, "FitTop1", Top1)
-    events = set_ak_column(events, "FitTop2", Top2)
+        fit_eventmask = kinFit_eventmask & ~reuse
+        events = self[self.kinfit_cls](events, kinFit_jetmask, fit_eventmask, **kwargs)
+
+        if events.gen_top.ndim > 1:
+            # matching only needs the raw eta and phi values, no behavior is attached to gen_top
+            fitcomb = combination_type(events.FitJet.reco[fit_eventmask], events.gen_top[fit_eventmask])
+            full_fitcomb = np.full(len(events), EF)
+            full_fitcomb[fit_eventmask] = fitcomb
+            events = set_ak_column(events, "fitCombinationType", full_fitcomb)
+        else:
+            events = set_ak_column(events, "fitCombinationType", 0)
+
+        if np.any(reuse):
+            for column, values in nominal.items():
+                current = events[column]
+                if column == "FitJet":
+                    current = ak.zip({field: current[field] for field in values.fields})
+                events = set_ak_column(events, column, _select_rows(reuse, values, current))
+
+    # FitJets are in order (B1, B2, W1Prod1, W1Prod2, W2Prod1, W2Prod2)
+    fit_jets = FourVectors.from_record(events.FitJet, n=6)
+    W1 = fit_jets[:, 2] + fit_jets[:, 3]
+    W2 = fit_jets[:, 4] + fit_jets[:, 5]
+    Top1 = fit_jets[:, 0] + W1
+    Top2 = fit_jets[:, 1] + W2
+    events = set_ak_column(events, "FitB1", events.FitJet[:, 0])
+    events = set_ak_column(events, "FitB2", events.FitJet[:, 1])
+    events = set_ak_column(events, "FitW1", W1.to_record())
+    events = set_ak_column(events, "FitW2", W2.to_record())
+    events = set_ak_column(events, "FitTop1", Top1.to_record())
+    events = set_ak_column(events, "FitTop2", Top2.to_record())
 
     return events
 
 
+@kinFitMatch.init
+def kinFitMatch_init(self: Producer) -> None:
+    self.uses.add(self.kinfit_cls)
+    self.produces.add(self.kinfit_cls)
+    if self.reuse_nominal is None:
+        self.reuse_nominal = law.config.get_expanded_bool("analysis", "kinfit_reuse_nominal", True)
+    if self.preselection is None:
+        self.preselection = self.config_inst.x("kinfit_preselection", None)
+    self.preselection_expr = None
+    self.preselection_categorizers = {}
+    if self.preselection:
+        # names of categorizers are evaluated by them, which must not depend on the fit itself
+        routes = MaskExpression(self.preselection, derived=KINFIT_PRESELECTION_COUNTS).routes
+        self.preselection_categorizers = {
+            route: Categorizer.get_cls(route)
+            for route in routes
+            if Categorizer.has_cls(route)
+        }
+        fit_columns = {
+            column.split(".")[0]
+            for column in self.produces | self.kinfit_cls.produces
+            if isinstance(column, str)
+        }
+        for name, cls in self.preselection_categorizers.items():
+            used = {column.split(".")[0] for column in cls.uses if isinstance(column, str)} & fit_columns
+            if used:
+                raise ValueError(
+                    f"categorizer '{name}' in the fit preselection uses outputs of the fit: {', '.join(sorted(used))}",
+                )
+        self.preselection_expr = MaskExpression(
+            self.preselection,
+            derived=set(KINFIT_PRESELECTION_COUNTS) | set(self.preselection_categorizers),
+        )
+        self.uses |= self.preselection_expr.routes
+        self.uses |= set(self.preselection_categorizers.values())
+    self.presel_skipped = 0
+    self.presel_candidates = 0
+    # nominal fit results, loaded in the setup if reused
+    self.nominal_fit = None
+
+
+def _reuses_nominal_fit(self: Producer, task: law.Task) -> bool:
+    # only columns produced for mc in a shift that leaves the jets of the nominal shift unchanged
+    from columnflow.tasks.production import ProduceColumns
+
+    shift_inst = getattr(task, "global_shift_inst", None)
+    return (
+        self.reuse_nominal and
+        isinstance(task, ProduceColumns) and
+        self.dataset_inst.is_mc and
+        shift_inst is not None and
+        not shift_inst.is_nominal and
+        not shift_inst.has_tag("disjoint_from_nominal") and
+        not shift_inst.source.startswith(REFIT_SHIFT_SOURCES)
+    )
+
+
+@kinFitMatch.requires
+def kinFitMatch_requires(self: Producer, task: law.Task, reqs: dict) -> None:
+    if "kinfit_nominal" in reqs or not _reuses_nominal_fit(self, task):
+        return
+    reqs["kinfit_nominal"] = task.req(task, shift="nominal")
+
+
+@kinFitMatch.setup
+def kinFitMatch_setup(
+    self: Producer,
+    task: law.Task,
+    reqs: dict,
+    inputs: dict,
+    reader_targets: InsertableDict,
+) -> None:
+    self.nominal_fit = None
+    if not _reuses_nominal_fit(self, task):
+        return
+
+    # fit and matching results of the nominal shift, looked up by run, luminosity block and event number
+    columns = ak.from_parquet(
+        inputs["kinfit_nominal"]["columns"].abspath,
+        columns=[
+            "run", "luminosityBlock", "event", "FitInputHash", "FitJet.*", "FitRecoPhi", "FitChi2", "FitPgof",
+            "FitBackend", "fitCombinationType",
+        ],
+    )
+    keys = event_keys(np.asarray(columns.run), np.asarray(columns.luminosityBlock), np.asarray(columns.event))
+    self.nominal_fit = {
+        "keys": keys,
+        "order": np.argsort(keys, kind="stable"),
+        "columns": columns,
+    }
+
+
+def _nominal_fit_columns(nominal_fit: dict, keys: np.ndarray, input_hash: np.ndarray) -> tuple[np.ndarray, dict]:
+    # mask of the events found in the nominal shift with the same jets and the nominal fit columns of
+    # all events, which are arbitrary for events not in the mask
+    if not len(nominal_fit["keys"]):
+        return np.zeros(len(keys), dtype=bool), {}
+    rows, found = match_rows(nominal_fit["keys"], keys, order=nominal_fit["order"])
+    columns = nominal_fit["columns"][rows]
+    same = found & (np.asarray(columns.FitInputHash) == input_hash)
+    return same, {
+        "FitJet": ak.zip({field: columns.FitJet[field] for field in ("pt", "eta", "phi", "mass")}),
+        "FitRecoPhi": columns.FitRecoPhi,
+        "FitChi2": columns.FitChi2,
+        "FitPgof": columns.FitPgof,
+        "FitBackend": columns.FitBackend,
+        "fitCombinationType": columns.fitCombinationType,
+    }
+
+
+def _select_rows(mask: np.ndarray, a: ak.Array, b: ak.Array) -> ak.Array:
+    # rows of a where mask is set and of b otherwise, also for jagged arrays with different counts
+    index = np.arange(len(mask))
+    return ak.concatenate([a, b], axis=0)[np.where(mask, index, index + len(mask))]
+
+
+# kinematic fit with the numpy backend instead of pyKinFit
+kinFitMatch_numpy = kinFitMatch.derive(
+    "kinFitMatch_numpy",
+    cls_dict={"kinfit_cls": kinFit_numpy},
+)
+
+# kinematic fit on the local fit server
+kinFitMatch_server = kinFitMatch.derive(
+    "kinFitMatch_server",
+    cls_dict={"kinfit_cls": kinFit_server},
+)
+
+
 @producer(
     uses={
         mc_weight,
@@ -313,23 +463,22 @@ def cutflow_features(
     )
     events = set_ak_column(events, "cutflow.n_jet",
                            ak.num(events.Jet.pt, axis=1))
-    wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
     events = set_ak_column(
         events,
         "cutflow.n_bjet",
-        ak.sum((events.Jet.btagDeepFlavB >= wp_tight), axis=1),
+        ak.sum(get_jet_mask(events, self.config_inst, "tight_b"), axis=1),
     )
     return events
 
 
 @producer(
     uses={
+        jet_masks,
         features,
         category_ids,
         normalization_weights,
         muon_weights,
         deterministic_seeds,
-        kinFitMatch,
         gen_top_lookup,
         attach_coffea_behavior,
     },
@@ -339,15 +488,18 @@ def cutflow_features(
         normalization_weights,
         muon_weights,
         deterministic_seeds,
-        kinFitMatch,
         gen_top_lookup,
         "gen_top",
         attach_coffea_behavior,
     },
+    # producer matching and performing the kinematic fit, added to uses and produces in the init
+    kinfit_match_cls=kinFitMatch,
 )
 def example(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     # attach coffea behavior
     events = self[attach_coffea_behavior](events, **kwargs)
+    # jet masks shared by all following producers and categorizers
+    events = self[jet_masks](events, **kwargs)
 
     # features
     if not self.dataset_inst.has_tag("has_top"):
@@ -355,7 +507,7 @@ def example(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
 
     events = self[features](events, **kwargs)
     # apply kinematic fit
-    events = self[kinFitMatch](events, **kwargs)
+    events = self[self.kinfit_match_cls](events, **kwargs)
     # category ids
     events = self[category_ids](events, **kwargs)
 
@@ -375,8 +527,28 @@ def example(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     return events
 
 
+@example.init
+def example_init(self: Producer) -> None:
+    self.uses.add(self.kinfit_match_cls)
+    self.produces.add(self.kinfit_match_cls)
+
+
+# same as example, but running the kinematic fit in the columnar sandbox with the numpy backend
+example_numpy_fit = example.derive(
+    "example_numpy_fit",
+    cls_dict={"kinfit_match_cls": kinFitMatch_numpy},
+)
+
+# same as example, but running the columnar sandbox and sending the fits to the local fit server
+example_server_fit = example.derive(
+    "example_server_fit",
+    cls_dict={"kinfit_match_cls": kinFitMatch_server},
+)
+
+
 @producer(
     uses={
+        jet_masks,
         normalization_weights,
         features,
         category_ids,
@@ -394,6 +566,8 @@ def example(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     },
 )
 def no_norm(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    # jet masks shared by all following producers and categorizers
+    events = self[jet_masks](events, **kwargs)
     # features
     if not self.dataset_inst.has_tag("has_top"):
         events = set_ak_column(events, "gen_top", False)
@@ -402,6 +576,8 @@ def no_norm(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     # fake kinfit for trig weights creation
     events = set_ak_column(events, "FitChi2", 0)
     events = set_ak_column(events, "FitPgof", 1)
+    events = set_ak_column(events, "FitSkipped", False)
+    events = set_ak_column(events, "FitBackend", -1)
     events = set_ak_column(events, "fitCombinationType", 2)
     events = set_ak_column(events, "FitRbb", 0)
     # category ids
@@ -426,66 +602,36 @@ def no_norm(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     return events
 
 
+# number of bits per trigger category in the trig_mask column
+TRIG_MASK_BITS = 32
+
+
 @producer(
-    produces={"trig_bits", "trig_bits_orth"},
+    produces={"trig_mask"},
     channel=["tt_fh"],
 )
 def trigger_prod(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     """
-    Produces column where each bin corresponds to a certain trigger
+    Produces a bit-packed uint64 column ``trig_mask`` with the decisions of all configured triggers.
+    Bit *i* of the lower 32 bits is set when the *i*-th trigger fired, the same bit of the upper 32
+    bits when both the reference trigger and the *i*-th trigger fired. Bit 0 of both halves is always
+    set and corresponds to the inclusive entry. The variables ``trig_bits`` and ``trig_bits_orth``
+    expand the two halves into one histogram entry per set bit.
     """
-
-    arr = ak.singletons(np.zeros(len(events)))
-    arr_orth = ak.singletons(np.zeros(len(events)))
-
-    id = 1
+    # decisions per bit, starting with the inclusive entry
+    passed = [np.ones(len(events), dtype=bool)]
+    passed_ref = [np.ones(len(events), dtype=bool)]
 
     for channel in self.channel:
-        ref_trig = self.config_inst.x.ref_trigger[channel]
+        ref_passed = np.asarray(events.HLT[self.config_inst.x.ref_trigger[channel]], dtype=bool)
         for trigger in self.config_inst.x.trigger[channel]:
-            trig_passed = ak.singletons(
-                ak.flatten(
-                    ak.nan_to_none(
-                        ak.unzip(
-                            ak.where(events.HLT[trigger], id, np.float64(np.nan))),
-                    ),
-                ),
-            )
-            trig_passed_orth = ak.flatten(
-                ak.singletons(
-                    ak.nan_to_none(
-                        ak.where(
-                            ak.singletons(ak.flatten(ak.unzip(events.HLT[ref_trig]))) &
-                            ak.singletons(ak.flatten(
-                                ak.unzip(events.HLT[trigger]))),
-                            id,
-                            np.float64(np.nan),
-                        ),
-                    ),
-                ),
-                axis=1,
-            )
-            # trig_passed_orth = ak.singletons(ak.nan_to_none(
-            #     ak.where((events.HLT[ref_trig] & events.HLT[trigger]), id, np.float64(np.nan))
-            # ))
-            arr = ak.concatenate([arr, trig_passed], axis=1)
-            arr_orth = ak.concatenate([arr_orth, trig_passed_orth], axis=1)
-            id += 1
-
-    """ for channel, trig_cols in self.config_inst.x.trigger.items():
-        for trig_col in trig_cols:
-            trig_passed = ak.singletons(ak.nan_to_none(
-                ak.where(events.HLT[trig_col], id, np.float64(np.nan))
-            ))
-            trig_passed_orth = ak.singletons(ak.nan_to_none(
-                ak.where((events.HLT[ref_trig] & events.HLT[trig_col]), id, np.float64(np.nan))
-            ))
-            arr = ak.concatenate([arr, trig_passed], axis=1)
-            arr_orth = ak.concatenate([arr_orth, trig_passed_orth], axis=1)
-            id += 1 """
-
-    events = set_ak_column(events, "trig_bits", arr)
-    events = set_ak_column(events, "trig_bits_orth", arr_orth)
+            passed.append(np.asarray(events.HLT[trigger], dtype=bool))
+            passed_ref.append(passed[-1] & ref_passed)
+
+    if len(passed) > TRIG_MASK_BITS:
+        raise ValueError(f"cannot pack more than {TRIG_MASK_BITS - 1} triggers into trig_mask")
+    mask = pack_bitmask(passed) | pack_bitmask(passed_ref, shift=TRIG_MASK_BITS)
+    events = set_ak_column(events, "trig_mask", mask)
 
     return events
 
@@ -496,7 +642,7 @@ def trigger_prod_init(self: Producer) -> None:
     for channel in self.channel:
         for trigger in self.config_inst.x.trigger[channel]:
             self.uses.add(f"HLT.{trigger}")
-        self.uses.add(f"HLT{self.config_inst.x.ref_trigger[channel]}")
+        self.uses.add(f"HLT.{self.config_inst.x.ref_trigger[channel]}")
 
 
 # producers for single channels
@@ -529,6 +675,7 @@ tt_fh_trigger_prod = trigger_prod.derive(
 
 @producer(
     uses={
+        jet_masks,
         features,
         # category_ids,
         normalization_weights,
@@ -553,6 +700,8 @@ tt_fh_trigger_prod = trigger_prod.derive(
 def example_no_kinfit(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     # attach coffea behavior
     events = self[attach_coffea_behavior](events, **kwargs)
+    # jet masks shared by all following producers
+    events = self[jet_masks](events, **kwargs)
     # features
     events = self[features](events, **kwargs)
     # apply kinematic fit
@@ -579,20 +728,17 @@ def example_no_kinfit(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     produces={"n_jet_in_event", "n_bjet_in_event"},
 )
 def njets(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
-    wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
+    jet_mask = get_jet_mask(events, self.config_inst, "central", "pt_gt40")
     events = set_ak_column(
         events,
         "n_jet_in_event",
-        ak.num(events.Jet[(abs(events.Jet.eta) < 2.4)
-               & (events.Jet.pt > 40)].pt, axis=1),
+        ak.sum(jet_mask, axis=1),
         value_type=np.int32,
     )
     events = set_ak_column(
         events,
         "n_bjet_in_event",
-        ak.num(events.Jet[(abs(events.Jet.eta) < 2.4) &
-                          (events.Jet.pt > 40) &
-                          (events.Jet.btagDeepFlavB >= wp_tight)].pt, axis=1),
+        ak.sum(jet_mask & get_jet_mask(events, self.config_inst, "tight_b"), axis=1),
         value_type=np.int32,
     )
     return events
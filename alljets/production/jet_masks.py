@@ -0,0 +1,108 @@
+# coding: utf-8
+
+"""
+Registry of jet masks shared between selectors, producers and categorizers.
+
+Masks are computed once per chunk by the :py:func:`jet_masks` producer and stored as bits of the
+in-memory column ``Jet.mask_bits``, which is not written to disk. :py:func:`get_jet_mask` reads
+them by name and falls back to computing them directly if the column is not present.
+"""
+
+from __future__ import annotations
+
+import order as od
+
+from columnflow.columnar_util import flat_np_view, has_ak_column, set_ak_column
+from columnflow.production import Producer, producer
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# bit positions of the registered masks
+JET_MASK_BITS = {
+    # central jets
+    "central": 0,
+    # jets considered in the reconstruction and kinematic fit
+    "kinfit_jet": 1,
+    # b-tagged jets, tight and loose deepjet working points
+    "tight_b": 2,
+    "loose_b": 3,
+    # jets within the trigger acceptance
+    "trigger_jet": 4,
+    # jets with pt strictly above 40 GeV, as required by the features and njets producers
+    "pt_gt40": 5,
+}
+
+
+def _compute_masks(
+    config_inst: od.Config,
+    names: set[str],
+    jets: ak.Array,
+) -> dict[str, np.ndarray]:
+    # flat mask definitions, evaluated only when requested and only reading the required columns
+    wps = config_inst.x.btag_working_points.deepjet
+
+    def abs_eta():
+        return np.abs(flat_np_view(jets.eta))
+
+    definitions = {
+        "central": lambda: abs_eta() < 2.4,
+        "kinfit_jet": lambda: (abs_eta() < 2.4) & (flat_np_view(jets.pt) >= 40.0),
+        "tight_b": lambda: flat_np_view(jets.btagDeepFlavB) >= wps.tight,
+        "loose_b": lambda: flat_np_view(jets.btagDeepFlavB) >= wps.loose,
+        "trigger_jet": lambda: abs_eta() < 2.6,
+        "pt_gt40": lambda: flat_np_view(jets.pt) > 40.0,
+    }
+    return {name: definitions[name]() for name in names}
+
+
+def get_jet_mask(
+    events: ak.Array,
+    config_inst: od.Config,
+    *names: str,
+) -> ak.Array:
+    """
+    Returns the jagged logical AND of the registered jet masks *names*, e.g.
+
+    .. code-block:: python
+
+        bjet_mask = get_jet_mask(events, self.config_inst, "kinfit_jet", "tight_b")
+
+    The masks are read from the ``Jet.mask_bits`` column when it was created by
+    :py:func:`jet_masks` before, and computed from the jet columns otherwise.
+    """
+    unknown = set(names) - set(JET_MASK_BITS)
+    if unknown:
+        raise ValueError(f"unknown jet masks: {', '.join(sorted(unknown))}")
+
+    counts = ak.num(events.Jet.pt, axis=1)
+    if has_ak_column(events, "Jet.mask_bits"):
+        bits = flat_np_view(events.Jet.mask_bits)
+        want = np.uint8(sum(1 << JET_MASK_BITS[name] for name in names))
+        return ak.unflatten((bits & want) == want, counts)
+
+    masks = _compute_masks(config_inst, set(names), events.Jet)
+    mask = np.ones(int(ak.sum(counts)), dtype=bool)
+    for name in names:
+        mask &= masks[name]
+    return ak.unflatten(mask, counts)
+
+
+@producer(
+    uses={"Jet.pt", "Jet.eta", "Jet.btagDeepFlavB"},
+    produces={"Jet.mask_bits"},
+)
+def jet_masks(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Computes all registered jet masks in a single pass over the flat jet columns and packs them into
+    the uint8 column ``Jet.mask_bits``. Callers should add this producer to their *uses* only, so
+    that the column stays in memory for the masks requested via :py:func:`get_jet_mask` later on.
+    """
+    masks = _compute_masks(self.config_inst, set(JET_MASK_BITS), events.Jet)
+    bits = np.zeros(len(masks["central"]), dtype=np.uint8)
+    for name, bit in JET_MASK_BITS.items():
+        bits |= masks[name].astype(np.uint8) << np.uint8(bit)
+
+    return set_ak_column(events, "Jet.mask_bits", ak.unflatten(bits, ak.num(events.Jet.pt, axis=1)))
@@ -0,0 +1,384 @@
+# coding: utf-8
+
+"""
+Vectorized numpy implementation of the fully hadronic ttbar kinematic fit.
+
+The fit varies (pt, eta, phi) of the six jets of a hypothesis within their resolutions such that
+both dijet masses match the W boson mass and both top quark candidates have equal masses. The
+constrained chi2 is minimized with iterated Lagrange multipliers, evaluated simultaneously for all
+events and jet permutations of a batch.
+"""
+
+from __future__ import annotations
+
+import functools
+import itertools
+
+from columnflow.util import maybe_import
+
+from alljets.fourvector import FourVectors
+from alljets.selection.reco import MASS_CHI2
+
+np = maybe_import("numpy")
+
+# jets per hypothesis, ordered as (B1, B2, W1Prod1, W1Prod2, W2Prod1, W2Prod2)
+N_FIT_JETS = 6
+
+# number of constraints, i.e., degrees of freedom of the fit chi2
+N_CONSTRAINTS = 3
+
+# chi2 assigned to events without any converged permutation, see cat_fit_nconv
+NCONV_CHI2 = 10000.0
+
+# default jet resolution parameters, sigma_pt / pt = sqrt((N / pt)^2 + S^2 / pt + C^2)
+DEFAULT_RESOLUTION = {
+    "pt_noise": 5.0,
+    "pt_stochastic": 1.0,
+    "pt_constant": 0.05,
+    "eta": 0.04,
+    "phi": 0.04,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def permutation_table(n_jets: int) -> np.ndarray:
+    """
+    Returns the jet indices of all distinct fit hypotheses that can be built from *n_jets* jets,
+    with shape ``(n_perms, 6)``. As in pyKinFit, every jet can take every role. Swapping the jets of
+    a W candidate, or both b jets together with their W candidates, yields the same hypothesis, so
+    each one is listed once with the b jet of lower index first. There are ``n! / ((n - 6)! * 8)``
+    hypotheses, e.g., 90 for six, 2520 for eight and 18900 for ten jets.
+    """
+    perms = []
+    for b1, b2 in itertools.combinations(range(n_jets), 2):
+        others = [j for j in range(n_jets) if j not in (b1, b2)]
+        for light in itertools.combinations(others, 4):
+            for w1 in itertools.combinations(light, 2):
+                w2 = tuple(j for j in light if j not in w1)
+                perms.append((b1, b2) + w1 + w2)
+
+    perms = np.array(perms, dtype=np.int32).reshape(-1, N_FIT_JETS)
+    perms.flags.writeable = False
+    return perms
+
+
+def mass_chi2(hyp: np.ndarray, **params) -> np.ndarray:
+    """
+    Returns the mass chi2 of the jet selection for hypotheses *hyp* of unfitted jets, given with
+    last axes ``(6, 4)`` in the fit order and fields ``(pt, eta, phi, mass)``. Parameters default to
+    :py:data:`alljets.selection.reco.MASS_CHI2` and can be changed with *params*. As in the jet
+    selection, the top quark candidate with the harder b jet is the first one.
+
+    Other than in the jet selection, which takes the two b jets from the b-tags and only assigns the
+    light jets, the hypotheses of the :py:func:`permutation_table` let every jet take every role, as
+    in the fit. Ranked this way, the chi2 therefore does not use any b-tag information, and its best
+    hypothesis can differ from the one of the jet selection.
+    """
+    p = dict(MASS_CHI2, **params)
+    p4 = FourVectors.from_ptetaphim(*(hyp[..., i] for i in range(4)))
+    w1 = p4[..., 2] + p4[..., 3]
+    w2 = p4[..., 4] + p4[..., 5]
+    t1 = p4[..., 0] + w1
+    t2 = p4[..., 1] + w2
+
+    first = hyp[..., 0, 0] > hyp[..., 1, 0]
+    mw1, mw2 = np.where(first, w1.mass, w2.mass), np.where(first, w2.mass, w1.mass)
+    mt1, mt2 = np.where(first, t1.mass, t2.mass), np.where(first, t2.mass, t1.mass)
+    return (
+        (mw1 - p["mw"] - p["mu_w"]) ** 2 / p["mw_sigma"] ** 2 +
+        (mw2 - p["mw"] - p["mu_w"]) ** 2 / p["mw_sigma"] ** 2 +
+        (mt1 - mt2 - p["mu_tt"]) ** 2 / p["mt_sigma"] ** 2
+    )
+
+
+def _four_vectors(
+    params: np.ndarray,
+    mass: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    # params: (..., 3) with (pt, eta, phi), mass: (...)
+    pt, eta, phi = params[..., 0], params[..., 1], params[..., 2]
+    cos_phi, sin_phi = np.cos(phi), np.sin(phi)
+    cosh_eta, sinh_eta = np.cosh(eta), np.sinh(eta)
+    e = np.sqrt((pt * cosh_eta) ** 2 + mass ** 2)
+
+    # components ordered as (e, px, py, pz)
+    p4 = np.stack([e, pt * cos_phi, pt * sin_phi, pt * sinh_eta], axis=-1)
+
+    # derivatives with respect to (pt, eta, phi), shape (..., 3, 4)
+    zero = np.zeros_like(pt)
+    dp4 = np.stack([
+        np.stack([pt * cosh_eta ** 2 / e, cos_phi, sin_phi, sinh_eta], axis=-1),
+        np.stack([pt ** 2 * cosh_eta * sinh_eta / e, zero, zero, pt * cosh_eta], axis=-1),
+        np.stack([zero, -pt * sin_phi, pt * cos_phi, zero], axis=-1),
+    ], axis=-2)
+
+    return p4, dp4
+
+
+def _mass(p4: np.ndarray) -> np.ndarray:
+    m2 = p4[..., 0] ** 2 - p4[..., 1] ** 2 - p4[..., 2] ** 2 - p4[..., 3] ** 2
+    return np.sqrt(np.maximum(m2, 1e-6))
+
+
+def _constraints(
+    params: np.ndarray,
+    mass: np.ndarray,
+    mw: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    # params: (..., 6, 3), mass: (..., 6)
+    p4, dp4 = _four_vectors(params, mass)
+    w1 = p4[..., 2, :] + p4[..., 3, :]
+    w2 = p4[..., 4, :] + p4[..., 5, :]
+    t1 = p4[..., 0, :] + w1
+    t2 = p4[..., 1, :] + w2
+    m_w1, m_w2, m_t1, m_t2 = _mass(w1), _mass(w2), _mass(t1), _mass(t2)
+
+    f = np.stack([m_w1 - mw, m_w2 - mw, m_t1 - m_t2], axis=-1)
+
+    # gradient of a composite mass with respect to the parameters of all jets, (..., 6, 3)
+    metric = np.array([1.0, -1.0, -1.0, -1.0])
+
+    def grad(composite, m, jets):
+        g = np.einsum("...k,...jpk->...jp", composite * metric, dp4) / m[..., None, None]
+        member = np.zeros(N_FIT_JETS)
+        member[list(jets)] = 1.0
+        return g * member[:, None]
+
+    d = np.stack([
+        grad(w1, m_w1, (2, 3)),
+        grad(w2, m_w2, (4, 5)),
+        grad(t1, m_t1, (0, 2, 3)) - grad(t2, m_t2, (1, 4, 5)),
+    ], axis=-3)
+
+    # flatten jet and parameter axes, (..., 3, 18)
+    return f, d.reshape(d.shape[:-2] + (-1,))
+
+
+def fit_prob(chi2: np.ndarray, ndf: int = N_CONSTRAINTS) -> np.ndarray:
+    """
+    Goodness-of-fit probability of *chi2* for *ndf* degrees of freedom, i.e., the chi2 survival
+    function, equivalent to ``TMath::Prob(chi2, ndf)``.
+    """
+    from scipy.special import gammaincc
+
+    return gammaincc(ndf / 2, np.maximum(np.asarray(chi2, dtype=np.float64), 0.0) / 2)
+
+
+def _batches(rows: np.ndarray, n_perms: int, max_hypotheses: int):
+    # splits rows into batches of at most max_hypotheses hypotheses
+    batch_size = max(1, max_hypotheses // max(n_perms, 1))
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+def _effective_counts(jets: np.ndarray, counts: np.ndarray, max_jets: int | None) -> np.ndarray:
+    # number of jets per event entering the fit
+    counts = np.minimum(np.asarray(counts, dtype=np.int64), jets.shape[1])
+    return counts if max_jets is None else np.minimum(counts, max_jets)
+
+
+def _fit_hypotheses(
+    hyp: np.ndarray,
+    mw: float,
+    res: dict[str, float],
+    max_iter: int,
+    tolerance: float,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fits the hypotheses *hyp* with shape ``(n, n_perms, 6, 4)`` and returns the fitted and measured
+    ``(pt, eta, phi)`` of all jets with shape ``(n, n_perms, 18)`` and the chi2, which is infinite
+    for hypotheses that did not converge.
+    """
+    y0 = hyp[..., :3]
+    mass = hyp[..., 3]
+
+    # diagonal covariance, flattened over events and hypotheses
+    pt = np.maximum(y0[..., 0], 1.0)
+    var = np.stack([
+        pt ** 2 * ((res["pt_noise"] / pt) ** 2 + res["pt_stochastic"] ** 2 / pt + res["pt_constant"] ** 2),
+        np.full_like(pt, res["eta"] ** 2),
+        np.full_like(pt, res["phi"] ** 2),
+    ], axis=-1).reshape(-1, N_FIT_JETS * 3)
+    y0_flat = y0.reshape(var.shape)
+    mass_flat = mass.reshape(-1, N_FIT_JETS)
+
+    # iterate linearized constraints, only for hypotheses that did not converge yet
+    y = y0_flat.copy()
+    converged = np.zeros(len(y), dtype=bool)
+    active = np.arange(len(y))
+    for i in range(max_iter + 1):
+        if not len(active):
+            break
+        f, d = _constraints(y[active].reshape(-1, N_FIT_JETS, 3), mass_flat[active], mw)
+        done = np.all(np.abs(f) < tolerance, axis=-1) & np.all(np.isfinite(y[active]), axis=-1)
+        converged[active[done]] = True
+        if i == max_iter:
+            break
+        active, f, d = active[~done], f[~done], d[~done]
+        _y0, _var = y0_flat[active], var[active]
+        r = f + np.einsum("...ai,...i->...a", d, _y0 - y[active])
+        s = np.einsum("...ai,...i,...bi->...ab", d, _var, d) + 1e-9 * np.eye(N_CONSTRAINTS)
+        lam = np.linalg.solve(s, r[..., None])[..., 0]
+        _y = _y0 - _var * np.einsum("...ai,...a->...i", d, lam)
+        # keep transverse momenta physical
+        _y[:, 0::3] = np.maximum(_y[:, 0::3], 1e-3)
+        y[active] = _y
+
+    chi2 = np.where(converged, np.sum((y - y0_flat) ** 2 / var, axis=-1), np.inf)
+    shape = hyp.shape[:2]
+    return y.reshape(shape + (-1,)), y0_flat.reshape(shape + (-1,)), chi2.reshape(shape)
+
+
+def fit_numpy(
+    jets: np.ndarray,
+    counts: np.ndarray,
+    max_jets: int | None = None,
+    mw: float = 80.4,
+    resolution: dict[str, float] | None = None,
+    max_iter: int = 30,
+    tolerance: float = 1e-3,
+    max_hypotheses: int = 100000,
+    top_k: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Runs the constrained kinematic fit for all hypotheses of the :py:func:`permutation_table` of
+    each event and returns the best one per event. The interface is identical to the pyKinFit
+    backend of :py:func:`alljets.production.KinFit.kinfit_batch`, i.e., *jets* is a padded block of
+    shape ``(n_events, n_max, 4)`` with fields ``(pt, eta, phi, mass)`` and *counts* the number of
+    valid jets per event. All valid jets enter the fit, unless *max_jets* limits them to the
+    leading ones.
+
+    Events are grouped by their number of jets and processed in batches of at most
+    *max_hypotheses* hypotheses to bound the memory of the intermediate ``(n, n_perms, 3, 18)``
+    jacobians. The runtime grows with the number of hypotheses, about 5, 25, 95, 300 and 800 ms per
+    event for six to ten jets on a single core, and batches hold only five events at ten jets and a
+    single one from twelve jets on. Large jet multiplicities therefore need *max_jets* or *top_k*.
+    Hypotheses whose constraints are not satisfied to within *tolerance* (in GeV) after
+    *max_iter* iterations are considered as not converged. Events without any converged hypothesis,
+    including those with less than six jets, obtain a chi2 of :py:attr:`NCONV_CHI2` and their
+    unchanged leading jets.
+
+    The result differs from pyKinFit in the jet resolutions, which are the simple parametrization
+    in :py:attr:`DEFAULT_RESOLUTION` unless given by *resolution*, and in the minimization and
+    convergence criterion, so that fitted values and chi2 agree only approximately and the best
+    hypothesis can differ when two hypotheses have similar chi2. The kinFit producer therefore
+    records the backend in the ``FitBackend`` column.
+
+    When *top_k* is set, hypotheses are ranked by the :py:func:`mass_chi2` of the unfitted jets and
+    only the *top_k* best ones per event are fitted. The result differs from the fit of all
+    hypotheses in events whose best fitted hypothesis is not among them, see
+    :py:func:`top_k_misses`.
+    """
+    res = dict(DEFAULT_RESOLUTION, **(resolution or {}))
+    jets = np.asarray(jets)
+    counts = _effective_counts(jets, counts, max_jets)
+
+    n_events = len(jets)
+    fit_jets = np.zeros((n_events, N_FIT_JETS, 4), dtype=np.float32)
+    fit_jets[:, :jets.shape[1]] = jets[:, :N_FIT_JETS]
+    indices = np.tile(np.arange(N_FIT_JETS, dtype=np.int32), (n_events, 1))
+    chi2 = np.full(n_events, NCONV_CHI2, dtype=np.float64)
+
+    for n_jets in np.unique(counts[counts >= N_FIT_JETS]):
+        perms = permutation_table(int(n_jets))
+        k = len(perms) if top_k is None else min(top_k, len(perms))
+        for rows in _batches(np.flatnonzero(counts == n_jets), len(perms), max_hypotheses):
+            _jets = np.asarray(jets[rows, :n_jets], dtype=np.float64)
+
+            # jet indices of the hypotheses to fit per event, (n, n_perms, 6)
+            ev_perms = np.broadcast_to(perms, (len(rows),) + perms.shape)
+            if k < len(perms):
+                # keep the k hypotheses with the smallest mass chi2, in the order of the table
+                sel = np.argpartition(mass_chi2(_jets[:, perms]), k - 1, axis=1)[:, :k]
+                ev_perms = perms[np.sort(sel, axis=1)]
+
+            hyp = _jets[np.arange(len(rows))[:, None, None], ev_perms]
+            y, y0, _chi2 = _fit_hypotheses(hyp, mw, res, max_iter, tolerance)
+
+            # pick the best hypothesis, falling back to the first one when nothing converged
+            best = np.argmin(_chi2, axis=1)
+            ar = np.arange(len(rows))
+            best_chi2 = _chi2[ar, best]
+            converged = np.isfinite(best_chi2)
+            fit_jets[rows, :, :3] = np.where(converged[:, None], y[ar, best], y0[ar, best]).reshape(-1, N_FIT_JETS, 3)
+            fit_jets[rows, :, 3] = hyp[ar, best, :, 3]
+            indices[rows] = ev_perms[ar, best]
+            chi2[rows] = np.where(converged, best_chi2, NCONV_CHI2)
+
+    pgof = np.where(chi2 < NCONV_CHI2, fit_prob(chi2), 0.0)
+
+    return fit_jets, indices, chi2, pgof
+
+
+def top_k_jet_sets(
+    jets: np.ndarray,
+    counts: np.ndarray,
+    top_k: int,
+    max_jets: int | None = None,
+    max_hypotheses: int = 100000,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the distinct sets of six jets of the *top_k* hypotheses with the smallest
+    :py:func:`mass_chi2` per event, for fits that cannot be restricted to single hypotheses but only
+    to the jets they are given, such as pyKinFit. Returns the event row of each set and its jet
+    indices in ascending order, with shapes ``(n_sets,)`` and ``(n_sets, 6)``. Events with at most
+    *top_k* hypotheses, or less than six jets, are not contained and need to be fitted with all jets.
+    """
+    jets = np.asarray(jets)
+    counts = _effective_counts(jets, counts, max_jets)
+
+    rows_list, sets_list = [np.zeros(0, dtype=np.int64)], [np.zeros((0, N_FIT_JETS), dtype=np.int32)]
+    for n_jets in np.unique(counts[counts >= N_FIT_JETS]):
+        perms = permutation_table(int(n_jets))
+        if top_k >= len(perms):
+            continue
+        # jets of each hypothesis as bit mask
+        perm_bits = np.sum(np.left_shift(np.int64(1), perms.astype(np.int64)), axis=1)
+        for rows in _batches(np.flatnonzero(counts == n_jets), len(perms), max_hypotheses):
+            rank_chi2 = mass_chi2(np.asarray(jets[rows, :n_jets], dtype=np.float64)[:, perms])
+            sel = np.argpartition(rank_chi2, top_k - 1, axis=1)[:, :top_k]
+
+            # keep each set of jets once per event
+            bits = np.sort(perm_bits[sel], axis=1)
+            new = np.ones(bits.shape, dtype=bool)
+            new[:, 1:] = bits[:, 1:] != bits[:, :-1]
+            ev, pos = np.nonzero(new)
+            _, jet_index = np.nonzero((bits[ev, pos, None] >> np.arange(n_jets)) & 1)
+            rows_list.append(rows[ev])
+            sets_list.append(jet_index.reshape(-1, N_FIT_JETS).astype(np.int32))
+
+    return np.concatenate(rows_list), np.concatenate(sets_list, axis=0)
+
+
+def top_k_misses(
+    jets: np.ndarray,
+    counts: np.ndarray,
+    top_k: int,
+    max_jets: int | None = None,
+    max_hypotheses: int = 100000,
+    **kwargs,
+) -> tuple[int, int]:
+    """
+    Fits all hypotheses of the padded *jets* with *counts* valid jets per event and returns the
+    number of events whose best hypothesis is not among the *top_k* hypotheses with the smallest
+    :py:func:`mass_chi2`, i.e., for which :py:func:`fit_numpy` with *top_k* misses the optimum, and
+    the number of events with a converged fit. *max_jets*, *max_hypotheses* and *kwargs* are
+    forwarded to :py:func:`fit_numpy`.
+    """
+    jets = np.asarray(jets)
+    counts = _effective_counts(jets, counts, max_jets)
+    _, indices, chi2, _ = fit_numpy(jets, counts, max_hypotheses=max_hypotheses, **kwargs)
+    converged = chi2 < NCONV_CHI2
+
+    missed = 0
+    for n_jets in np.unique(counts[converged]):
+        perms = permutation_table(int(n_jets))
+        if top_k >= len(perms):
+            continue
+        for rows in _batches(np.flatnonzero(converged & (counts == n_jets)), len(perms), max_hypotheses):
+            rank_chi2 = mass_chi2(np.asarray(jets[rows, :n_jets], dtype=np.float64)[:, perms])
+            best = np.argmax(np.all(perms[None] == indices[rows, None], axis=2), axis=1)
+            rank = np.sum(rank_chi2 < rank_chi2[np.arange(len(rows)), best][:, None], axis=1)
+            missed += int(np.sum(rank >= top_k))
+
+    return missed, int(np.sum(converged))
@@ -0,0 +1,283 @@
+# coding: utf-8
+
+"""
+Local kinematic fit server, started once per node inside the CMSSW sandbox.
+
+Producers running in the columnar sandbox hand their jet batches to the server instead of running
+the fit themselves, so that the CMSSW environment setup and the pyKinFit import are paid once per
+node rather than once per task branch. Batches are exchanged as raw numpy buffers in a shared memory
+block allocated by the client, and a Unix socket only carries a short json message per batch:
+
+- the client writes the padded jets and their counts into the block and sends its name and shape,
+- the server attaches to the block, runs :py:func:`alljets.production.KinFit.kinfit_batch` and
+  writes the results into the output section of the same block,
+- the server replies with a status message, after which the client copies the results and unlinks
+  the block.
+
+The server handles one batch at a time, concurrent clients wait in the socket backlog. Fits of a
+batch are spread over *workers* processes as for the kinFit producer. Start it with
+
+.. code-block:: bash
+
+    cf_sandbox sandboxes/cmsswtest.sh python -m alljets.production.kinfit_server --workers 8
+
+and use the ``kinFit_server`` producer (or ``example_server_fit``) in the columnar sandbox. The
+socket path is taken from the ``kinfit_server_socket`` option in the law config.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import traceback
+from multiprocessing import shared_memory
+
+import law
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+
+logger = law.logger.get_logger(__name__)
+
+# jets per hypothesis, see alljets.production.KinFit.N_FIT_JETS
+N_FIT_JETS = 6
+
+# maximum size of a json message
+MAX_MESSAGE_SIZE = 65536
+
+
+def default_socket_path() -> str:
+    """
+    Returns the path of the server socket, given by the ``kinfit_server_socket`` option in the law
+    config and defaulting to a per-user file in the temporary directory.
+    """
+    default = os.path.join(tempfile.gettempdir(), f"alljets_kinfit_{os.getuid()}.sock")
+    return law.config.get_expanded("analysis", "kinfit_server_socket", None) or default
+
+
+def buffer_layout(n_events: int, n_max: int) -> tuple[dict[str, tuple[int, tuple[int, ...], type]], int]:
+    """
+    Returns the offset, shape and dtype of the input and output arrays in the shared memory block of
+    a batch of *n_events* events with up to *n_max* jets, and the total size of the block in bytes.
+    """
+    arrays = {
+        # inputs
+        "jets": ((n_events, n_max, 4), np.float32),
+        "counts": ((n_events,), np.int64),
+        # outputs
+        "fit_jets": ((n_events, N_FIT_JETS, 4), np.float32),
+        "indices": ((n_events, N_FIT_JETS), np.int32),
+        "chi2": ((n_events,), np.float64),
+        "pgof": ((n_events,), np.float64),
+    }
+    layout = {}
+    offset = 0
+    for name, (shape, dtype) in arrays.items():
+        layout[name] = (offset, shape, dtype)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        # keep all arrays 8-byte aligned
+        offset += (size + 7) // 8 * 8
+    return layout, max(offset, 1)
+
+
+def buffer_views(shm: shared_memory.SharedMemory, n_events: int, n_max: int) -> dict[str, np.ndarray]:
+    layout, _ = buffer_layout(n_events, n_max)
+    return {
+        name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        for name, (offset, shape, dtype) in layout.items()
+    }
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # attach to a block owned by the client, without registering it for cleanup in this process
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _send(sock: socket.socket, message: dict) -> None:
+    sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+
+def _receive(rfile) -> dict:
+    line = rfile.readline(MAX_MESSAGE_SIZE)
+    if not line:
+        raise ConnectionError("connection closed by kinematic fit server")
+    return json.loads(line)
+
+
+def fit_remote(
+    jets: np.ndarray,
+    counts: np.ndarray,
+    socket_path: str | None = None,
+    top_k: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Fits the padded *jets* with *counts* valid jets per event on the server listening at
+    *socket_path*, with the same interface as the backends of
+    :py:func:`alljets.production.KinFit.kinfit_batch`.
+    """
+    socket_path = socket_path or default_socket_path()
+    n_events, n_max = jets.shape[:2]
+    _, size = buffer_layout(n_events, n_max)
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    views = None
+    try:
+        views = buffer_views(shm, n_events, n_max)
+        views["jets"][...] = jets
+        views["counts"][...] = counts
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                raise RuntimeError(
+                    f"no kinematic fit server listening at {socket_path}, start it with "
+                    "'cf_sandbox sandboxes/cmsswtest.sh python -m alljets.production.kinfit_server'",
+                ) from e
+            _send(sock, {"op": "fit", "shm": shm.name, "n_events": n_events, "n_max": n_max, "top_k": top_k})
+            with sock.makefile("rb") as rfile:
+                reply = _receive(rfile)
+        if reply["status"] != "ok":
+            raise RuntimeError(f"kinematic fit server failed: {reply.get('message')}")
+
+        return tuple(views[name].copy() for name in ("fit_jets", "indices", "chi2", "pgof"))
+    finally:
+        # release the views before closing the block
+        views = None
+        shm.close()
+        shm.unlink()
+
+
+class FitRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self) -> None:
+        try:
+            request = _receive(self.rfile)
+            if request["op"] == "ping":
+                reply = {"status": "ok", "backend": self.server.backend, "workers": self.server.n_workers}
+            elif request["op"] == "stop":
+                reply = {"status": "ok"}
+                # shutdown blocks until serve_forever returns, so it cannot be called from here
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            elif request["op"] == "fit":
+                self.fit(request["shm"], int(request["n_events"]), int(request["n_max"]), request.get("top_k"))
+                reply = {"status": "ok"}
+            else:
+                reply = {"status": "error", "message": f"unknown operation '{request['op']}'"}
+        except Exception as e:
+            logger.error(traceback.format_exc())
+            reply = {"status": "error", "message": f"{type(e).__name__}: {e}"}
+        _send(self.connection, reply)
+
+    def fit(self, name: str, n_events: int, n_max: int, top_k: int | None = None) -> None:
+        from alljets.production.KinFit import kinfit_batch
+
+        shm = _attach(name)
+        views = None
+        try:
+            views = buffer_views(shm, n_events, n_max)
+            if n_events:
+                results = kinfit_batch(
+                    views["jets"],
+                    counts=views["counts"],
+                    backend=self.server.backend,
+                    n_workers=self.server.n_workers,
+                    top_k=top_k,
+                )
+                for key, values in zip(("fit_jets", "indices", "chi2", "pgof"), results):
+                    views[key][...] = values
+            self.server.n_batches += 1
+            self.server.n_events += n_events
+        finally:
+            views = None
+            shm.close()
+
+
+class FitServer(socketserver.UnixStreamServer):
+    """
+    Unix socket server fitting one batch at a time with *backend* and *n_workers* processes.
+    """
+
+    def __init__(self, socket_path: str, backend: str = "pykinfit", n_workers: int = 1):
+        self.backend = backend
+        self.n_workers = n_workers
+        self.n_batches = 0
+        self.n_events = 0
+        super().__init__(socket_path, FitRequestHandler)
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+    raise RuntimeError(f"a kinematic fit server is already listening at {socket_path}")
+
+
+def serve(socket_path: str | None = None, backend: str = "pykinfit", n_workers: int = 1) -> None:
+    """
+    Runs a :py:class:`FitServer` at *socket_path* until it receives a stop request or is
+    interrupted.
+    """
+    if backend == "server":
+        raise ValueError("the kinematic fit server cannot use the server backend itself")
+    socket_path = socket_path or default_socket_path()
+    _remove_stale_socket(socket_path)
+
+    # import the fitter once before accepting batches
+    if backend == "pykinfit":
+        import pyKinFit  # noqa: F401
+
+    with FitServer(socket_path, backend=backend, n_workers=n_workers) as server:
+        os.chmod(socket_path, 0o600)
+        logger.info(f"kinematic fit server listening at {socket_path} ({backend}, {n_workers} workers)")
+        try:
+            server.serve_forever(poll_interval=1.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+            logger.info(f"fitted {server.n_events} events in {server.n_batches} batches")
+
+
+def request(op: str, socket_path: str | None = None) -> dict:
+    """
+    Sends the operation *op* (``"ping"`` or ``"stop"``) to the server at *socket_path*.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path or default_socket_path())
+        _send(sock, {"op": op})
+        with sock.makefile("rb") as rfile:
+            return _receive(rfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--socket", default=None, help="socket path, defaults to kinfit_server_socket")
+    parser.add_argument("--backend", default="pykinfit", help="fit backend, default: pykinfit")
+    parser.add_argument("--workers", type=int, default=1, help="number of fit worker processes, default: 1")
+    parser.add_argument("--ping", action="store_true", help="check a running server and exit")
+    parser.add_argument("--stop", action="store_true", help="stop a running server and exit")
+    args = parser.parse_args()
+
+    if args.ping or args.stop:
+        print(request("ping" if args.ping else "stop", args.socket))
+    else:
+        serve(args.socket, backend=args.backend, n_workers=args.workers)
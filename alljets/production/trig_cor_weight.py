@@ -12,6 +12,9 @@ from columnflow.production import Producer, producer
 from columnflow.util import maybe_import
 from law.util import InsertableDict
 
+from alljets.production.jet_masks import get_jet_mask
+from alljets.util import kth_largest
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
@@ -49,14 +52,9 @@ def trig_weights(
         })
     """
     if self.dataset_inst.has_tag("has_top"):
-        jet6_pt = ak.where(
-            ak.num(events.Jet[(abs(events.Jet.eta) < 2.6)], axis=1) > 5,
-            ak.sort(events.Jet[(abs(events.Jet.eta) < 2.6)
-                               ].pt[:], ascending=False, axis=1),
-            np.zeros((len(events), 6)),
-        )[:, 5]
-        ht = ak.sum(events.Jet.pt[(events.Jet.pt > 32)
-                    & (abs(events.Jet.eta) < 2.6)], axis=1)
+        trigger_jet_mask = get_jet_mask(events, self.config_inst, "trigger_jet")
+        jet6_pt = kth_largest(events.Jet.pt[trigger_jet_mask], 6, 0.0)
+        ht = ak.sum(events.Jet.pt[(events.Jet.pt > 32) & trigger_jet_mask], axis=1)
         if self.config_inst.x.trigger_sf_variable.startswith("jet6_pt"):
             weight = ak.where(jet6_pt == 0, np.zeros(
                 (len(events))), self.trig_sf_corrector(jet6_pt))
@@ -115,19 +113,18 @@ def trig_weights_setup(
     reader_targets: InsertableDict,
 ) -> None:
     # bundle = reqs["external_files"]
-    # create the corrector
-    import correctionlib
-    correctionlib.highlevel.Correction.__call__ = correctionlib.highlevel.Correction.evaluate
+    # create the corrector, parsed correction sets are cached per process and formula corrections
+    # are evaluated with numpy after validation against correctionlib
+    from alljets.corrections import CorrectionEvaluator, load_correction_set
     # correction_set = correctionlib.CorrectionSet.from_string(
     #     self.get_trig_file(bundle.files).load(formatter="gzip").decode("utf-8"),
     # )
-    correction_set = correctionlib.CorrectionSet.from_string(
-        inputs["external_files"]["collection"].targets[0]["weights"][0].load(
-            formatter="gzip").decode("utf-8"),
+    correction_set, content = load_correction_set(
+        inputs["external_files"]["collection"].targets[0]["weights"][0],
     )
     # Add distinction for year and working point later. For now only one
     # corrector_name, self.year, self.wp = self.get_trig_config()
     # self.trig_sf_corrector = correction_set[corrector_name]
-    self.trig_sf_corrector = correction_set["trig_cor"]
+    self.trig_sf_corrector = CorrectionEvaluator(correction_set, content, "trig_cor")
     # self.trig_sf_up_corrector = correction_set["trig_cor_up"]
     # self.trig_sf_down_corrector = correction_set["trig_cor_down"]
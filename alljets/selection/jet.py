@@ -3,18 +3,28 @@
 Jet selection methods.
 """
 
+import law
+
 from columnflow.columnar_util import set_ak_column, sorted_indices_from_mask
+from columnflow.production.cms.seeds import deterministic_event_seeds
 from columnflow.production.util import attach_coffea_behavior
 from columnflow.selection import SelectionResult, Selector, selector
 from columnflow.util import maybe_import
 
+from alljets.instrumentation import step, timed
+from alljets.matching import combination_type
+from alljets.production.jet_masks import get_jet_mask, jet_masks
+from alljets.selection.reco import chi2_reco, chi2_reco_tensor
+from alljets.util import seeded_permutations
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
 @selector(
     uses={"Jet.pt", "Jet.eta", "Jet.btagDeepFlavB",
-          "Jet.phi", "Jet.mass", attach_coffea_behavior, "HLT.*",
+          "Jet.phi", "Jet.mass", attach_coffea_behavior, "HLT.*", deterministic_event_seeds,
+          jet_masks,
           "gen_top", "GenPart.*",
           },
     # "Jet.jetId", "Jet.puId", "Jet.genJetIdx", "GenJet.*",
@@ -22,7 +32,10 @@ ak = maybe_import("awkward")
               "deltaRb", "combination_type", "R2b4q",
               },
     jet_pt=None, jet_trigger=None, jet_base_trigger=None, alt_jet_trigger=None,
+    # chi2 reconstruction, "awkward" or "tensor", defaults to the "chi2_reco_mode" option in the law config
+    chi2_mode=None,
 )
+@timed("jet_selection")
 def jet_selection(
     self: Selector,
     events: ak.Array,
@@ -30,23 +43,25 @@ def jet_selection(
 ) -> tuple[ak.Array, SelectionResult]:
     # example jet selection: at least six jets, lowest jet at least 40 GeV and H_T > 450 GeV
     EF = -99999.0  # define EMPTY_FLOAT
+    events = self[jet_masks](events, **kwargs)
     ht1_sel = (ak.sum(events.Jet.pt, axis=1) >= 1)
     jet_mask0 = (abs(events.Jet.eta) < 2.6)
     jet6_existance = (ak.num(jet_mask0, axis=1) > 5)
     jet_mask = (jet_mask0 & (events.Jet.pt >= 32.0))
     ht_sel = (ak.sum(events.Jet.pt[jet_mask], axis=1) >= 450)
-    jet_mask2 = ((abs(events.Jet.eta) < 2.4) & (events.Jet.pt >= 40.0))
+    jet_mask2 = get_jet_mask(events, self.config_inst, "kinfit_jet")
     jet_sel = ak.sum(jet_mask2, axis=1) >= 6
     veto_jet = ~jet_mask
     wp_tight = self.config_inst.x.btag_working_points.deepjet.tight
-    light_jet = (jet_mask2) & (events.Jet.btagDeepFlavB < wp_tight)
+    tight_bjet_mask = get_jet_mask(events, self.config_inst, "tight_b")
+    light_jet = (jet_mask2) & (~tight_bjet_mask)
 
     # B-Tag cut without jet energy limit
     bjet_mask0 = (abs(events.Jet.eta) < 2.4) & (events.Jet.pt >= 32.0) & (events.Jet.btagDeepFlavB >= wp_tight)
     bjet_sel0 = ((ak.sum(bjet_mask0[:, :6], axis=1) == 2))
 
     # b-tagged jets (tight wp)
-    bjet_mask = (jet_mask2) & (events.Jet.btagDeepFlavB >= wp_tight)
+    bjet_mask = (jet_mask2) & tight_bjet_mask
 
     bjet_sel = ((ak.sum(bjet_mask, axis=1) >= 2))
     sixjets_sel = (bjet_sel & (ak.sum(light_jet, axis=1) >= 4))
@@ -55,8 +70,7 @@ def jet_selection(
     #TOM:             )
 
     # B-Jet Rejection for bkg estimation
-    wp_loose = self.config_inst.x.btag_working_points.deepjet.loose
-    loose_bjet_mask = (events.Jet.btagDeepFlavB >= wp_loose)
+    loose_bjet_mask = get_jet_mask(events, self.config_inst, "loose_b")
     bjet_rej = (ak.sum(((jet_mask2) & loose_bjet_mask), axis=1) == 0)
     sel_bjet_2or0 = ak.any([bjet_sel, bjet_rej], axis=0)
     sel_bjet_alt_2or0 = ak.any([bjet_sel_alt, bjet_rej], axis=0)
@@ -75,37 +89,28 @@ def jet_selection(
         jet_base_trigger_sel = [True] * len(events)
     signal_or_bkg_trigger = ak.any([jet_trigger_sel, alt_jet_trigger_sel], axis=0)
 
-    # Preparation for reconstruction
-    mwref = 80.36
-    mwsig = 11.01  # Jette: 11.01, 12
-    mtsig = 27.07  # not Jette: 15
-    mu_tt = 2.07  # not Jette: 0
-    mu_w = 0.88  # not Jette: 0
-
-    m = lambda j1, j2: (j1.add(j2)).mass
-    m3 = lambda j1, j2, j3: (j1.add(j2.add(j3))).mass
-    dr = lambda j1, j2: j1.delta_r(j2)
-
     # Build jet combinations
-    bjet_after_jet_mask = (events.Jet[jet_mask2].btagDeepFlavB >= wp_tight)
-    ljet_after_jet_mask = (events.Jet[jet_mask2].btagDeepFlavB < wp_tight)
+    bjet_after_jet_mask = tight_bjet_mask[jet_mask2]
+    ljet_after_jet_mask = ~bjet_after_jet_mask
     leading_six_sel = ((ak.num((events.Jet.pt[jet_mask2][:, :6])[bjet_after_jet_mask[:, :6]], axis=1) == 2) &
                        (ak.num((events.Jet.pt[jet_mask2][:, :6])[ljet_after_jet_mask[:, :6]], axis=1) == 4))
 
     leading_six_or_bkg = ak.any([leading_six_sel, alt_jet_trigger_sel])
     # ljets = ak.combinations((events.Jet[light_jet])[sixjets_sel], 4, axis=1)
     # bjets = ak.combinations((events.Jet[bjet_mask])[sixjets_sel], 2, axis=1)
-    ljets = ak.combinations((events.Jet[(~bjet_mask) & jet_mask2][:, :])[sixjets_sel], 4, axis=1)
-    bjets = ak.combinations((events.Jet[bjet_mask][:, :2])[sixjets_sel], 2, axis=1)
+    ljets = (events.Jet[(~bjet_mask) & jet_mask2][:, :])[sixjets_sel]
+    bjets = (events.Jet[bjet_mask][:, :2])[sixjets_sel]
 
     # Pseudo recontruction for background
-    rej_jets = ((events.Jet[~loose_bjet_mask])[bjet_rej & alt_jet_trigger_sel & jet_sel & ht_sel])
+    bkg_sel = bjet_rej & alt_jet_trigger_sel & jet_sel & ht_sel
+    rej_jets = ((events.Jet[~loose_bjet_mask])[bkg_sel])
     rej_jets = rej_jets[ak.argsort((rej_jets.pt), axis=1, ascending=False)][:, :6]
 
-    rng = np.random.default_rng()
-    rng_index = rng.permuted(np.full((len(rej_jets), 6), [0, 1, 2, 3, 4, 5]), axis=1)
-
-    rej_jets = rej_jets[ak.Array(rng_index).to_list()]
+    # shuffle the six jets reproducibly per event, seeded by the deterministic event seeds
+    with step("jet_selection.bkg_shuffle"):
+        rej_seeds = self[deterministic_event_seeds](events[bkg_sel], **kwargs).deterministic_seed
+        rng_index = seeded_permutations(ak.to_numpy(rej_seeds), 6)
+        rej_jets = rej_jets[ak.unflatten(rng_index.ravel(), np.full(len(rng_index), 6))]
     # rej_bjets = ak.combinations((rej_jets[ak.argsort(
     #     (rej_jets.btagDeepFlavB),
     #     axis=1,
@@ -114,105 +119,43 @@ def jet_selection(
     #     (rej_jets.btagDeepFlavB),
     #     axis=1,
     #     ascending=False)])[:, 2:], 4, axis=1)
-    rej_bjets = ak.combinations(rej_jets[:, :2], 2, axis=1)
-    rej_ljets = ak.combinations(rej_jets[:, 2:], 4, axis=1)
-
-    # Building combination light jet mass functions
-
-    def lpermutations(ljets):
-        j1, j2, j3, j4 = ljets
-        return ak.concatenate([ak.zip([j1, j2, j3, j4]), ak.zip([j1, j3, j2, j4]), ak.zip([j1, j4, j2, j3])], axis=1)
-
-    def bpermutations(bjets):
-        j1, j2 = bjets
-        return ak.concatenate([ak.zip([j1, j2]), ak.zip([j2, j1])], axis=1)
-
-    def sixjetcombinations(bjets, ljets):
-        return ak.cartesian([bjets, ljets], axis=1)
-
-    # Top quark mass reconstruction
-    def mt(sixjets):
-        b1, b2 = ak.unzip(ak.unzip(sixjets)[0])
-        j1, j2, j3, j4 = ak.unzip(ak.unzip(sixjets)[1])
-        mt1 = ak.where((b1.pt > b2.pt), m3(b1, j1, j2), m3(b2, j3, j4))
-        mt2 = ak.where((b1.pt > b2.pt), m3(b2, j3, j4), m3(b1, j1, j2))
-        mw1 = ak.where((b1.pt > b2.pt), m(j1, j2), m(j3, j4))
-        mw2 = ak.where((b1.pt > b2.pt), m(j3, j4), m(j1, j2))
-        drbb = dr(b1, b2)
-        chi2 = ak.sum([
-            ((mw1 - mwref - mu_w) ** 2) / (mwsig ** 2),
-            ((mw2 - mwref - mu_w) ** 2) / (mwsig ** 2),
-            ((mt1 - mt2 - mu_tt) ** 2) / (mtsig ** 2)],
-            axis=0,
-        )
-        if len(chi2) > 0:
-            bestc2 = ak.argmin(chi2, axis=1, keepdims=True)
-            return mt1[bestc2], mt2[bestc2], mw1[bestc2], mw2[bestc2], drbb[bestc2], chi2[bestc2], bestc2, sixjets
-        else:
-            return [[EF]], [[EF]], [[EF]], [[EF]], [[EF]], [[EF]], [[EF]], [[EF]]
-
-    mt_result = mt(sixjetcombinations(bpermutations(ak.unzip(bjets)), lpermutations(ak.unzip(ljets))))
-    mt_bkg_result = mt(sixjetcombinations(bpermutations(ak.unzip(rej_bjets)), lpermutations(ak.unzip(rej_ljets))))
+    rej_bjets = rej_jets[:, :2]
+    rej_ljets = rej_jets[:, 2:]
+
+    # Top quark mass reconstruction, see alljets.selection.reco
+    reco = chi2_reco_tensor if self.chi2_mode == "tensor" else chi2_reco
+    with step("jet_selection.chi2"):
+        mt_result = reco(bjets, ljets, fill_value=EF)
+        mt_bkg_result = reco(rej_bjets, rej_ljets, fill_value=EF)
     chi2_cut = 50
     mt_result_filled = np.full((6, ak.num(events, axis=0)), EF)
     for i in range(6):
         (mt_result_filled[i])[sixjets_sel] = ak.flatten(mt_result[i])
-        (mt_result_filled[i])[bjet_rej & alt_jet_trigger_sel & jet_sel & ht_sel] = ak.flatten(mt_bkg_result[i])
+        (mt_result_filled[i])[bkg_sel] = ak.flatten(mt_bkg_result[i])
 
     chi2_sel = ak.Array((mt_result_filled[5] < chi2_cut) & (mt_result_filled[5] > -1))
     chi2_sel3 = ak.Array((mt_result_filled[5] < 5) & (mt_result_filled[5] > -1))
     Rbb_sel = ak.Array(mt_result_filled[4] > 2)
 
-    events = set_ak_column(events, "Mt1", mt_result_filled[0])
-    events = set_ak_column(events, "Mt2", mt_result_filled[1])
-    events = set_ak_column(events, "MW1", mt_result_filled[2])
-    events = set_ak_column(events, "MW2", mt_result_filled[3])
-    events = set_ak_column(events, "deltaRb", mt_result_filled[4])
-    events = set_ak_column(events, "chi2", mt_result_filled[5])
+    with step("jet_selection.set_columns"):
+        events = set_ak_column(events, "Mt1", mt_result_filled[0])
+        events = set_ak_column(events, "Mt2", mt_result_filled[1])
+        events = set_ak_column(events, "MW1", mt_result_filled[2])
+        events = set_ak_column(events, "MW2", mt_result_filled[3])
+        events = set_ak_column(events, "deltaRb", mt_result_filled[4])
+        events = set_ak_column(events, "chi2", mt_result_filled[5])
 
     def combinationtype(bestcomb, correctcomb):
-        b1, b2 = ak.unzip(ak.unzip(bestcomb)[0])
-        j1, j2, j3, j4 = ak.unzip(ak.unzip(bestcomb)[1])
-
-        b1cor = correctcomb.b[:,0]
-        q1cor = correctcomb.w_children[:, 0,0]
-        q2cor = correctcomb.w_children[:, 0, 1]
-        b2cor = correctcomb.b[:,1]
-        q3cor = correctcomb.w_children[:, 1, 0]
-        q4cor = correctcomb.w_children[:, 1, 1]
-        drmax = 0.4
-        drb11, drb22, drq11 = (dr(b1, b1cor) < drmax), (dr(b2, b2cor) < drmax), (dr(j1, q1cor) < drmax)
-        drq22, drq33, drq44 = (dr(j2, q2cor) < drmax), (dr(j3, q3cor) < drmax), (dr(j4, q4cor) < drmax)
-        drq21, drq12 = (dr(j2, q1cor) < drmax), (dr(j1, q2cor) < drmax)
-        drq43, drq34 = (dr(j4, q3cor) < drmax), (dr(j3, q4cor) < drmax)
-        drb21, drb12, drq31 = (dr(b2, b1cor) < drmax), (dr(b1, b2cor) < drmax), (dr(j3, q1cor) < drmax)
-        drq42, drq13, drq24 = (dr(j4, q2cor) < drmax), (dr(j1, q3cor) < drmax), (dr(j2, q4cor) < drmax)
-        drq41, drq32 = (dr(j4, q1cor) < drmax), (dr(j3, q2cor) < drmax)
-        drq23, drq14 = (dr(j2, q3cor) < drmax), (dr(j1, q4cor) < drmax)
-        # b1b2: 1234 2134 1243 2143, b2b1: 3412 4312 3421 4321
-        drlist = [(drb11 & drb22 & drq11 & drq22 & drq33 & drq44),
-                  (drb11 & drb22 & drq21 & drq12 & drq33 & drq44),
-                  (drb11 & drb22 & drq11 & drq22 & drq43 & drq34),
-                  (drb11 & drb22 & drq21 & drq12 & drq43 & drq34),
-                  (drb21 & drb12 & drq31 & drq42 & drq13 & drq24),
-                  (drb21 & drb12 & drq41 & drq32 & drq13 & drq24),
-                  (drb21 & drb12 & drq31 & drq42 & drq23 & drq14),
-                  (drb21 & drb12 & drq41 & drq32 & drq23 & drq14),
-                  ]
-        # test if all jets are matched
-        matched = ak.all([
-            ak.any([drb11, drb12], axis=0),
-            ak.any([drb22, drb21], axis=0),
-            ak.any([drq11, drq12, drq13, drq14], axis=0),
-            ak.any([drq21, drq22, drq23, drq24], axis=0),
-            ak.any([drq31, drq32, drq33, drq34], axis=0),
-            ak.any([drq41, drq42, drq43, drq44], axis=0)], axis=0)
-        type = ak.flatten(matched) * 1 + ak.flatten(ak.any(drlist, axis=0))
-        return type
+        if len(correctcomb) == 0:
+            return np.zeros(0, dtype=np.int8)
+        # reco jets of the best combination, one list of length one per event and jet
+        bestjets = ak.unzip(ak.unzip(bestcomb)[0]) + ak.unzip(ak.unzip(bestcomb)[1])
+        return combination_type(list(bestjets), correctcomb)
 
     if self.dataset_inst.has_tag("has_top"):
         type = np.full((1, ak.num(events, axis=0)), -1)
-        type_unfilled = combinationtype((mt_result[7])[mt_result[6]], events.gen_top[sixjets_sel])
+        with step("jet_selection.combination_type"):
+            type_unfilled = combinationtype(mt_result[7], events.gen_top[sixjets_sel])
         type[0][sixjets_sel] = type_unfilled
         type = ak.flatten(type)
     else:
@@ -288,6 +231,11 @@ def jet_selection(
 @jet_selection.init
 def jet_selection_init(self: Selector) -> None:
     year = self.config_inst.campaign.x.year
+    if self.chi2_mode is None:
+        self.chi2_mode = law.config.get_expanded("analysis", "chi2_reco_mode", "awkward")
+    if self.chi2_mode not in ("awkward", "tensor"):
+        raise ValueError(f"unknown chi2 reconstruction mode '{self.chi2_mode}'")
+
     # register shifts
     self.shifts |= {
         shift_inst.name
@@ -0,0 +1,321 @@
+# coding: utf-8
+
+"""
+Chi2 reconstruction of the fully hadronic ttbar hypothesis.
+
+:py:func:`chi2_reco` evaluates the candidates on awkward arrays of jets. In the tensor based
+implementation, jets are padded to fixed size float32 blocks of (px, py, pz, e) and all candidate
+masses are obtained from precomputed index tables, without building awkward records per candidate.
+"""
+
+from __future__ import annotations
+
+import functools
+import itertools
+import math
+
+from columnflow.columnar_util import flat_np_view
+from columnflow.util import maybe_import
+
+from alljets.fourvector import FourVectors
+from alljets.util import jagged_offsets, pad_flat
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# parameters of the mass chi2 of the jet selection, also used to rank kinematic fit hypotheses, in
+# which case all jets can take all roles instead of the b jets being fixed by their b-tags
+MASS_CHI2 = {
+    "mw": 80.36,
+    "mw_sigma": 11.01,  # Jette: 11.01, 12
+    "mt_sigma": 27.07,  # not Jette: 15
+    "mu_tt": 2.07,  # not Jette: 0
+    "mu_w": 0.88,  # not Jette: 0
+}
+
+# number of light jet pairings per quadruplet, i.e., (12)(34), (13)(24) and (14)(23)
+PAIRINGS = ((0, 1, 2, 3), (0, 2, 1, 3), (0, 3, 1, 2))
+
+
+@functools.lru_cache(maxsize=None)
+def candidate_table(n_light: int) -> dict[str, np.ndarray]:
+    """
+    Returns index tables of all chi2 candidates that can be built from two b jets and up to
+    *n_light* light jets. Candidates are ordered by b jet order, light jet pairing and quadruplet,
+    which is the order of ``ak.cartesian([bpermutations, lpermutations])`` in the jet selection.
+    Fields are:
+
+        - ``pairs``: light jet indices of all pairs, ``(n_pairs, 2)``
+        - ``b_order``: index of the first b jet, ``(n_cand,)``
+        - ``light``: light jet indices (j1, j2, j3, j4), ``(n_cand, 4)``
+        - ``pair_a``, ``pair_b``: pair indices of (j1, j2) and (j3, j4), ``(n_cand,)``
+        - ``n_needed``: minimum number of light jets, ``(n_cand,)``
+        - ``block``, ``rank``: pairing block ``b_order * 3 + pairing`` and position of the
+          quadruplet among all valid ones, given the number of light jets, ``(n_light + 1, n_cand)``
+    """
+    pairs = np.array(list(itertools.combinations(range(n_light), 2)), dtype=np.int32).reshape(-1, 2)
+    pair_index = {tuple(p): i for i, p in enumerate(pairs.tolist())}
+    quads = np.array(list(itertools.combinations(range(n_light), 4)), dtype=np.int32).reshape(-1, 4)
+    n_quads = len(quads)
+
+    light = np.concatenate([quads[:, list(pairing)] for pairing in PAIRINGS] * 2, axis=0)
+    b_order = np.repeat(np.arange(2, dtype=np.int32), len(PAIRINGS) * n_quads)
+    block = np.repeat(np.arange(2 * len(PAIRINGS), dtype=np.int32), n_quads)
+    n_needed = np.tile(quads.max(axis=1, initial=-1) + 1, 2 * len(PAIRINGS))
+
+    # position of each quadruplet among those valid for a given number of light jets
+    valid = np.arange(n_light + 1)[:, None] >= quads.max(axis=1, initial=-1)[None, :] + 1
+    rank = np.tile(np.cumsum(valid, axis=1) - 1, 2 * len(PAIRINGS))
+
+    return {
+        "pairs": pairs,
+        "b_order": b_order,
+        "light": light,
+        "pair_a": np.array([pair_index[tuple(p)] for p in light[:, :2].tolist()], dtype=np.int32),
+        "pair_b": np.array([pair_index[tuple(p)] for p in light[:, 2:].tolist()], dtype=np.int32),
+        "n_needed": n_needed,
+        "block": block,
+        "rank": rank,
+    }
+
+
+def p4_block(jets: np.ndarray) -> np.ndarray:
+    """
+    Converts a block of jets with last axis (pt, eta, phi, mass) into float32 (px, py, pz, e).
+    """
+    p4 = FourVectors.from_ptetaphim(*(jets[..., i] for i in range(4)))
+    return np.stack([p4.px, p4.py, p4.pz, p4.e], axis=-1)
+
+
+def _mass(p4: np.ndarray) -> np.ndarray:
+    m2 = p4[..., 3] ** 2 - p4[..., 0] ** 2 - p4[..., 1] ** 2 - p4[..., 2] ** 2
+    return np.sqrt(np.maximum(m2, 0))
+
+
+def best_candidates(
+    b_p4: np.ndarray,
+    l_p4: np.ndarray,
+    n_light: np.ndarray,
+    mw: float,
+    mw_sigma: float,
+    mt_sigma: float,
+    mu_w: float = 0.0,
+    mu_tt: float = 0.0,
+    batch_size: int = 2000,
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Returns the position of the candidate with the smallest chi2 per event in the
+    :py:func:`candidate_table` for the padded light jets, as well as the masses of the best
+    candidate in a dictionary with fields ``mt1``, ``mt2``, ``mw1``, ``mw2`` and ``chi2``.
+
+    *b_p4* and *l_p4* are float32 blocks of shape ``(n_events, 2, 4)`` and ``(n_events, n_max, 4)``
+    holding (px, py, pz, e) as returned by :py:func:`p4_block`, and *n_light* is the number of valid
+    light jets per event. The chi2 definition and the assignment of the top quark candidates by b jet
+    pt follow the awkward implementation in the jet selection. Events are processed in batches of
+    *batch_size* to bound the memory of the ``(n_events, n_cand)`` candidate arrays.
+    """
+    table = candidate_table(l_p4.shape[1])
+    n_events = len(b_p4)
+    best = np.zeros(n_events, dtype=np.int64)
+    values = {key: np.empty(n_events, dtype=np.float32) for key in ("mt1", "mt2", "mw1", "mw2", "chi2")}
+
+    # incidence matrix of jets in pairs, used to sum all pair four-vectors at once
+    incidence = np.zeros((len(table["pairs"]), l_p4.shape[1]), dtype=np.float32)
+    np.put_along_axis(incidence, table["pairs"].astype(np.int64), 1.0, axis=1)
+
+    for start in range(0, n_events, batch_size):
+        sl = slice(start, start + batch_size)
+        pair_p4 = np.einsum("ps,nsd->npd", incidence, l_p4[sl])
+        mw_pair = _mass(pair_p4)
+        # top quark candidate masses for both b jets and all pairs, (n, 2, n_pairs)
+        mt_pair = _mass(b_p4[sl, :, None] + pair_p4[:, None])
+
+        # gather masses per candidate, (n, n_cand)
+        b_order = table["b_order"]
+        mt_a = mt_pair[:, b_order, table["pair_a"]]
+        mt_b = mt_pair[:, 1 - b_order, table["pair_b"]]
+        mw_a = mw_pair[:, table["pair_a"]]
+        mw_b = mw_pair[:, table["pair_b"]]
+
+        # first b jet of the candidate defines the first top quark if it is harder
+        b_pt2 = b_p4[sl, :, 0] ** 2 + b_p4[sl, :, 1] ** 2
+        first = np.where(b_order[None, :] == 0, b_pt2[:, :1] > b_pt2[:, 1:], b_pt2[:, 1:] > b_pt2[:, :1])
+        mt1, mt2 = np.where(first, mt_a, mt_b), np.where(first, mt_b, mt_a)
+        mw1, mw2 = np.where(first, mw_a, mw_b), np.where(first, mw_b, mw_a)
+        chi2 = (
+            (mw1 - mw - mu_w) ** 2 / mw_sigma ** 2 +
+            (mw2 - mw - mu_w) ** 2 / mw_sigma ** 2 +
+            (mt1 - mt2 - mu_tt) ** 2 / mt_sigma ** 2
+        )
+        chi2[table["n_needed"][None, :] > n_light[sl, None]] = np.inf
+
+        _best = np.argmin(chi2, axis=1)
+        rows = np.arange(len(_best))
+        best[sl] = _best
+        for key, arr in zip(values, (mt1, mt2, mw1, mw2, chi2)):
+            values[key][sl] = arr[rows, _best]
+
+    return best, values
+
+
+def candidate_position(
+    best: np.ndarray,
+    n_light: np.ndarray,
+    n_max: int,
+) -> np.ndarray:
+    """
+    Converts positions *best* in the :py:func:`candidate_table` for *n_max* light jets into
+    positions in the list of candidates built from exactly *n_light* light jets per event.
+    """
+    table = candidate_table(n_max)
+    n_quads = np.array([math.comb(n, 4) for n in range(n_max + 1)])
+    return table["block"][best] * n_quads[n_light] + table["rank"][n_light, best]
+
+
+def _w_term(mw: ak.Array) -> ak.Array:
+    return ((mw - MASS_CHI2["mw"] - MASS_CHI2["mu_w"]) ** 2) / (MASS_CHI2["mw_sigma"] ** 2)
+
+
+def _evaluate_candidates(
+    bjets: ak.Array,
+    ljets: ak.Array,
+    b_order: ak.Array,
+    l1: ak.Array,
+    l2: ak.Array,
+    l3: ak.Array,
+    l4: ak.Array,
+) -> tuple[ak.Array, ...]:
+    # masses, b jet distance and chi2 of the candidates given by the local indices of their jets
+    def m(j1, j2):
+        return (j1.add(j2)).mass
+
+    def m3(j1, j2, j3):
+        return (j1.add(j2.add(j3))).mass
+
+    b1 = bjets[b_order]
+    b2 = bjets[1 - b_order]
+    j1, j2, j3, j4 = ljets[l1], ljets[l2], ljets[l3], ljets[l4]
+    mt1 = ak.where((b1.pt > b2.pt), m3(b1, j1, j2), m3(b2, j3, j4))
+    mt2 = ak.where((b1.pt > b2.pt), m3(b2, j3, j4), m3(b1, j1, j2))
+    mw1 = ak.where((b1.pt > b2.pt), m(j1, j2), m(j3, j4))
+    mw2 = ak.where((b1.pt > b2.pt), m(j3, j4), m(j1, j2))
+    drbb = b1.delta_r(b2)
+    chi2 = ak.sum([
+        _w_term(mw1),
+        _w_term(mw2),
+        ((mt1 - mt2 - MASS_CHI2["mu_tt"]) ** 2) / (MASS_CHI2["mt_sigma"] ** 2),
+    ], axis=0)
+    return mt1, mt2, mw1, mw2, drbb, chi2
+
+
+def chi2_reco(bjets: ak.Array, ljets: ak.Array, fill_value: float) -> tuple:
+    """
+    Returns the candidate with the smallest :py:data:`MASS_CHI2` per event, built from the two
+    *bjets* and four of the *ljets*, both jagged arrays of jets with four-vector behavior.
+
+    Candidates are all assignments of the two b jets (2 orders) and four out of the light jets to
+    the W bosons (3 pairings per quadruplet), ordered as in ``ak.cartesian([bperms, lperms])`` with
+    ``lperms = [(j1, j2, j3, j4)..., (j1, j3, j2, j4)..., (j1, j4, j2, j3)...]``. Since the top mass
+    term is non-negative, the W terms of a light jet pairing are a lower bound of its chi2. The
+    pairing with the lowest bound is evaluated first, and its chi2 bounds the best one, so that all
+    pairings with a larger lower bound can be dropped before computing any top masses.
+
+    Returns an 8-tuple of lists with one entry per event: the masses ``mt1``, ``mt2``, ``mw1`` and
+    ``mw2``, the distance of the b jets, the chi2, the position of the best candidate among all
+    candidates and the best combination as ``((b1, b2), (j1, j2, j3, j4))``. Without any events,
+    all entries are *fill_value*.
+    """
+    if len(bjets) == 0:
+        return tuple([[fill_value]] for _ in range(8))
+
+    # W terms of all light jet pairs
+    n_l = ak.num(ljets, axis=1)
+    p1, p2 = ak.unzip(ak.combinations(ljets, 2, axis=1))
+    w_pair = _w_term((p1.add(p2)).mass)
+
+    def pair_index(a, b):
+        # position of the pair (a, b) with a < b in the combinations
+        return a * n_l - a * (a + 1) // 2 + b - a - 1
+
+    # local indices of all light jet pairings and their lower chi2 bound
+    i1, i2, i3, i4 = ak.unzip(ak.combinations(ak.local_index(ljets, axis=1), 4, axis=1))
+    l1 = ak.concatenate([i1, i1, i1], axis=1)
+    l2 = ak.concatenate([i2, i3, i4], axis=1)
+    l3 = ak.concatenate([i3, i2, i2], axis=1)
+    l4 = ak.concatenate([i4, i4, i3], axis=1)
+    bound = w_pair[pair_index(l1, l2)] + w_pair[pair_index(l3, l4)]
+
+    # evaluate the most promising pairing for both b jet orders to obtain an upper bound
+    first = ak.argmin(bound, axis=1, keepdims=True)
+    upper = ak.min(ak.concatenate([
+        _evaluate_candidates(
+            bjets, ljets, ak.zeros_like(first) + b_order, l1[first], l2[first], l3[first], l4[first],
+        )[5]
+        for b_order in (0, 1)
+    ], axis=1), axis=1)
+
+    # keep pairings that can still compete, preserving their order, and evaluate them
+    keep = bound <= upper
+    index = ak.local_index(bound, axis=1)[keep]
+    l1, l2, l3, l4 = l1[keep], l2[keep], l3[keep], l4[keep]
+    b_order = ak.concatenate([ak.zeros_like(index), ak.ones_like(index)], axis=1)
+    l1, l2, l3, l4 = (ak.concatenate([li, li], axis=1) for li in (l1, l2, l3, l4))
+    results = _evaluate_candidates(bjets, ljets, b_order, l1, l2, l3, l4)
+
+    # position of the best candidate in the full list of candidates
+    bestc = ak.argmin(results[5], axis=1, keepdims=True)
+    bestc2 = (b_order * ak.num(bound, axis=1) + ak.concatenate([index, index], axis=1))[bestc]
+
+    # best combination in the nested structure ((b1, b2), (j1, j2, j3, j4))
+    b_best = b_order[bestc]
+    bestcomb = ak.zip([
+        ak.zip([bjets[b_best], bjets[1 - b_best]]),
+        ak.zip([ljets[l1[bestc]], ljets[l2[bestc]], ljets[l3[bestc]], ljets[l4[bestc]]]),
+    ])
+    return tuple(result[bestc] for result in results) + (bestc2, bestcomb)
+
+
+def _p4_block_from_jets(jets: ak.Array, n_max: int) -> np.ndarray:
+    flat = np.stack([flat_np_view(jets[field]) for field in ("pt", "eta", "phi", "mass")], axis=-1)
+    return p4_block(pad_flat(flat, jagged_offsets(jets), n_max=n_max))
+
+
+def _as_jagged(values: np.ndarray) -> ak.Array:
+    # wrap one value per event as a list of length one, usable as jagged index
+    return ak.unflatten(values, np.ones(len(values), dtype=np.int64))
+
+
+def chi2_reco_tensor(bjets: ak.Array, ljets: ak.Array, fill_value: float) -> tuple:
+    """
+    Same as :py:func:`chi2_reco`, but evaluated with :py:func:`best_candidates` on padded float32
+    four-vectors, which can change the best candidate in case of near-degenerate chi2 values.
+    """
+    if len(bjets) == 0:
+        return tuple([[fill_value]] for _ in range(8))
+
+    n_light = ak.to_numpy(ak.num(ljets, axis=1))
+    n_max = max(int(n_light.max()), 4)
+    best, values = best_candidates(
+        _p4_block_from_jets(bjets, 2),
+        _p4_block_from_jets(ljets, n_max),
+        n_light,
+        mw=MASS_CHI2["mw"],
+        mw_sigma=MASS_CHI2["mw_sigma"],
+        mt_sigma=MASS_CHI2["mt_sigma"],
+        mu_w=MASS_CHI2["mu_w"],
+        mu_tt=MASS_CHI2["mu_tt"],
+    )
+
+    # build the best combination from its jet indices
+    table = candidate_table(n_max)
+    b_best = _as_jagged(table["b_order"][best])
+    b1, b2 = bjets[b_best], bjets[1 - b_best]
+    light = [ljets[_as_jagged(table["light"][best, i])] for i in range(4)]
+    bestcomb = ak.zip([ak.zip([b1, b2]), ak.zip(light)])
+    bestc2 = _as_jagged(candidate_position(best, n_light, n_max))
+
+    return tuple(
+        _as_jagged(values[key])
+        for key in ("mt1", "mt2", "mw1", "mw2")
+    ) + (b1.delta_r(b2), _as_jagged(values["chi2"]), bestc2, bestcomb)
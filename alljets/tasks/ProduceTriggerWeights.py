@@ -4,11 +4,13 @@
 Tasks to create trigger correction weights .
 """
 
+import os
 from collections import OrderedDict, defaultdict
 from abc import abstractmethod
 
 from columnflow.types import Any
 
+import luigi
 import law
 import order as od
 
@@ -27,6 +29,8 @@ from columnflow.util import DotDict, dev_sandbox
 from columnflow.hist_util import add_missing_shifts
 from columnflow.config_util import get_shift_from_configs
 
+from alljets.histogramming.hist_store import LazyHist, is_hist_store, load_hist, save_hist
+
 
 class _ProduceTriggerWeightBase(
     CalibratorClassesMixin,
@@ -54,16 +58,36 @@ class ProduceTriggerWeightBase(_ProduceTriggerWeightBase):
 
     exclude_index = True
 
+    cache_hists = luigi.BoolParameter(
+        default=True,
+        significant=False,
+        description="when True, merged histograms are loaded once per process and shared between consecutive "
+        "branches with the same variable; default: True",
+    )
+
+    hist_format = luigi.ChoiceParameter(
+        default="pickle",
+        choices=("pickle", "hstore"),
+        significant=False,
+        description="format in which merged histograms are read; 'hstore' converts local pickles once into a "
+        "memory-mapped histogram store next to them and only reads the selected processes and categories; "
+        "default: pickle",
+    )
+
+    # merged histograms of the last variable loaded in this process, see load_merged_hist
+    _hist_cache = {"variable": None, "hists": {}}
+
     def store_parts(self) -> law.util.InsertableDict:
         parts = super().store_parts()
         parts.insert_before("version", "datasets", f"datasets_{self.datasets_repr}")
         return parts
 
     def create_branch_map(self):
+        # branches of the same variable are consecutive so that they can share loaded histograms
         return [
             DotDict({"category": cat_name, "variable": var_name})
-            for cat_name in sorted(self.categories)
             for var_name in sorted(self.variables)
+            for cat_name in sorted(self.categories)
         ]
 
     def workflow_requires(self):
@@ -79,6 +103,38 @@ class ProduceTriggerWeightBase(_ProduceTriggerWeightBase):
     def config_inst(self):
         return self.config_insts[0]
 
+    def load_merged_hist(self, inp: dict):
+        """
+        Loads the merged histogram of the branch variable from the MergeHistograms output *inp*. When
+        :py:attr:`cache_hists` is set, histograms are cached per process for as long as consecutive
+        branches use the same variable, so that each one is unpickled only once. Cached histograms are
+        shared and must not be modified in place.
+
+        With :py:attr:`hist_format` ``"hstore"``, local histograms are returned as
+        :py:class:`~alljets.histogramming.hist_store.LazyHist` objects instead.
+        """
+        target = inp["collection"][0]["hists"].targets[self.branch_data.variable]
+        if not self.cache_hists:
+            return self._load_hist_target(target)
+
+        cache = ProduceTriggerWeightBase._hist_cache
+        if cache["variable"] != self.branch_data.variable:
+            cache["variable"] = self.branch_data.variable
+            cache["hists"].clear()
+        key = target.uri()
+        if key not in cache["hists"]:
+            cache["hists"][key] = self._load_hist_target(target)
+        return cache["hists"][key]
+
+    def _load_hist_target(self, target: law.FileSystemTarget):
+        if self.hist_format != "hstore" or not isinstance(target, law.LocalFileTarget):
+            return target.load(formatter="pickle")
+
+        store_path = f"{os.path.splitext(target.abspath)[0]}.hstore"
+        if not is_hist_store(store_path):
+            save_hist(target.load(formatter="pickle"), store_path)
+        return load_hist(store_path)
+
     def get_config_process_map(self) -> tuple[dict[od.Config, dict[od.Process, dict[str, Any]]], dict[str, set[str]]]:
         """
         Function that maps the config and process instances to the datasets and shifts they are supposed to be plotted
@@ -171,22 +227,38 @@ class ProduceTriggerWeightBase(_ProduceTriggerWeightBase):
 
                 for dataset, inp in dataset_dict.items():
                     dataset_inst = config_inst.get_dataset(dataset)
-                    h_in = inp["collection"][0]["hists"].targets[self.branch_data.variable].load(formatter="pickle")
+                    h_in = self.load_merged_hist(inp)
+                    lazy = isinstance(h_in, LazyHist)
+                    if lazy:
+                        # read only the bins of the leaf categories of this branch
+                        h_categories = h_in.categories("category")
+                        lazy_categories = [c.name for c in leaf_category_insts if c.name in h_categories]
 
                     # loop and extract one histogram per process
                     for process_inst, process_info in config_process_map[config_inst].items():
                         if dataset_inst not in process_info["dataset_proc_name_map"].keys():
                             continue
 
-                        # select processes and reduce axis
-                        h = h_in.copy()
-                        h = h[{
-                            "process": [
-                                hist.loc(proc_name)
-                                for proc_name in process_info["dataset_proc_name_map"][dataset_inst]
-                                if proc_name in h.axes["process"]
-                            ],
-                        }]
+                        # select processes and reduce axis, slicing creates a new histogram so that the
+                        # (possibly cached) input histogram is not modified
+                        if lazy:
+                            h_processes = h_in.categories("process")
+                            h = h_in[{
+                                "process": [
+                                    proc_name
+                                    for proc_name in process_info["dataset_proc_name_map"][dataset_inst]
+                                    if proc_name in h_processes
+                                ],
+                                "category": lazy_categories,
+                            }]
+                        else:
+                            h = h_in[{
+                                "process": [
+                                    hist.loc(proc_name)
+                                    for proc_name in process_info["dataset_proc_name_map"][dataset_inst]
+                                    if proc_name in h_in.axes["process"]
+                                ],
+                            }]
                         h = h[{"process": sum}]
 
                         # create expected shift bins and fill them with the nominal histogram
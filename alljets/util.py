@@ -0,0 +1,322 @@
+# coding: utf-8
+
+"""
+Collection of columnar helpers shared across alljets selectors and producers.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def jagged_offsets(array: ak.Array) -> np.ndarray:
+    """
+    Returns the offsets of the outermost jagged dimension of *array* as a numpy array starting at
+    zero, i.e., with ``len(array) + 1`` entries.
+    """
+    counts = np.asarray(ak.num(array, axis=1), dtype=np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def pad_flat(
+    flat: np.ndarray,
+    offsets: np.ndarray,
+    n_max: int | None = None,
+    fill_value: float = 0.0,
+    dtype: np.dtype | None = None,
+) -> np.ndarray:
+    """
+    Scatters the *flat* content buffer of a jagged array with *offsets* into a padded block of shape
+    ``(n_events, n_max) + flat.shape[1:]``. Entries beyond *n_max* are dropped, missing entries are
+    set to *fill_value*. Example:
+
+    .. code-block:: python
+
+        pad_flat(np.array([1.0, 2.0, 3.0]), np.array([0, 2, 2, 3]), fill_value=-1)
+        # array([[ 1.,  2.],
+        #        [-1., -1.],
+        #        [ 3., -1.]])
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    if n_max is None:
+        n_max = int(counts.max()) if len(counts) else 0
+    if dtype is None:
+        dtype = flat.dtype
+
+    out = np.full((len(counts), n_max) + flat.shape[1:], fill_value, dtype=dtype)
+    if not len(counts) or not n_max:
+        return out
+
+    # event and local index of each flat entry
+    rows = np.repeat(np.arange(len(counts)), counts)
+    local = local_index_flat(offsets)
+    keep = local < n_max
+    out[rows[keep], local[keep]] = flat[offsets[0]:offsets[-1]][keep]
+
+    return out
+
+
+def local_index_flat(offsets: np.ndarray) -> np.ndarray:
+    """
+    Returns the flat local index, i.e., the position of each entry within its event, of a jagged
+    array with *offsets*.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    return np.arange(offsets[-1] - offsets[0]) - np.repeat(offsets[:-1] - offsets[0], counts)
+
+
+def leading_order(
+    offsets: np.ndarray,
+    rows: np.ndarray,
+    leading: np.ndarray,
+) -> np.ndarray:
+    """
+    Returns flat local indices that reorder the entries of a jagged array with *offsets* such that,
+    for the events *rows*, the local indices given in the rows of the 2D array *leading* come first,
+    followed by all remaining entries in ascending order. All other events keep their order. Example:
+
+    .. code-block:: python
+
+        leading_order(np.array([0, 3, 7]), np.array([1]), np.array([[2, 0]]))
+        # array([0, 1, 2, 2, 0, 1, 3])
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    local = local_index_flat(offsets)
+
+    # sort key per entry, leading entries get their position, all others are shifted behind them
+    n_lead = leading.shape[1]
+    key = local + n_lead
+    pos = offsets[rows, None] - offsets[0] + leading
+    valid = leading < counts[rows, None]
+    key[pos[valid]] = np.broadcast_to(np.arange(n_lead), leading.shape)[valid]
+
+    event = np.repeat(np.arange(len(counts)), counts)
+    return local[np.lexsort((key, event))]
+
+
+def scatter_leading(
+    flat: np.ndarray,
+    offsets: np.ndarray,
+    rows: np.ndarray,
+    leading: np.ndarray,
+) -> np.ndarray:
+    """
+    Returns a copy of the *flat* content buffer of a jagged array with *offsets*, in which the first
+    entries of the events *rows* are replaced by the rows of the 2D array *leading*. Values beyond
+    the number of entries of an event are dropped. Example:
+
+    .. code-block:: python
+
+        scatter_leading(np.array([1.0, 2.0, 3.0, 4.0]), np.array([0, 1, 4]), np.array([1]), np.array([[8.0, 9.0]]))
+        # array([1., 8., 9., 4.])
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    n_lead = leading.shape[1]
+    pos = offsets[rows, None] - offsets[0] + np.arange(n_lead)
+    valid = np.arange(n_lead) < counts[rows, None]
+    out = np.array(flat[offsets[0]:offsets[-1]])
+    out[pos[valid]] = leading[valid]
+    return out
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer, uint64 arithmetic wraps around
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def seeded_permutations(seeds: np.ndarray, n: int) -> np.ndarray:
+    """
+    Returns one permutation of ``range(n)`` per entry of the 64 bit integer *seeds*, with shape
+    ``(len(seeds), n)``. The permutations only depend on the seeds, so that they are reproducible
+    per event when using deterministic event seeds, independent of chunking and processing order.
+    Random keys are derived per seed and position with the splitmix64 mixing function and sorted.
+    """
+    z = np.asarray(seeds, dtype=np.uint64)[:, None] + (
+        np.arange(1, n + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    )
+    return np.argsort(_mix64(z), axis=1, kind="stable")
+
+
+def pack_bitmask(flags: list[np.ndarray], shift: int = 0) -> np.ndarray:
+    """
+    Packs the non-empty list of boolean arrays *flags* into a uint64 array, in which bit
+    ``shift + i`` is set when the *i*-th flag is set. Inverse of :py:func:`expand_bitmask`. Example:
+
+    .. code-block:: python
+
+        pack_bitmask([np.array([True, False]), np.array([False, True]), np.array([True, False])])
+        # array([5, 2], dtype=uint64)
+    """
+    if shift + len(flags) > 64:
+        raise ValueError(f"cannot pack {len(flags)} flags starting at bit {shift} into 64 bits")
+    mask = np.zeros(len(flags[0]), dtype=np.uint64)
+    for i, flag in enumerate(flags):
+        mask |= np.asarray(flag, dtype=bool).astype(np.uint64) << np.uint64(shift + i)
+    return mask
+
+
+def expand_bitmask(
+    mask: np.ndarray,
+    shift: int = 0,
+    n_bits: int = 32,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Expands the bits ``shift`` to ``shift + n_bits - 1`` of the integer array *mask* into one entry
+    per set bit. Returns the row of each entry and the position of its bit relative to *shift*,
+    both ordered by row and bit position. Example:
+
+    .. code-block:: python
+
+        expand_bitmask(np.array([0b101, 0b010]))
+        # (array([0, 0, 1]), array([0, 2, 1]))
+    """
+    bits = np.asarray(mask, dtype=np.uint64) >> np.uint64(shift)
+    rows, pos = np.nonzero((bits[:, None] >> np.arange(n_bits, dtype=np.uint64)) & np.uint64(1))
+    return rows, pos
+
+
+def broadcast_flat(values: dict) -> dict:
+    """
+    Flattens the arrays in *values* to one dimension. Per-event arrays are repeated for each entry
+    of the jagged arrays using their offsets, which avoids building cartesian records. All jagged
+    arrays must have a single jagged dimension with the same counts, otherwise a *ValueError* is
+    raised. Scalars are kept. Example:
+
+    .. code-block:: python
+
+        broadcast_flat({"x": ak.Array([[1, 2], [], [3]]), "w": np.array([0.5, 1.0, 2.0]), "c": 0})
+        # {"x": array([1, 2, 3]), "w": array([0.5, 0.5, 2.0]), "c": 0}
+    """
+    counts = None
+    for value in values.values():
+        if not isinstance(value, (ak.Array, np.ndarray)) or value.ndim == 1:
+            continue
+        if value.ndim != 2:
+            raise ValueError(f"cannot broadcast arrays with {value.ndim} dimensions")
+        _counts = np.asarray(ak.num(value, axis=1), dtype=np.int64)
+        if counts is None:
+            counts = _counts
+        elif not np.array_equal(counts, _counts):
+            raise ValueError("cannot broadcast jagged arrays with different structures")
+
+    rows = None if counts is None else np.repeat(np.arange(len(counts)), counts)
+    flat = {}
+    for key, value in values.items():
+        if not isinstance(value, (ak.Array, np.ndarray)):
+            flat[key] = value
+        elif value.ndim == 2:
+            flat[key] = np.asarray(ak.flatten(value, axis=1))
+        elif rows is not None:
+            flat[key] = np.asarray(value)[rows]
+        else:
+            flat[key] = np.asarray(value)
+    return flat
+
+
+def _padded_descending(array: ak.Array, k: int) -> tuple[np.ndarray, np.ndarray]:
+    # negated values of the jagged *array*, padded with inf to at least k entries, and the counts
+    offsets = jagged_offsets(array)
+    counts = np.diff(offsets)
+    flat = np.asarray(ak.flatten(array, axis=1))
+    if not np.issubdtype(flat.dtype, np.floating):
+        flat = flat.astype(np.float64)
+    n_max = max(k, int(counts.max()) if len(counts) else 0)
+    return pad_flat(-flat, offsets, n_max=n_max, fill_value=np.inf), counts
+
+
+def kth_largest(array: ak.Array, k: int, fill_value: float) -> np.ndarray:
+    """
+    Returns the *k*-th largest value (starting at 1) per event of the jagged *array*, or
+    *fill_value* for events with less than *k* entries. Values are selected with a partial sort in
+    linear time instead of sorting all entries. Example:
+
+    .. code-block:: python
+
+        kth_largest(ak.Array([[3.0, 5.0, 4.0], [1.0], []]), 2, -1.0)
+        # array([ 4., -1., -1.])
+    """
+    neg, counts = _padded_descending(array, k)
+    values = -np.partition(neg, k - 1, axis=1)[:, k - 1]
+    return np.where(counts >= k, values, fill_value).astype(neg.dtype)
+
+
+def top_k(array: ak.Array, k: int, fill_value: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the *k* largest values per event of the jagged *array* in descending order and their
+    local indices, both with shape ``(n_events, k)``. Missing entries of events with less than *k*
+    entries are set to *fill_value* and -1, respectively. The order of equal values is undefined.
+    """
+    neg, counts = _padded_descending(array, k)
+    if neg.shape[1] > k:
+        index = np.argpartition(neg, k - 1, axis=1)[:, :k]
+    else:
+        index = np.broadcast_to(np.arange(k), neg.shape).copy()
+    values = np.take_along_axis(neg, index, axis=1)
+    order = np.argsort(values, axis=1, kind="stable")
+    index = np.take_along_axis(index, order, axis=1)
+    values = -np.take_along_axis(values, order, axis=1)
+
+    valid = np.arange(k) < counts[:, None]
+    return np.where(valid, values, fill_value).astype(neg.dtype), np.where(valid, index, -1)
+
+
+def content_hash(array: ak.Array, fields: list[str]) -> np.ndarray:
+    """
+    Returns a 64 bit hash per event of the *fields* of the jagged *array*, depending on the exact
+    values, their order within the event and the number of entries. Used to check that columns
+    derived from the same inputs, e.g. in a different shift, can be reused.
+    """
+    offsets = jagged_offsets(array)
+    local = local_index_flat(offsets).astype(np.uint64)
+    h = _mix64(np.diff(offsets).astype(np.uint64))
+    for i, field in enumerate(fields):
+        bits = np.asarray(ak.flatten(array[field], axis=1), dtype=np.float32).view(np.uint32).astype(np.uint64)
+        x = _mix64(bits ^ (local << np.uint64(32)) ^ (np.uint64(i + 1) << np.uint64(56)))
+        # wrapping sum per event
+        cumsum = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(x, dtype=np.uint64)])
+        h = _mix64(h ^ (cumsum[offsets[1:]] - cumsum[offsets[:-1]]))
+    return h
+
+
+def event_keys(run: np.ndarray, luminosityBlock: np.ndarray, event: np.ndarray) -> np.ndarray:
+    """
+    Returns structured keys identifying events by *run*, *luminosityBlock* and *event* number, which
+    sort in this order and can be given to :py:func:`match_rows`.
+    """
+    keys = np.empty(len(event), dtype=[("run", np.uint64), ("luminosityBlock", np.uint64), ("event", np.uint64)])
+    keys["run"] = np.asarray(run)
+    keys["luminosityBlock"] = np.asarray(luminosityBlock)
+    keys["event"] = np.asarray(event)
+    return keys
+
+
+def match_rows(
+    keys: np.ndarray,
+    values: np.ndarray,
+    order: np.ndarray | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the rows of the unique *keys*, e.g. :py:func:`event_keys`, that match *values* and a mask of the
+    values that were found. Rows of values that were not found are valid but arbitrary indices.
+    *order* can be given as the precomputed ``np.argsort(keys)``.
+    """
+    keys, values = np.asarray(keys), np.asarray(values)
+    if not len(keys):
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+    if order is None:
+        order = np.argsort(keys, kind="stable")
+    rows = order[np.minimum(np.searchsorted(keys[order], values), len(keys) - 1)]
+    return rows, keys[rows] == values
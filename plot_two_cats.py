@@ -6,16 +6,20 @@ import matplotlib.pyplot as plt
 
 # Import your existing plotting function and od classes
 from alljets.plotting.plot_two_variables import plot_unmatched_matched
+from alljets.histogramming.hist_store import LazyHist, is_hist_store, load_hist
 import order as od  # Adjust accordingly
 
 def load_histograms(path: Path) -> dict:
+    # histogram stores are memory-mapped, only the compared categories are read later on
+    if is_hist_store(path):
+        return load_hist(path)
     with open(path, "rb") as f:
         return pickle.load(f)
 
 def main():
     parser = argparse.ArgumentParser(description="Compare two categories from one pickle histogram file.")
 
-    parser.add_argument("--pickle", type=Path, required=True, help="Path to pickle file containing all categories.")
+    parser.add_argument("--pickle", type=Path, required=True, help="Path to pickle file or histogram store directory containing all categories.")
     parser.add_argument("--cat1-name", required=True, help="Name of first category (must be a top-level key in pickle).")
     parser.add_argument("--cat2-name", required=True, help="Name of second category (must be a top-level key in pickle).")
 
@@ -36,8 +40,9 @@ def main():
 
     import IPython
      # Validate category and process existence
-    cat_values = list(hist.axes["category"])
-    proc_values = list(hist.axes["process"])
+    lazy = isinstance(hist, LazyHist)
+    cat_values = hist.categories("category") if lazy else list(hist.axes["category"])
+    proc_values = hist.categories("process") if lazy else list(hist.axes["process"])
 
     if args.cat1_name not in cat_values:
         raise ValueError(f"Category '{args.cat1_name}' not found in histogram (available: {cat_values})")
@@ -55,7 +60,10 @@ def main():
 
     category_inst = od.Category(name=f"{args.cat1_name}_vs_{args.cat2_name}")
     variable_inst = config_inst.variables.get(args.variable)
-    hist_dict = {str(cat): hist[{"category": cat}] for cat in hist.axes["category"]}
+    if lazy:
+        hist_dict = {cat: hist[{"category": cat}] for cat in (args.cat1_name, args.cat2_name)}
+    else:
+        hist_dict = {str(cat): hist[{"category": cat}] for cat in hist.axes["category"]}
 
     # Call plotting function
     fig, axes = plot_unmatched_matched(
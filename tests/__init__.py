@@ -16,4 +16,9 @@ sys.path.append(base)
 import alljets  # noqa
 
 # import all tests
-# ...
+from .test_corrections import *
+from .test_expressions import *
+from .test_hist_store import *
+from .test_kinfit import *
+from .test_reco import *
+from .test_util import *
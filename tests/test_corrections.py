@@ -0,0 +1,86 @@
+# coding: utf-8
+
+__all__ = ["CorrectionsTest"]
+
+import json
+import unittest
+
+from columnflow.util import maybe_import
+
+from alljets.corrections import CorrectionEvaluator, compile_formula
+
+np = maybe_import("numpy")
+correctionlib = maybe_import("correctionlib")
+
+
+def formula_correction_set(formulas: dict) -> tuple:
+    # correction set with one TFormula correction per name in *formulas*, mapping to the expression,
+    # the variable names and the optional parameters
+    content = {
+        "schema_version": 2,
+        "corrections": [
+            {
+                "name": name,
+                "version": 1,
+                "inputs": [{"name": v, "type": "real"} for v in variables],
+                "output": {"name": "weight", "type": "real"},
+                "data": {
+                    "nodetype": "formula",
+                    "expression": expression,
+                    "parser": "TFormula",
+                    "variables": variables,
+                    **({"parameters": parameters} if parameters else {}),
+                },
+            }
+            for name, (expression, variables, parameters) in formulas.items()
+        ],
+    }
+    return correctionlib.CorrectionSet.from_string(json.dumps(content)), content
+
+
+class CorrectionsTest(unittest.TestCase):
+
+    formulas = {
+        # shape of the fitted trigger scale factors
+        "sigmoid": ("[0]/(1+exp(-[1]*(x-[2])))+[3]", ["x"], [0.95, 0.05, 120.0, 0.02]),
+        "functions": ("sqrt(x)*log(x+1)-abs(x-[0])/[1]+pow(x,0.5)", ["x"], [500.0, 1000.0]),
+        "powers": ("2.5e-1*x^2/(1+x^1.5)-0.5*x", ["x"], None),
+        # unary signs bind tighter than ^ in TFormula
+        "unary": ("-x^2+-(y-3.)*[0]-exp(-y/1000)^2*-[0]^2", ["x", "y"], [1.5]),
+        "precedence": ("1-x/2^3^0.5*y-x/y/2", ["x", "y"], None),
+    }
+
+    def setUp(self):
+        self.correction_set, self.content = formula_correction_set(self.formulas)
+        self.rng = np.random.default_rng(42)
+
+    def test_compile_formula(self):
+        for name, (expression, variables, parameters) in self.formulas.items():
+            values = [self.rng.uniform(0.0, 3000.0, 1000) for _ in variables]
+            with self.subTest(name=name):
+                np.testing.assert_allclose(
+                    compile_formula(expression, parameters)(*values),
+                    self.correction_set[name].evaluate(*values),
+                    rtol=1e-12,
+                )
+
+    def test_compile_formula_invalid(self):
+        for expression in ("erf(x)", "TMath::Erf(x)", "x;1", "__import__('os')", "x.real", "x == 1"):
+            with self.subTest(expression=expression):
+                with self.assertRaises(ValueError):
+                    compile_formula(expression)
+
+    def test_evaluator(self):
+        for name, (_, variables, _) in self.formulas.items():
+            evaluator = CorrectionEvaluator(self.correction_set, self.content, name)
+            self.assertIsNotNone(evaluator.formula)
+            values = [self.rng.uniform(0.0, 3000.0, 100).astype(np.float32) for _ in variables]
+            np.testing.assert_allclose(evaluator(*values), self.correction_set[name].evaluate(*values), rtol=1e-12)
+
+    def test_evaluator_fallback(self):
+        # unsupported functions are evaluated with correctionlib
+        correction_set, content = formula_correction_set({"erf": ("0.5*(1+erf((x-[0])/[1]))", ["x"], [100.0, 20.0])})
+        evaluator = CorrectionEvaluator(correction_set, content, "erf")
+        self.assertIsNone(evaluator.formula)
+        values = self.rng.uniform(0.0, 300.0, 100)
+        np.testing.assert_array_equal(evaluator(values), correction_set["erf"].evaluate(values))
@@ -0,0 +1,96 @@
+# coding: utf-8
+
+__all__ = ["MaskExpressionTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from alljets.expressions import MaskExpression
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class MaskExpressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = ak.Array({
+            "chi2": [10.0, 60.0, 30.0, 5.0],
+            "n_jet": [6, 7, 8, 5],
+            "HLT": {"Trig": [True, True, False, True]},
+            "Fit": {"Top": {"mass": [170.0, 175.0, 180.0, 165.0]}},
+        })
+
+    def test_routes(self):
+        expr = MaskExpression("(chi2 < 50) & HLT.Trig & (Fit.Top.mass > n_tight_b)", derived={"n_tight_b"})
+        self.assertEqual(expr.routes, {"chi2", "HLT.Trig", "Fit.Top.mass"})
+        self.assertEqual(MaskExpression("True").routes, set())
+
+    def test_evaluate(self):
+        cases = {
+            "(chi2 < 50) & HLT.Trig": [True, False, False, True],
+            "(chi2 <= 10) | ~HLT.Trig": [True, False, True, True],
+            "(n_jet >= 7) & (Fit.Top.mass != 175)": [False, False, True, False],
+            "chi2 * 2 - n_jet / 2 > 15": [True, True, True, False],
+            "-chi2 < -20": [False, True, True, False],
+            "n_jet == 6": [True, False, False, False],
+            # chained comparisons
+            "6 <= n_jet < 8": [True, True, False, False],
+            "170 <= Fit.Top.mass <= 175 != n_jet": [True, True, False, False],
+            # constants are broadcast to all events
+            "True": [True, True, True, True],
+            "0": [False, False, False, False],
+        }
+        for expression, expected in cases.items():
+            with self.subTest(expression=expression):
+                mask = MaskExpression(expression)(self.events)
+                self.assertEqual(mask.dtype, bool)
+                self.assertEqual(mask.tolist(), expected)
+
+    def test_derived(self):
+        calls = []
+
+        def n_tight_b():
+            calls.append("n_tight_b")
+            return np.array([2, 1, 3, 2])
+
+        def cat_7j():
+            calls.append("cat_7j")
+            return self.events.n_jet >= 7
+
+        derived = {"n_tight_b": n_tight_b, "cat_7j": cat_7j}
+        expr = MaskExpression("(n_tight_b >= 2) & HLT.Trig", derived=derived)
+        self.assertEqual(expr.routes, {"HLT.Trig"})
+        self.assertEqual(expr(self.events, derived).tolist(), [True, False, False, True])
+        # only used derived quantities are computed
+        self.assertEqual(calls, ["n_tight_b"])
+
+        expr = MaskExpression("cat_7j & (n_tight_b >= 2)", derived=derived)
+        self.assertEqual(expr(self.events, derived).tolist(), [False, False, True, False])
+
+        # all derived quantities must be given
+        with self.assertRaises(ValueError):
+            expr(self.events, {"cat_7j": cat_7j})
+        with self.assertRaises(ValueError):
+            expr(self.events)
+
+    def test_rejected(self):
+        expressions = [
+            "abs(chi2) < 5",
+            "Jet.pt[0] > 40",
+            "chi2 < 50 and n_jet > 6",
+            "not HLT.Trig",
+            "n_jet ** 2 > 36",
+            "n_jet % 2 == 0",
+            "n_jet in (6, 7)",
+            "chi2 if HLT.Trig else n_jet",
+            "'chi2' == chi2",
+            "(lambda: chi2)()",
+            "chi2 <",
+            "",
+        ]
+        for expression in expressions:
+            with self.subTest(expression=expression):
+                with self.assertRaises(ValueError):
+                    MaskExpression(expression)
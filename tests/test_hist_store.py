@@ -0,0 +1,105 @@
+# coding: utf-8
+
+__all__ = ["HistStoreTest"]
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from columnflow.util import maybe_import
+
+from alljets.histogramming.hist_store import is_hist_store, load_hist, save_hist
+
+np = maybe_import("numpy")
+hist = maybe_import("hist")
+
+
+class HistStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        rng = np.random.default_rng(42)
+        n = 2000
+        self.h = hist.Hist(
+            hist.axis.StrCategory(["tt", "qcd", "data"], name="process"),
+            hist.axis.IntCategory([5, 7, 9, 11], name="category", growth=True),
+            hist.axis.IntCategory([0, 1], name="shift"),
+            hist.axis.Regular(10, 0.0, 500.0, name="pt", label=r"$p_T$"),
+            hist.axis.Variable([0.0, 0.5, 1.5, 2.4], name="eta", overflow=False),
+            hist.axis.Integer(0, 10, name="n_jet"),
+            storage=hist.storage.Weight(),
+        )
+        self.h.fill(
+            process=rng.choice(["tt", "qcd", "data"], n),
+            category=rng.choice([5, 7, 9, 11], n),
+            shift=rng.choice([0, 1], n),
+            pt=rng.uniform(-10.0, 600.0, n),
+            eta=rng.uniform(-0.5, 3.0, n),
+            n_jet=rng.integers(-1, 12, n),
+            weight=rng.uniform(0.5, 1.5, n),
+        )
+        self.path = os.path.join(self.tmp_dir, "h.hstore")
+        save_hist(self.h, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assertHistEqual(self, h1, h2):
+        self.assertEqual(h1.axes, h2.axes)
+        self.assertEqual([ax.label for ax in h1.axes], [ax.label for ax in h2.axes])
+        self.assertEqual([ax.traits for ax in h1.axes], [ax.traits for ax in h2.axes])
+        np.testing.assert_array_equal(h1.view(flow=True), h2.view(flow=True))
+
+    def test_round_trip(self):
+        self.assertTrue(is_hist_store(self.path))
+        self.assertFalse(is_hist_store(self.tmp_dir))
+        self.assertHistEqual(load_hist(self.path).to_hist(), self.h)
+
+        # overwriting an existing store
+        h = self.h[{"shift": hist.loc(0)}]
+        save_hist(h, self.path)
+        self.assertHistEqual(load_hist(self.path).to_hist(), h)
+
+    def test_storages(self):
+        for storage in (hist.storage.Double(), hist.storage.Int64(), hist.storage.Mean()):
+            h = hist.Hist(
+                hist.axis.StrCategory(["a", "b"], name="c"),
+                hist.axis.Regular(3, 0, 3, name="x"),
+                storage=storage,
+            )
+            kwargs = {"sample": [1.0, 2.0, 3.0]} if isinstance(storage, hist.storage.Mean) else {}
+            h.fill(c=["a", "b", "a"], x=[0.5, 1.5, 5.0], **kwargs)
+            path = os.path.join(self.tmp_dir, f"{type(storage).__name__}.hstore")
+            save_hist(h, path)
+            self.assertHistEqual(load_hist(path).to_hist(), h)
+
+    def test_selections(self):
+        lazy = load_hist(self.path)
+        selections = [
+            {"process": "tt"},
+            {"process": ["data", "tt"]},
+            {"category": 2},
+            {"category": -1},
+            {"category": hist.loc(9)},
+            {"category": [hist.loc(11), hist.loc(5)]},
+            {"process": "qcd", "category": [0, 2], "shift": hist.loc(1)},
+        ]
+        for selection in selections:
+            self.assertHistEqual(lazy[selection], self.h[selection])
+
+        # summing the kept categories afterwards
+        selection = {"process": "tt", "category": [hist.loc(5), hist.loc(9)]}
+        self.assertHistEqual(lazy[selection][{"category": sum}], self.h[selection][{"category": sum}])
+
+    def test_invalid_selections(self):
+        lazy = load_hist(self.path)
+        with self.assertRaises(KeyError):
+            lazy[{"unknown": 0}]
+        with self.assertRaises(KeyError):
+            lazy[{"category": hist.loc(6)}]
+        with self.assertRaises(IndexError):
+            lazy[{"category": 4}]
+        with self.assertRaises(TypeError):
+            lazy[{"category": 1.0}]
@@ -0,0 +1,142 @@
+# coding: utf-8
+
+__all__ = ["KinFitNumpyTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from alljets.production.kinfit_numpy import NCONV_CHI2, fit_numpy, fit_prob
+
+np = maybe_import("numpy")
+
+
+def p4_from_ptetaphim(jets: np.ndarray) -> np.ndarray:
+    # (..., 4) with (pt, eta, phi, mass) to (..., 4) with (e, px, py, pz) in double precision
+    pt, eta, phi, mass = (np.asarray(jets[..., i], dtype=np.float64) for i in range(4))
+    px, py, pz = pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+    return np.stack([np.sqrt(px ** 2 + py ** 2 + pz ** 2 + mass ** 2), px, py, pz], axis=-1)
+
+
+def invariant_mass(p4: np.ndarray) -> np.ndarray:
+    return np.sqrt(np.maximum(p4[..., 0] ** 2 - np.sum(p4[..., 1:] ** 2, axis=-1), 0.0))
+
+
+def two_body_decay(rng, parent: np.ndarray, m1: float, m2: float) -> tuple[np.ndarray, np.ndarray]:
+    # isotropic decays of *parent* four-vectors (n, 4) into daughters of masses m1 and m2
+    m = invariant_mass(parent)
+    p = np.sqrt((m ** 2 - (m1 + m2) ** 2) * (m ** 2 - (m1 - m2) ** 2)) / (2 * m)
+    cos_theta, phi = rng.uniform(-1.0, 1.0, len(m)), rng.uniform(-np.pi, np.pi, len(m))
+    sin_theta = np.sqrt(1.0 - cos_theta ** 2)
+    d = p[:, None] * np.stack([sin_theta * np.cos(phi), sin_theta * np.sin(phi), cos_theta], axis=-1)
+
+    # boost both daughters from the rest frame of the parent
+    b = parent[:, 1:] / parent[:, :1]
+    gamma = parent[:, 0] / m
+    daughters = []
+    for sign, md in ((1.0, m1), (-1.0, m2)):
+        e = np.sqrt(p ** 2 + md ** 2)
+        bp = np.sum(b * sign * d, axis=-1)
+        f = (gamma - 1) * bp / np.sum(b ** 2, axis=-1) + gamma * e
+        daughters.append(np.concatenate([(gamma * (e + bp))[:, None], sign * d + f[:, None] * b], axis=-1))
+    return daughters[0], daughters[1]
+
+
+def ttbar_jets(rng, n_events: int, n_extra: int = 0) -> np.ndarray:
+    # six jets of fully hadronic ttbar decays with 5% pt resolution and *n_extra* additional jets,
+    # shuffled and with shape (n_events, 6 + n_extra, 4) and fields (pt, eta, phi, mass)
+    partons = []
+    for _ in range(2):
+        top = p4_from_ptetaphim(np.stack([
+            rng.uniform(50.0, 250.0, n_events),
+            rng.uniform(-1.5, 1.5, n_events),
+            rng.uniform(-np.pi, np.pi, n_events),
+            np.full(n_events, 172.5),
+        ], axis=-1))
+        b, w = two_body_decay(rng, top, 4.8, 80.4)
+        partons.extend((b,) + two_body_decay(rng, w, 0.1, 0.1))
+    p4 = np.stack(partons, axis=1)
+
+    pt = np.hypot(p4[..., 1], p4[..., 2]) * rng.normal(1.0, 0.05, p4.shape[:2])
+    jets = np.stack([
+        pt,
+        np.arcsinh(p4[..., 3] / np.hypot(p4[..., 1], p4[..., 2])),
+        np.arctan2(p4[..., 2], p4[..., 1]),
+        invariant_mass(p4),
+    ], axis=-1)
+    extra = np.stack([
+        rng.uniform(40.0, 100.0, (n_events, n_extra)),
+        rng.uniform(-2.4, 2.4, (n_events, n_extra)),
+        rng.uniform(-np.pi, np.pi, (n_events, n_extra)),
+        np.full((n_events, n_extra), 8.0),
+    ], axis=-1)
+    jets = np.concatenate([jets, extra], axis=1)
+    order = rng.permuted(np.tile(np.arange(jets.shape[1]), (n_events, 1)), axis=1)
+    return np.take_along_axis(jets, order[..., None], axis=1)
+
+
+class KinFitNumpyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(42)
+
+        # events with six and seven jets, and with less than six jets, padded to seven jets
+        jets6 = ttbar_jets(self.rng, 12)
+        jets7 = ttbar_jets(self.rng, 4, n_extra=1)
+        short = ttbar_jets(self.rng, 6)[:, :5]
+        self.counts = np.array([6] * len(jets6) + [7] * len(jets7) + [5, 4, 3, 1, 0, 5])
+        self.jets = np.zeros((len(self.counts), 7, 4), dtype=np.float32)
+        self.jets[:len(jets6), :6] = jets6
+        self.jets[len(jets6):len(jets6) + len(jets7)] = jets7
+        for i, n in enumerate(self.counts[-len(short):], len(jets6) + len(jets7)):
+            self.jets[i, :n] = short[i - len(jets6) - len(jets7), :n]
+
+    def test_constraints(self):
+        fit_jets, indices, chi2, pgof = fit_numpy(self.jets, self.counts)
+        self.assertEqual(fit_jets.shape, (len(self.counts), 6, 4))
+        self.assertEqual(indices.shape, (len(self.counts), 6))
+
+        converged = chi2 < NCONV_CHI2
+        fitted = self.counts >= 6
+        # the correct hypothesis of generated ttbar events fulfills the constraints within resolution
+        self.assertTrue(np.all(converged[fitted]))
+        self.assertTrue(np.all(chi2[converged] >= 0))
+        np.testing.assert_allclose(pgof[converged], fit_prob(chi2[converged]))
+
+        # fitted jets satisfy the constraints, in the order (B1, B2, W1Prod1, W1Prod2, W2Prod1, W2Prod2)
+        p4 = p4_from_ptetaphim(fit_jets[converged])
+        mw1 = invariant_mass(p4[:, 2] + p4[:, 3])
+        mw2 = invariant_mass(p4[:, 4] + p4[:, 5])
+        mt1 = invariant_mass(p4[:, 0] + p4[:, 2] + p4[:, 3])
+        mt2 = invariant_mass(p4[:, 1] + p4[:, 4] + p4[:, 5])
+        np.testing.assert_allclose(mw1, 80.4, atol=0.02)
+        np.testing.assert_allclose(mw2, 80.4, atol=0.02)
+        np.testing.assert_allclose(mt1 - mt2, 0.0, atol=0.02)
+
+        # fitted jets are distinct jets of the event, with their mass and only slightly changed
+        self.assertTrue(np.all(np.sort(indices[fitted], axis=1)[:, 1:] > np.sort(indices[fitted], axis=1)[:, :-1]))
+        self.assertTrue(np.all(indices[fitted] < self.counts[fitted, None]))
+        measured = np.take_along_axis(self.jets[fitted], indices[fitted][..., None], axis=1)
+        np.testing.assert_array_equal(fit_jets[fitted, :, 3], measured[..., 3])
+        np.testing.assert_allclose(fit_jets[fitted, :, 0], measured[..., 0], rtol=0.5)
+
+    def test_short_events(self):
+        fit_jets, indices, chi2, pgof = fit_numpy(self.jets, self.counts)
+        short = self.counts < 6
+        np.testing.assert_array_equal(chi2[short], NCONV_CHI2)
+        np.testing.assert_array_equal(pgof[short], 0.0)
+        # unchanged leading jets
+        np.testing.assert_array_equal(indices[short], np.tile(np.arange(6), (np.sum(short), 1)))
+        np.testing.assert_array_equal(fit_jets[short], self.jets[short, :6])
+
+        # only short events
+        fit_jets, indices, chi2, pgof = fit_numpy(self.jets[short, :5], self.counts[short])
+        self.assertEqual(fit_jets.shape, (np.sum(short), 6, 4))
+        np.testing.assert_array_equal(chi2, NCONV_CHI2)
+        np.testing.assert_array_equal(pgof, 0.0)
+        np.testing.assert_array_equal(fit_jets[:, :5], self.jets[short, :5])
+        np.testing.assert_array_equal(fit_jets[:, 5], 0.0)
+
+        # events limited to less than six jets
+        _, _, chi2, _ = fit_numpy(self.jets, self.counts, max_jets=5)
+        np.testing.assert_array_equal(chi2, NCONV_CHI2)
@@ -0,0 +1,107 @@
+# coding: utf-8
+
+__all__ = ["Chi2RecoTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from alljets.selection.reco import MASS_CHI2, chi2_reco, chi2_reco_tensor
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+maybe_import("coffea.nanoevents.methods.vector")
+
+
+def random_jets(rng: np.random.Generator, counts: np.ndarray) -> ak.Array:
+    from coffea.nanoevents.methods import vector
+
+    n = int(np.sum(counts))
+    flat = {
+        "pt": rng.uniform(30.0, 200.0, n),
+        "eta": rng.uniform(-2.4, 2.4, n),
+        "phi": rng.uniform(-np.pi, np.pi, n),
+        "mass": rng.uniform(2.0, 20.0, n),
+    }
+    return ak.zip(
+        {field: ak.unflatten(values, counts) for field, values in flat.items()},
+        with_name="PtEtaPhiMLorentzVector",
+        behavior=vector.behavior,
+    )
+
+
+def cartesian_chi2_reco(bjets: ak.Array, ljets: ak.Array) -> tuple:
+    # evaluation of all candidates as in the jet selection before the pruning
+    b1, b2 = ak.unzip(ak.combinations(bjets, 2, axis=1))
+    bperms = ak.concatenate([ak.zip([b1, b2]), ak.zip([b2, b1])], axis=1)
+    j1, j2, j3, j4 = ak.unzip(ak.combinations(ljets, 4, axis=1))
+    lperms = ak.concatenate([ak.zip([j1, j2, j3, j4]), ak.zip([j1, j3, j2, j4]), ak.zip([j1, j4, j2, j3])], axis=1)
+    sixjets = ak.cartesian([bperms, lperms], axis=1)
+
+    b1, b2 = ak.unzip(ak.unzip(sixjets)[0])
+    j1, j2, j3, j4 = ak.unzip(ak.unzip(sixjets)[1])
+    harder = b1.pt > b2.pt
+    mt1 = ak.where(harder, (b1 + j1 + j2).mass, (b2 + j3 + j4).mass)
+    mt2 = ak.where(harder, (b2 + j3 + j4).mass, (b1 + j1 + j2).mass)
+    mw1 = ak.where(harder, (j1 + j2).mass, (j3 + j4).mass)
+    mw2 = ak.where(harder, (j3 + j4).mass, (j1 + j2).mass)
+    p = MASS_CHI2
+    chi2 = (
+        (mw1 - p["mw"] - p["mu_w"]) ** 2 / p["mw_sigma"] ** 2 +
+        (mw2 - p["mw"] - p["mu_w"]) ** 2 / p["mw_sigma"] ** 2 +
+        (mt1 - mt2 - p["mu_tt"]) ** 2 / p["mt_sigma"] ** 2
+    )
+    best = ak.argmin(chi2, axis=1, keepdims=True)
+    return mt1[best], mt2[best], mw1[best], mw2[best], b1.delta_r(b2)[best], chi2[best], best
+
+
+class Chi2RecoTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(42)
+        n_events = 300
+        self.bjets = random_jets(rng, np.full(n_events, 2))
+        self.ljets = random_jets(rng, rng.integers(4, 8, n_events))
+
+    def test_pruned_candidates(self):
+        result = chi2_reco(self.bjets, self.ljets, fill_value=-99999.0)
+        expected = cartesian_chi2_reco(self.bjets, self.ljets)
+
+        # same best candidate
+        self.assertEqual(ak.flatten(result[6]).tolist(), ak.flatten(expected[6]).tolist())
+        # same masses, distance of the b jets and chi2
+        for values, expected_values in zip(result[:6], expected[:6]):
+            np.testing.assert_allclose(ak.to_numpy(ak.flatten(values)), ak.to_numpy(ak.flatten(expected_values)))
+
+        # best combination made of the jets at these positions
+        (b1, b2), (j1, j2, j3, j4) = (ak.unzip(c) for c in ak.unzip(result[7]))
+        mw = (j1 + j2).mass
+        mw_other = (j3 + j4).mass
+        harder = b1.pt > b2.pt
+        np.testing.assert_allclose(
+            ak.to_numpy(ak.flatten(ak.where(harder, mw, mw_other))),
+            ak.to_numpy(ak.flatten(result[2])),
+        )
+
+    def test_tensor_mode(self):
+        result = chi2_reco_tensor(self.bjets, self.ljets, fill_value=-99999.0)
+        expected = chi2_reco(self.bjets, self.ljets, fill_value=-99999.0)
+
+        # same best candidate and, up to the float32 precision of the tensor mode, the same values
+        self.assertEqual(ak.flatten(result[6]).tolist(), ak.flatten(expected[6]).tolist())
+        for values, expected_values in zip(result[:6], expected[:6]):
+            np.testing.assert_allclose(
+                ak.to_numpy(ak.flatten(values)),
+                ak.to_numpy(ak.flatten(expected_values)),
+                rtol=1e-4,
+                atol=1e-4,
+            )
+        for jets, expected_jets in zip(ak.unzip(result[7]), ak.unzip(expected[7])):
+            for jet, expected_jet in zip(ak.unzip(jets), ak.unzip(expected_jets)):
+                self.assertEqual(ak.flatten(jet.pt).tolist(), ak.flatten(expected_jet.pt).tolist())
+
+    def test_no_events(self):
+        for reco in (chi2_reco, chi2_reco_tensor):
+            result = reco(self.bjets[:0], self.ljets[:0], fill_value=-1.0)
+            self.assertEqual(len(result), 8)
+            self.assertTrue(all(values == [[-1.0]] for values in result))
@@ -0,0 +1,241 @@
+# coding: utf-8
+
+__all__ = ["UtilTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from alljets.util import (
+    content_hash, event_keys, expand_bitmask, jagged_offsets, kth_largest, leading_order, match_rows, pack_bitmask,
+    scatter_leading, seeded_permutations, top_k,
+)
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def append_indices(initial_array: list, target_lengths: list) -> list:
+    # reference, appends the indices missing in each list up to its target length
+    for inner_list, target_length in zip(initial_array, target_lengths):
+        for num in range(target_length):
+            if num not in inner_list:
+                inner_list.append(num)
+            if len(inner_list) >= target_length:
+                break
+    return initial_array
+
+
+def insert_at_index(to_insert, where: ak.Array, indices_to_replace: np.ndarray) -> ak.Array:
+    # reference, replaces the lists of *where* for events in *indices_to_replace* by *to_insert*
+    mask = ak.full_like(where, True, dtype=bool) & indices_to_replace
+    cut_replaced = ak.unflatten(ak.flatten(ak.Array(to_insert), axis=None), ak.num(where[mask]))
+    return ak.concatenate((where[~mask], cut_replaced), axis=1)
+
+
+def trig_bits(hlt: ak.Array, triggers: list[str], ref_trigger: str) -> tuple[ak.Array, ak.Array]:
+    # reference, jagged trigger ids as produced by trigger_prod before the bit packing
+    arr = ak.singletons(np.zeros(len(hlt)))
+    arr_orth = ak.singletons(np.zeros(len(hlt)))
+    for id, trigger in enumerate(triggers, 1):
+        passed = ak.singletons(ak.nan_to_none(ak.where(hlt[trigger], id, np.float64(np.nan))))
+        passed_orth = ak.singletons(ak.nan_to_none(ak.where(hlt[ref_trigger] & hlt[trigger], id, np.float64(np.nan))))
+        arr = ak.concatenate([arr, passed], axis=1)
+        arr_orth = ak.concatenate([arr_orth, passed_orth], axis=1)
+    return arr, arr_orth
+
+
+class UtilTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(42)
+
+    def test_leading_order_and_scatter(self):
+        # events with up to nine jets, those with at least six are fitted
+        counts = self.rng.integers(0, 10, 500)
+        values = ak.unflatten(self.rng.uniform(0.0, 100.0, int(np.sum(counts))).astype(np.float32), counts)
+        eventmask = (counts >= 6) & (self.rng.uniform(size=len(counts)) < 0.8)
+        rows = np.flatnonzero(eventmask)
+        fit_indices = np.array([self.rng.permutation(counts[row])[:6] for row in rows]).reshape(-1, 6)
+        fit_values = self.rng.uniform(0.0, 100.0, (len(rows), 6)).astype(np.float32)
+
+        # previous implementation
+        combined = insert_at_index(
+            append_indices(fit_indices.tolist(), counts[eventmask].tolist()),
+            ak.local_index(values),
+            eventmask,
+        )
+        expected_top6 = values[combined][:, :6]
+        expected_fit = insert_at_index(fit_values, expected_top6, eventmask)
+
+        # flat implementation
+        offsets = jagged_offsets(values)
+        order = ak.unflatten(leading_order(offsets, rows, fit_indices), counts)
+        top6 = values[order][:, :6]
+        self.assertEqual(top6.tolist(), expected_top6.tolist())
+
+        offsets_top6 = jagged_offsets(top6)
+        fit = ak.unflatten(
+            scatter_leading(ak.to_numpy(ak.flatten(top6)), offsets_top6, rows, fit_values),
+            np.diff(offsets_top6),
+        )
+        self.assertEqual(fit.tolist(), expected_fit.tolist())
+
+    def test_leading_order_example(self):
+        order = leading_order(np.array([0, 3, 7]), np.array([1]), np.array([[2, 0]]))
+        self.assertEqual(order.tolist(), [0, 1, 2, 2, 0, 1, 3])
+
+    def test_scatter_leading_short_events(self):
+        # values beyond the number of entries are dropped
+        flat = scatter_leading(
+            np.array([1.0, 2.0, 3.0, 4.0]),
+            np.array([0, 1, 4]),
+            np.array([0, 1]),
+            np.array([[7.0, 7.5], [8.0, 9.0]]),
+        )
+        self.assertEqual(flat.tolist(), [7.0, 8.0, 9.0, 4.0])
+
+    def test_seeded_permutations_chunking(self):
+        seeds = self.rng.integers(0, 2 ** 63, 1000, dtype=np.uint64)
+        perms = seeded_permutations(seeds, 6)
+
+        # valid permutations of range(6)
+        self.assertEqual(perms.shape, (1000, 6))
+        self.assertTrue(np.all(np.sort(perms, axis=1) == np.arange(6)))
+        # not all the same
+        self.assertGreater(len(np.unique(perms, axis=0)), 100)
+
+        # independent of chunking and processing order
+        for chunk_size in (1, 7, 128, 999):
+            chunks = [seeded_permutations(seeds[i:i + chunk_size], 6) for i in range(0, len(seeds), chunk_size)]
+            np.testing.assert_array_equal(np.concatenate(chunks), perms)
+        order = self.rng.permutation(len(seeds))
+        np.testing.assert_array_equal(seeded_permutations(seeds[order], 6), perms[order])
+
+    def test_trigger_bitmask(self):
+        n_events = 1000
+        triggers = [f"trigger_{i}" for i in range(5)]
+        hlt = ak.zip({name: self.rng.uniform(size=n_events) < 0.4 for name in triggers + ["ref"]})
+        expected, expected_orth = trig_bits(hlt, triggers, "ref")
+
+        # packing as in trigger_prod, with bit 0 of both halves for the inclusive entry
+        ones = np.ones(n_events, dtype=bool)
+        passed = [ak.to_numpy(hlt[name]) for name in triggers]
+        mask = (
+            pack_bitmask([ones] + passed) |
+            pack_bitmask([ones] + [p & ak.to_numpy(hlt.ref) for p in passed], shift=32)
+        )
+
+        # expanded as in the histogram filling of the trig_bits and trig_bits_orth variables
+        for shift, values in ((0, expected), (32, expected_orth)):
+            rows, bits = expand_bitmask(mask, shift=shift)
+            self.assertEqual(
+                ak.unflatten(bits, np.bincount(rows, minlength=n_events)).tolist(),
+                ak.values_astype(values, np.int64).tolist(),
+            )
+
+    def test_pack_bitmask_limit(self):
+        with self.assertRaises(ValueError):
+            pack_bitmask([np.ones(2, dtype=bool)] * 33, shift=32)
+
+    def test_kth_largest_example(self):
+        values = kth_largest(ak.Array([[3.0, 5.0, 4.0], [1.0], []]), 2, -1.0)
+        self.assertEqual(values.tolist(), [4.0, -1.0, -1.0])
+
+    def test_kth_largest_and_top_k(self):
+        # events with fewer, as many and more entries than k
+        counts = self.rng.integers(0, 9, 500)
+        array = ak.unflatten(self.rng.uniform(0.0, 100.0, int(np.sum(counts))).astype(np.float32), counts)
+
+        for k in (1, 4, 6):
+            # sort-based reference
+            order = ak.argsort(array, axis=1, ascending=False)
+            expected_values = ak.fill_none(ak.pad_none(array[order], k, clip=True), -1.0)
+            expected_index = ak.fill_none(ak.pad_none(order, k, clip=True), -1)
+
+            values, index = top_k(array, k, -1.0)
+            self.assertEqual(values.shape, (len(counts), k))
+            self.assertEqual(values.dtype, np.float32)
+            self.assertEqual(values.tolist(), expected_values.tolist())
+            self.assertEqual(index.tolist(), expected_index.tolist())
+
+            kth = kth_largest(array, k, -1.0)
+            self.assertEqual(kth.dtype, np.float32)
+            self.assertEqual(kth.tolist(), expected_values[:, k - 1].tolist())
+            self.assertTrue(np.all(kth[counts < k] == -1.0))
+
+    def test_top_k_short_events(self):
+        # all events shorter than k, including empty arrays and integer values
+        values, index = top_k(ak.Array([[2, 7], [], [5]]), 3, 0.0)
+        self.assertEqual(values.tolist(), [[7.0, 2.0, 0.0], [0.0, 0.0, 0.0], [5.0, 0.0, 0.0]])
+        self.assertEqual(index.tolist(), [[1, 0, -1], [-1, -1, -1], [0, -1, -1]])
+
+        values, index = top_k(ak.Array([[1.0]])[:0], 2, 0.0)
+        self.assertEqual(values.shape, (0, 2))
+        self.assertEqual(index.shape, (0, 2))
+        self.assertEqual(kth_largest(ak.Array([[], []]), 1, 9.0).tolist(), [9.0, 9.0])
+
+    def test_match_rows(self):
+        # unique keys in random order, and values of which some are missing
+        n = 1000
+        keys = event_keys(
+            self.rng.integers(1, 4, n),
+            self.rng.integers(1, 100, n),
+            self.rng.choice(2 ** 40, n, replace=False),
+        )
+        keys = keys[self.rng.permutation(n)]
+        rows = self.rng.integers(0, n, 300)
+        values = keys[rows].copy()
+        missing = self.rng.uniform(size=len(values)) < 0.3
+        values["event"][missing] += np.uint64(2 ** 40)
+
+        found_rows, found = match_rows(keys, values)
+        np.testing.assert_array_equal(found, ~missing)
+        np.testing.assert_array_equal(found_rows[found], rows[~missing])
+        self.assertTrue(np.all((found_rows >= 0) & (found_rows < n)))
+
+        # same result with precomputed order
+        found_rows_order, found_order = match_rows(keys, values, order=np.argsort(keys, kind="stable"))
+        np.testing.assert_array_equal(found_rows_order, found_rows)
+        np.testing.assert_array_equal(found_order, found)
+
+        # keys differing only in the run or luminosity block
+        keys = event_keys([1, 1, 2], [1, 2, 1], [5, 5, 5])
+        found_rows, found = match_rows(keys, event_keys([2, 1, 1], [1, 2, 3], [5, 5, 5]))
+        self.assertEqual(found.tolist(), [True, True, False])
+        self.assertEqual(found_rows[found].tolist(), [2, 1])
+
+        # no keys
+        found_rows, found = match_rows(keys[:0], keys)
+        self.assertEqual(found.tolist(), [False, False, False])
+        self.assertEqual(len(found_rows), 3)
+
+    def test_content_hash(self):
+        jets = ak.zip({
+            "pt": ak.Array([[50.0, 40.0, 30.0], [50.0, 40.0], [], [40.0, 50.0, 30.0], [50.0, 40.0, 30.0]]),
+            "eta": ak.Array([[0.1, -0.2, 0.3], [0.1, -0.2], [], [-0.2, 0.1, 0.3], [0.1, -0.2, 0.3]]),
+        })
+        h = content_hash(jets, ["pt", "eta"])
+        self.assertEqual(h.dtype, np.uint64)
+
+        # equal for the same values, different for other counts and order
+        self.assertEqual(h[0], h[4])
+        self.assertEqual(len(set(h[:4].tolist())), 4)
+        # independent of the event position
+        np.testing.assert_array_equal(content_hash(jets[::-1], ["pt", "eta"]), h[::-1])
+
+        # different for a changed value or field, also when swapped between fields
+        changed = ak.zip({"pt": ak.Array([[50.0, 40.0, 30.5]]), "eta": jets.eta[:1]})
+        self.assertNotEqual(content_hash(changed, ["pt", "eta"])[0], h[0])
+        self.assertNotEqual(content_hash(jets[:1], ["pt"])[0], h[0])
+        self.assertNotEqual(content_hash(jets[:1], ["eta", "pt"])[0], h[0])
+
+        # no collisions for random events
+        counts = self.rng.integers(0, 10, 10000)
+        jets = ak.zip({
+            "pt": ak.unflatten(self.rng.uniform(40.0, 300.0, int(np.sum(counts))).astype(np.float32), counts),
+            "eta": ak.unflatten(self.rng.uniform(-2.4, 2.4, int(np.sum(counts))).astype(np.float32), counts),
+        })
+        h = content_hash(jets, ["pt", "eta"])
+        # (all empty events share one hash)
+        self.assertEqual(len(np.unique(h)), np.sum(counts > 0) + np.any(counts == 0))